@@ -2,3 +2,8 @@ from ocr import SpriteIdentifier, StreamProcessor, LogHandler
 from delta import StringDeltaCompressor
 from dialog import BoxReader
 from video import ScreenExtractor, ScreenCompressor
+from pipeline import ParallelStreamProcessor
+from archive import TileDeltaCompressor, TileDeltaReader, ScreenArchiveReader
+from sinks import AsyncHandler, LocalPublisher
+from textlog import TextLog, TextLogReader
+from multistream import MultiStreamProcessor
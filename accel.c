@@ -2,6 +2,7 @@
 #include <stdio.h>
 #include <math.h>
 #include <memory.h>
+#include <pthread.h>
 
 #include "accel.h"
 
@@ -29,12 +30,77 @@ void pack2bpp(uint8_t *in, uint8_t *out) {
     }
 }
 
+void unpack2bpp(uint8_t *in, uint8_t *out, int count) {
+    /*
+    Inverse of pack2bpp, for count frames in a row.
+
+    Input: count*5760 bytes of packed 8x8 blocks
+    Output: count*144*160 bytes with values in [0, 3]
+    */
+
+    int x, y, n, i;
+
+    for (; count > 0; count--, out += 144 * 160) {
+        for (y = 0; y < 18; y++) {
+            for (x = 0; x < 20; x++) {
+                for (n = 0; n < 8; ++n) {
+                    uint8_t *row = out + (y * 8 + n) * 160 + x * 8;
+                    for (i = 0; i < 8; i += 4, in++) {
+                        row[i] = *in & 3;
+                        row[i+1] = (*in >> 2) & 3;
+                        row[i+2] = (*in >> 4) & 3;
+                        row[i+3] = *in >> 6;
+                    }
+                }
+            }
+        }
+    }
+}
+
+int sample_changed(uint8_t *raw, int raw_stride, int width, int height, int step, uint8_t *last, int tolerance) {
+    /*
+    Cheap change detection on a raw frame region: compare every step-th
+    pixel (in both directions) against the samples in last, which holds
+    (height / step) * (width / step) bytes.
+
+    Returns 0 if no sample moved by more than tolerance. Otherwise, stores
+    the new samples in last and returns 1.
+    */
+    int x, y;
+    int cols = width / step, rows = height / step;
+    uint8_t *prev = last;
+
+    for (y = 0; y < rows; ++y) {
+        uint8_t *row = raw + y * step * raw_stride;
+        for (x = 0; x < cols; ++x) {
+            int diff = row[x * step] - *prev++;
+            if (diff > tolerance || diff < -tolerance) {
+                goto changed;
+            }
+        }
+    }
+    return 0;
+
+changed:
+    for (y = 0; y < rows; ++y) {
+        uint8_t *row = raw + y * step * raw_stride;
+        for (x = 0; x < cols; ++x) {
+            *last++ = row[x * step];
+        }
+    }
+    return 1;
+}
+
 #define MAX_PALETTE_SIZE 16
+#define MAX_NEAR_DIST 2  /* every sprite is at least 3 columns wide */
 
-const int kSpriteX = 7;
-const int kSpriteY = 14;
+const int kSpriteX = 7;  /* widest sprite */
 
-#define SP_PIX(x, y) image[(y)+(x)*160]
+#define MAX_WIDTH 256
+#define MAX_HEIGHT 256
+
+/* images are column-major, `height` has to be in scope */
+#define SP_PIX(x, y) image[(y)+(x)*height]
 
 void translate_bytes(uint8_t *image, int len, uint8_t *table) {
     int i;
@@ -43,118 +109,732 @@ void translate_bytes(uint8_t *image, int len, uint8_t *table) {
     }
 }
 
-static struct sprite *find_sprite(uint32_t *needle, struct sprite *haystack, int n_sprites) {
-    int low = 0, high = n_sprites;
+void translate_screen(uint8_t *screen, int width, int height, uint8_t *table, uint8_t *image) {
+    /*
+    Map a row-major width x height screen through table into the
+    column-major layout identify_sprites reads, in one pass.
+    */
+    int x, y;
+    for (y = 0; y < height; ++y) {
+        for (x = 0; x < width; ++x) {
+            SP_PIX(x, y) = table[screen[y * width + x]];
+        }
+    }
+}
+
+static inline __attribute__((always_inline))
+void shrink_screen(uint8_t *raw, int raw_stride, int scale, int width, int height,
+                   uint8_t *screen, uint8_t *table, uint8_t *image) {
+    /*
+    Shrink the (width*scale)x(height*scale) region at raw to width x height
+    by averaging scale x scale blocks, rounding like cv2.resize's INTER_AREA
+    (half to even). Writes the result row-major into screen and/or mapped
+    through table, column-major into image; either may be NULL.
+
+    scale must be at most 8, and width at most MAX_WIDTH.
+    */
+    int x, y, i, j;
+    int area = scale * scale;
+    int shift = -1;
+    uint16_t line[MAX_WIDTH * 8];
+
+    for (i = 0; i < 16; ++i) {
+        if (area == 1 << i) {
+            shift = i;
+        }
+    }
 
-    /* binary search to find a match */
-    while (low + 1 < high) {
-        int mid = (low + high) / 2;
-        int dir = memcmp(needle, haystack[mid].image, sizeof(*needle) * haystack[mid].width);
-        if (dir == 0) {
-            return &haystack[mid];
-        } else if (dir < 0) {
-            high = mid;
-        } else if (dir > 0) {
-            low = mid;
+    for (y = 0; y < height; ++y) {
+        /* sum the rows first, so these loops vectorize */
+        uint8_t *row = raw + y * scale * raw_stride;
+        for (i = 0; i < width * scale; ++i) {
+            line[i] = row[i];
+        }
+        for (j = 1; j < scale; ++j) {
+            row += raw_stride;
+            for (i = 0; i < width * scale; ++i) {
+                line[i] += row[i];
+            }
+        }
+        for (x = 0; x < width; ++x) {
+            uint32_t sum = 0, q, rem;
+            for (i = 0; i < scale; ++i) {
+                sum += line[x * scale + i];
+            }
+            if (shift >= 0) {
+                q = sum >> shift;
+                rem = sum & (area - 1);
+            } else {
+                q = sum / area;
+                rem = sum % area;
+            }
+            if (rem * 2 > area || (rem * 2 == area && (q & 1))) {
+                q++;
+            }
+            if (screen) {
+                screen[y * width + x] = q;
+            }
+            if (image) {
+                SP_PIX(x, y) = table[q];
+            }
         }
     }
-    return NULL;
 }
 
-int identify_sprites(uint8_t *image, struct sprite *sprites, int n_sprites, struct sprite_match *matched, int max_matches) {
+void extract_screen(uint8_t *raw, int raw_stride, int scale, int width, int height,
+                    uint8_t *screen, uint8_t *table, uint8_t *image) {
     /*
-    Identify sprites using palette pattern matching
+    shrink_screen, with the geometries of the games we read (see
+    tilesets.py) as constants, so the compiler can unroll the block sums
+    and turn the division into shifts and multiplies.
     */
-    int x, y;
+    if (scale == 4 && width == 240 && height == 160) {
+        shrink_screen(raw, raw_stride, 4, 240, 160, screen, table, image);
+    } else if (scale == 3 && width == 160 && height == 144) {
+        shrink_screen(raw, raw_stride, 3, 160, 144, screen, table, image);
+    } else {
+        shrink_screen(raw, raw_stride, scale, width, height, screen, table, image);
+    }
+}
 
-    int considered = 0;
-    int match_count = 0;
+static uint32_t hash_sprite(const uint32_t *image, int width) {
+    uint32_t h = 2166136261u ^ width;
+    int i;
+    for (i = 0; i < width; ++i) {
+        h = (h ^ image[i]) * 16777619u;
+        h ^= h >> 15;
+    }
+    return h;
+}
 
-    for (y = 1; y < 160 - kSpriteY; ++y) {
-        int found = 0;
-        int lastX = -1;
-        for (x = 0; x < 240 - kSpriteX; ++x) {
-            // skip if it's not solid above
-            ///*
-            int off;
-            int prev = SP_PIX(x, y - 1);
-            for (off = 1; off < kSpriteX; ++off) {
-                if (SP_PIX(x + off, y - 1) != prev) {
-                    x += off;
-                    goto next_x;
-                }
+int build_sprite_index(struct sprite *sprites, int n_sprites, struct sprite_index *index, int32_t *table, int table_size) {
+    /*
+    Build an open-addressing hash table over the sprites' packed columns.
+    Each sprite is keyed by its first `width` columns, so lookups hash the
+    screen tile once per distinct width.
+
+    table_size must be a power of two, comfortably larger than n_sprites.
+    Returns 0, or -1 if the table is too small.
+    */
+    int i, n;
+
+    if (table_size & (table_size - 1) || table_size < n_sprites * 2) {
+        return -1;
+    }
+
+    index->sprites = sprites;
+    index->n_sprites = n_sprites;
+    index->mask = table_size - 1;
+    index->table = table;
+    index->n_widths = 0;
+
+    for (i = 0; i < table_size; ++i) {
+        table[i] = -1;
+    }
+
+    for (n = 0; n < n_sprites; ++n) {
+        struct sprite *sprite = &sprites[n];
+        int width = sprite->width;
+        uint32_t slot = hash_sprite(sprite->image, width) & index->mask;
+        int duplicate = 0;
+
+        if (width < 1 || width > kSpriteX) {
+            return -1;
+        }
+
+        while (table[slot] != -1) {
+            struct sprite *other = &sprites[table[slot]];
+            if (other->width == width && !memcmp(other->image, sprite->image, sizeof(uint32_t) * width)) {
+                duplicate = 1;  /* the first sprite with this image wins */
+                break;
             }
-            //*/
+            slot = (slot + 1) & index->mask;
+        }
+        if (duplicate) {
+            continue;
+        }
+        table[slot] = n;
 
-            // skip if it's a solid line on the left
-            int count = 0;
-            prev = SP_PIX(x, y);
-            for (off = 1; off < kSpriteY; ++off) {
-                if (SP_PIX(x, y + off) == prev) {
-                    count++;
-                } else {
-                    break;
-                }
+        /* keep the widths sorted widest first: when sprites of different
+           widths match, the widest one is the most specific */
+        for (i = 0; i < index->n_widths && index->widths[i] > width; ++i);
+        if (i == index->n_widths || index->widths[i] != width) {
+            memmove(&index->widths[i + 1], &index->widths[i], sizeof(int) * (index->n_widths - i));
+            index->widths[i] = width;
+            index->n_widths++;
+        }
+    }
+
+    filter_sprites(index);
+    return 0;
+}
+
+static inline uint32_t column_bit(uint32_t col) {
+    return (col * 2654435761u) >> 21;  /* 0-2047 */
+}
+
+void filter_sprites(struct sprite_index *index) {
+    /*
+    Fill in index->first_columns, so tiles that can't be a sprite are
+    turned down without hashing them. Indexes loaded from a cache need
+    this too.
+    */
+    int n;
+
+    memset(index->first_columns, 0, sizeof(index->first_columns));
+    for (n = 0; n < index->n_sprites; ++n) {
+        uint32_t bit = column_bit(index->sprites[n].image[0]);
+        index->first_columns[bit / 32] |= 1u << (bit % 32);
+    }
+}
+
+/*
+Approximate matching, by multi-index hashing: a sprite's columns are split
+into max_dist + 1 parts (columns p, p + parts, p + 2 * parts, ...), and
+each part is hashed on its own. A tile at most max_dist pixels away from a
+sprite can't have a wrong pixel in every part, so it shares at least one
+part with it exactly, and only the sprites found through those need to be
+compared pixel by pixel. Column p is always in part p, so tiles that have
+none of their first max_dist + 1 columns in the same place as any sprite
+are turned down first, with a bit filter like first_columns.
+*/
+static uint32_t hash_part(const uint32_t *image, int width, int part, int parts) {
+    uint32_t h = 2166136261u ^ (width << 8 | part);
+    int i;
+    for (i = part; i < width; i += parts) {
+        h = (h ^ image[i]) * 16777619u;
+        h ^= h >> 15;
+    }
+    return h;
+}
+
+static int same_part(const uint32_t *a, const uint32_t *b, int width, int part, int parts) {
+    int i;
+    for (i = part; i < width; i += parts) {
+        if (a[i] != b[i]) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+int build_near_index(struct sprite_index *index, int32_t *table, int table_size, int max_dist) {
+    /*
+    Index the sprites for matches up to max_dist pixels off, see
+    hash_part. max_dist 0 turns approximate matching off. table_size
+    must be a power of two, at least 2 * n_sprites * (max_dist + 1).
+    Returns 0, or -1 if the table is too small or max_dist too big.
+    */
+    int i, n, part;
+    int parts = max_dist + 1;
+
+    if (max_dist < 0 || max_dist > MAX_NEAR_DIST ||
+            table_size & (table_size - 1) || table_size < index->n_sprites * parts * 2) {
+        return -1;
+    }
+    for (i = 0; i < table_size; ++i) {
+        table[i] = -1;
+    }
+    memset(index->near_columns, 0, sizeof(index->near_columns));
+    for (n = 0; n < index->n_sprites; ++n) {
+        struct sprite *sprite = &index->sprites[n];
+        for (part = 0; part < parts && part < sprite->width; ++part) {
+            uint32_t bit = column_bit(sprite->image[part]);
+            index->near_columns[part][bit / 32] |= 1u << (bit % 32);
+        }
+        for (part = 0; part < parts && part < sprite->width; ++part) {
+            uint32_t slot = hash_part(sprite->image, sprite->width, part, parts) & (table_size - 1);
+            while (table[slot] != -1) {
+                slot = (slot + 1) & (table_size - 1);
             }
-            if (count == 13) {
-                goto next_x;
-            }
-            //*/
-
-            // extract tile
-            uint32_t screen_tile[7];
-            uint8_t color_palette[MAX_PALETTE_SIZE] = {0};
-            int n_colors = 0;
-            int sp_x, sp_y;
-            for (sp_x = 0; sp_x < kSpriteX; ++sp_x) {
-                uint32_t col = 0;
-                for (sp_y = 0; sp_y < kSpriteY; ++sp_y) {
-                    int color = SP_PIX(x + sp_x, y + sp_y);
-                    if (!color_palette[color]) {
-                        color_palette[color] = ++n_colors;
+            table[slot] = n;
+        }
+    }
+    index->near_table = table;
+    index->near_mask = table_size - 1;
+    index->max_dist = max_dist;
+    return 0;
+}
+
+static int sprite_distance(const uint32_t *needle, const struct sprite *sprite, uint32_t low) {
+    /* the number of pixels that differ */
+    int i, dist = 0;
+    for (i = 0; i < sprite->width; ++i) {
+        uint32_t diff = needle[i] ^ sprite->image[i];
+        dist += __builtin_popcount((diff | (diff >> 1)) & low);
+    }
+    return dist;
+}
+
+static struct sprite *find_near_sprite(uint32_t *needle, struct sprite_index *index, int *dist_out) {
+    /* the closest sprite within max_dist, widest first, then the first one */
+    struct sprite *best = NULL;
+    int best_dist = index->max_dist + 1;
+    int parts = index->max_dist + 1;
+    int sprite_height = index->sprite_height;
+    uint32_t low = 0x55555555u & (sprite_height >= 16 ? 0xffffffffu : (1u << (2 * sprite_height)) - 1);
+    int w, part;
+
+    for (part = 0; part < parts; ++part) {
+        uint32_t bit = column_bit(needle[part]);
+        if (index->near_columns[part][bit / 32] & (1u << (bit % 32))) {
+            break;
+        }
+    }
+    if (part == parts) {
+        *dist_out = best_dist;
+        return NULL;
+    }
+
+    for (w = 0; w < index->n_widths; ++w) {
+        int width = index->widths[w];
+        for (part = 0; part < parts && part < width; ++part) {
+            uint32_t slot = hash_part(needle, width, part, parts) & index->near_mask;
+            int32_t n;
+            while ((n = index->near_table[slot]) != -1) {
+                struct sprite *sprite = &index->sprites[n];
+                if (sprite->width == width && same_part(needle, sprite->image, width, part, parts)) {
+                    int dist = sprite_distance(needle, sprite, low);
+                    if (dist < best_dist || (dist == best_dist && best && sprite->width == best->width && sprite < best)) {
+                        best = sprite;
+                        best_dist = dist;
                     }
-                    col = (color_palette[color] - 1) | (col << 2);
                 }
-                screen_tile[sp_x] = col;
+                slot = (slot + 1) & index->near_mask;
             }
+        }
+    }
+    *dist_out = best_dist;
+    return best;
+}
+
+static struct sprite *find_sprite(uint32_t *needle, struct sprite_index *index, int *dist_out) {
+    int w;
+    uint32_t bit = column_bit(needle[0]);
 
-            if (n_colors != 3) {
-                continue;
+    *dist_out = 0;
+    if (index->first_columns[bit / 32] & (1u << (bit % 32))) {
+        for (w = 0; w < index->n_widths; ++w) {
+            int width = index->widths[w];
+            uint32_t slot = hash_sprite(needle, width) & index->mask;
+            int32_t n;
+            while ((n = index->table[slot]) != -1) {
+                struct sprite *sprite = &index->sprites[n];
+                if (sprite->width == width && !memcmp(needle, sprite->image, sizeof(*needle) * width)) {
+                    return sprite;
+                }
+                slot = (slot + 1) & index->mask;
             }
+        }
+    }
+    if (index->max_dist > 0) {
+        return find_near_sprite(needle, index, dist_out);
+    }
+    return NULL;
+}
 
-            considered++;
+/*
+The sprite_height rows of the image from row y down, as packed columns like
+sprite images (2 bits per pixel, top row in the high bits), so a candidate
+tile is a few word operations instead of reading each pixel. Moving down a
+row only shifts one new pixel into each column.
+*/
+struct window {
+    int y;  /* top row, -1 before the first */
+    uint32_t cols[MAX_WIDTH];
+    uint8_t colors[MAX_WIDTH];  /* bit c is set if color c is in the column */
+    uint8_t run[MAX_WIDTH];  /* pixels on row y - 1 from x on equal to the one at x, up to kSpriteX */
+};
 
-            if (0 && y == 137) {
-                for (off = 0; off < sizeof(screen_tile); ++off) printf("%c", "01234"[screen_tile[off]]);
-                printf("\n");
+/* the low bit of each pixel of col that's color, given the low bits of
+   every pixel */
+static inline uint32_t pixels_of_color(uint32_t col, uint32_t low, int color) {
+    uint32_t diff = col ^ (low * color);
+    return ~(diff | (diff >> 1)) & low;
+}
+
+static void slide_window(uint8_t *image, struct sprite_index *index, struct window *win, int y) {
+    int x, row;
+    int width = index->width;
+    int height = index->height;
+    int sprite_height = index->sprite_height;
+    uint32_t mask = sprite_height >= 16 ? 0xffffffffu : (1u << (2 * sprite_height)) - 1;
+    uint32_t low = 0x55555555u & mask;
+
+    if (win->y == y - 1) {
+        for (x = 0; x < width; ++x) {
+            win->cols[x] = ((win->cols[x] << 2) | (SP_PIX(x, y + sprite_height - 1) & 3)) & mask;
+        }
+    } else {
+        for (x = 0; x < width; ++x) {
+            uint32_t col = 0;
+            for (row = 0; row < sprite_height; ++row) {
+                col = (col << 2) | (SP_PIX(x, y + row) & 3);
             }
+            win->cols[x] = col;
+        }
+    }
+    win->y = y;
 
-            struct sprite *sprite = find_sprite(screen_tile, sprites, n_sprites);
-            if (sprite) {
-                matched[match_count].x = x;
-                matched[match_count].y = y;
-                matched[match_count].sp = sprite;
-                matched[match_count].space = 0;
+    for (x = 0; x < width; ++x) {
+        win->colors[x] = (pixels_of_color(win->cols[x], low, 0) != 0) |
+                         (pixels_of_color(win->cols[x], low, 1) != 0) << 1 |
+                         (pixels_of_color(win->cols[x], low, 2) != 0) << 2 |
+                         (pixels_of_color(win->cols[x], low, 3) != 0) << 3;
+    }
 
-                if (!found) {
-                    found = 1;
-                }
+    for (x = width - 1; x >= 0; --x) {
+        if (x + 1 < width && SP_PIX(x, y - 1) == SP_PIX(x + 1, y - 1)) {
+            win->run[x] = win->run[x + 1] < kSpriteX ? win->run[x + 1] + 1 : kSpriteX;
+        } else {
+            win->run[x] = 1;
+        }
+    }
+}
+
+static int scan_row(uint8_t *image, int y, struct sprite_index *index, struct window *win,
+                    struct sprite_match *matched, int max_matches) {
+    /*
+    Find the sprites whose top-left corner is on row y, and return how
+    many were stored in matched. Pixels must be colors 0-3.
+    */
+    int x;
+    int match_count = 0;
+    int lastX = -1;
+    int sprite_height = index->sprite_height;
+    uint32_t mask = sprite_height >= 16 ? 0xffffffffu : (1u << (2 * sprite_height)) - 1;
+    uint32_t low = 0x55555555u & mask;  /* the low bit of each pixel */
+
+    slide_window(image, index, win, y);
+
+    for (x = 0; x < index->width - kSpriteX; ++x) {
+        // skip if it's not solid above, past the first pixel that differs
+        if (win->run[x] < kSpriteX) {
+            x += win->run[x];
+            continue;
+        }
+
+        // skip if it's a solid line on the left
+        uint32_t left = win->cols[x];
+        if (left == (left >> (2 * sprite_height - 2)) * low) {
+            continue;
+        }
+
+        // skip if it has the wrong number of colors
+        int sp_x, color, other;
+        int colors = 0;
+        for (sp_x = 0; sp_x < kSpriteX; ++sp_x) {
+            colors |= win->colors[x + sp_x];
+        }
+        if (__builtin_popcount(colors) != index->n_colors) {
+            continue;
+        }
 
-                if (lastX != -1 && x > lastX + 3) {
-                    matched[match_count].space = 1;
+        // extract tile: number the colors in the order they first appear,
+        // going down each column, then across
+        uint32_t screen_tile[7];
+        uint32_t is_color[7][4];
+        int first[4];
+        for (color = 0; color < 4; ++color) {
+            first[color] = -1;
+        }
+        for (sp_x = 0; sp_x < kSpriteX; ++sp_x) {
+            for (color = 0; color < 4; ++color) {
+                uint32_t is = pixels_of_color(win->cols[x + sp_x], low, color);
+                is_color[sp_x][color] = is;
+                if (is && first[color] < 0) {
+                    first[color] = sp_x * 32 + __builtin_clz(is);
                 }
+            }
+        }
 
-                if (++match_count >= max_matches) {
-                    return match_count;
+        int number[4];
+        for (color = 0; color < 4; ++color) {
+            number[color] = 0;
+            for (other = 0; other < 4; ++other) {
+                if (first[other] >= 0 && first[other] < first[color]) {
+                    number[color]++;
                 }
+            }
+        }
+        for (sp_x = 0; sp_x < kSpriteX; ++sp_x) {
+            screen_tile[sp_x] = is_color[sp_x][0] * number[0] + is_color[sp_x][1] * number[1] +
+                                is_color[sp_x][2] * number[2] + is_color[sp_x][3] * number[3];
+        }
+
+        int distance;
+        struct sprite *sprite = find_sprite(screen_tile, index, &distance);
+        if (sprite) {
+            matched[match_count].x = x;
+            matched[match_count].y = y;
+            matched[match_count].sp = sprite;
+            matched[match_count].space = 0;
+            matched[match_count].distance = distance;
+            matched[match_count].confidence = 1 - (float)distance / (sprite->width * sprite_height);
+
+            if (lastX != -1 && x > lastX + 3) {
+                matched[match_count].space = 1;
+            }
+
+            if (++match_count >= max_matches) {
+                return match_count;
+            }
+
+            x += sprite->width - 1;
+            lastX = x;
+        }
+    }
+
+    return match_count;
+}
+
+/*
+Scanning in parallel: the screen is split into horizontal bands, and a
+thread for each one walks its rows the way identify_sprites does (skipping
+the rows under a found sprite), starting from the top of the band and
+keeping what every row it scanned found. Rows are independent, but where
+the skipping puts the rows in a band depends on the bands above it, so
+the walk is then redone on the calling thread, taking each row from the
+bands, and only scanning rows no band has, which is at most
+sprite_height - 1 rows per band.
+*/
+#define MAX_THREADS 16
+#define BAND_MATCHES 128
+
+struct band {
+    uint8_t *image;
+    struct sprite_index *index;
+    int begin, end;  /* rows to walk */
+    const uint8_t *rescan;  /* which rows have to be scanned, NULL for all */
+    const int *prev_found;  /* matches on each row last time, for the others */
+    int row_first[MAX_HEIGHT];  /* where each row's matches are, -1 if not scanned */
+    int row_count[MAX_HEIGHT];
+    int match_count;
+    struct sprite_match matched[BAND_MATCHES];
+};
+
+static void *walk_band(void *arg) {
+    struct band *band = arg;
+    struct sprite_index *index = band->index;
+    struct window win;
+    int y;
+
+    win.y = -1;
+    band->match_count = 0;
+    for (y = band->begin; y < band->end; ++y) {
+        band->row_first[y] = -1;
+    }
+    for (y = band->begin; y < band->end; ++y) {
+        int found;
+        if (y % index->row_step) {
+            continue;
+        }
+        if (band->rescan && !band->rescan[y]) {
+            found = band->prev_found[y];
+        } else {
+            found = scan_row(band->image, y, index, &win, band->matched + band->match_count,
+                             BAND_MATCHES - band->match_count);
+            if (band->match_count + found >= BAND_MATCHES) {
+                break;  /* the row may be cut short; leave it to the caller */
+            }
+            band->row_first[y] = band->match_count;
+            band->row_count[y] = found;
+            band->match_count += found;
+        }
+        if (found) {
+            y += index->sprite_height - 1;
+        }
+    }
+    return NULL;
+}
+
+struct bands {
+    int n;
+    struct band *band[MAX_THREADS];
+};
+
+static void walk_bands(struct bands *bands, struct band *storage, int threads, uint8_t *image,
+                       struct sprite_index *index, const uint8_t *rescan, const int *prev_found) {
+    pthread_t thread[MAX_THREADS];
+    int started[MAX_THREADS] = {0};
+    int first = 1, last = index->height - index->sprite_height;
+    int n;
+
+    if (threads > MAX_THREADS) {
+        threads = MAX_THREADS;
+    }
+    if (threads > last - first) {
+        threads = last - first;
+    }
+    bands->n = threads;
+    for (n = 0; n < threads; ++n) {
+        struct band *band = &storage[n];
+        band->image = image;
+        band->index = index;
+        band->begin = first + (last - first) * n / threads;
+        band->end = first + (last - first) * (n + 1) / threads;
+        band->rescan = rescan;
+        band->prev_found = prev_found;
+        bands->band[n] = band;
+    }
+    /* this thread takes the first band; if a thread can't be started,
+       its band is left for the final walk */
+    for (n = 1; n < threads; ++n) {
+        started[n] = !pthread_create(&thread[n], NULL, walk_band, storage + n);
+        if (!started[n]) {
+            storage[n].end = storage[n].begin;
+        }
+    }
+    walk_band(storage);
+    for (n = 1; n < threads; ++n) {
+        if (started[n]) {
+            pthread_join(thread[n], NULL);
+        }
+    }
+}
+
+static int fetch_row(struct bands *bands, uint8_t *image, int y, struct sprite_index *index, struct window *win,
+                     struct sprite_match *matched, int max_matches) {
+    /* like scan_row, but taking the row from a band if one scanned it */
+    int n;
+    for (n = 0; bands && n < bands->n; ++n) {
+        struct band *band = bands->band[n];
+        if (y >= band->begin && y < band->end && band->row_first[y] >= 0) {
+            int count = band->row_count[y];
+            if (count > max_matches) {
+                count = max_matches;
+            }
+            memcpy(matched, band->matched + band->row_first[y], sizeof(*matched) * count);
+            return count;
+        }
+    }
+    return scan_row(image, y, index, win, matched, max_matches);
+}
+
+int identify_sprites(uint8_t *image, struct sprite_index *index, struct sprite_match *matched, int max_matches) {
+    return identify_sprites_threads(image, index, matched, max_matches, 1);
+}
+
+int identify_sprites_threads(uint8_t *image, struct sprite_index *index, struct sprite_match *matched, int max_matches,
+                             int threads) {
+    /*
+    Identify sprites using palette pattern matching, scanning bands of the
+    screen on up to `threads` threads.
+    */
+    int y;
+    int match_count = 0;
+    struct window win;
+    struct bands bands;
+    struct band storage[threads > 1 ? (threads < MAX_THREADS ? threads : MAX_THREADS) : 1];
+
+    if (threads > 1) {
+        walk_bands(&bands, storage, threads, image, index, NULL, NULL);
+    }
+
+    win.y = -1;
+    for (y = 1; y < index->height - index->sprite_height; ++y) {
+        if (y % index->row_step) {
+            continue;
+        }
+        int found = fetch_row(threads > 1 ? &bands : NULL, image, y, index, &win,
+                              matched + match_count, max_matches - match_count);
+        match_count += found;
+        if (match_count >= max_matches) {
+            return match_count;
+        }
+        if (found) {
+            y += index->sprite_height - 1;
+        }
+    }
+
+    return match_count;
+}
+
+int identify_sprites_dirty(uint8_t *image, uint8_t *prev_image, struct sprite_index *index, uint8_t *visited,
+                           struct sprite_match *prev, int prev_count, struct sprite_match *matched, int max_matches) {
+    return identify_sprites_dirty_threads(image, prev_image, index, visited, prev, prev_count,
+                                          matched, max_matches, 1);
+}
+
+int identify_sprites_dirty_threads(uint8_t *image, uint8_t *prev_image, struct sprite_index *index, uint8_t *visited,
+                                   struct sprite_match *prev, int prev_count, struct sprite_match *matched, int max_matches,
+                                   int threads) {
+    /*
+    Same results as identify_sprites, but only rescans rows whose
+    sprite_height-row window changed since prev_image, copying the earlier results (prev) for
+    the rest.
+
+    visited[y] says whether row y was scanned for prev, and is updated
+    for the next call. With prev_image NULL, everything is rescanned.
+    */
+    int x, y, n;
+    int height = index->height;
+    int sprite_height = index->sprite_height;
+    int dirty_before[MAX_HEIGHT + 1] = {0};  /* number of changed rows above row y */
+    int match_count = 0;
+    int prev_ind = 0;
+    struct window win;
+    struct bands bands;
+    struct band storage[threads > 1 ? (threads < MAX_THREADS ? threads : MAX_THREADS) : 1];
+
+    win.y = -1;
+    for (y = 0; y < height; ++y) {
+        int dirty = !prev_image;
+        for (x = 0; x < index->width && !dirty; ++x) {
+            dirty = SP_PIX(x, y) != prev_image[y + x * height];
+        }
+        dirty_before[y + 1] = dirty_before[y] + dirty;
+    }
+
+    if (threads > 1) {
+        /* the rows the walk below would scan, and how many matches it
+           would copy for the others */
+        uint8_t rescan[MAX_HEIGHT] = {0};
+        int prev_found[MAX_HEIGHT] = {0};
+        for (y = 1; y < height - sprite_height; ++y) {
+            rescan[y] = dirty_before[y + sprite_height] != dirty_before[y - 1] || !visited[y];
+        }
+        for (n = 0; n < prev_count; ++n) {
+            prev_found[prev[n].y]++;
+        }
+        walk_bands(&bands, storage, threads, image, index, rescan, prev_found);
+    }
 
-                x += sprite->width - 1;
-                lastX = x;
+    for (y = 1; y < height - sprite_height; ++y) {
+        int found;
+        int clean = dirty_before[y + sprite_height] == dirty_before[y - 1];
+
+        if (y % index->row_step) {
+            continue;
+        }
+
+        while (prev_ind < prev_count && prev[prev_ind].y < y) {
+            prev_ind++;
+        }
+
+        if (clean && visited[y]) {
+            found = 0;
+            while (prev_ind < prev_count && prev[prev_ind].y == y && match_count + found < max_matches) {
+                matched[match_count + found] = prev[prev_ind++];
+                found++;
             }
-            next_x:;
+        } else {
+            found = fetch_row(threads > 1 ? &bands : NULL, image, y, index, &win,
+                              matched + match_count, max_matches - match_count);
+        }
+
+        match_count += found;
+        if (match_count >= max_matches) {
+            /* the row may be incomplete, so don't trust it next time */
+            memset(visited + y, 0, height - y);
+            return match_count;
         }
+        visited[y] = 1;
         if (found) {
-            y += 13;
+            for (n = 1; n < sprite_height; ++n) {
+                visited[y + n] = 0;
+            }
+            y += sprite_height - 1;
         }
     }
 
@@ -186,10 +866,10 @@ int merge_sprites(struct sprite_match *a, int a_count, struct sprite_match *b, i
             ind_b++;
         }
     }
-    while (b[ind_b].sp && ind_dest < dest_count && ind_b < b_count) {
+    while (ind_b < b_count && b[ind_b].sp && ind_dest < dest_count) {
         dest[ind_dest++] = b[ind_b++];
     }
-    while (a[ind_a].sp && ind_dest < dest_count && ind_a < a_count) {
+    while (ind_a < a_count && a[ind_a].sp && ind_dest < dest_count) {
         dest[ind_dest++] = a[ind_a++];
     }
 
@@ -209,3 +889,163 @@ int merge_sprites(struct sprite_match *a, int a_count, struct sprite_match *b, i
     *overlap_out = overlap;
     return ind_dest;
 }
+
+int is_subsequence(const char *a, int a_len, const char *b, int b_len) {
+    /*
+    Whether the characters of a, ignoring spaces, appear in b in the same
+    order.
+    */
+    int i, j = 0;
+    for (i = 0; i < a_len; ++i) {
+        if (a[i] == ' ') {
+            continue;
+        }
+        while (j < b_len && b[j] != a[i]) {
+            ++j;
+        }
+        if (j == b_len) {
+            return 0;
+        }
+        ++j;
+    }
+    return 1;
+}
+
+int dist_merge(const char *s1, int len1, const char *s2, int len2, char *out, int *out_len) {
+    /*
+    See dialog.dist_merge: returns the distance, and writes the merged
+    string (at most max(len1, len2) bytes) to out and its length to out_len.
+    */
+    int i, dist = 0;
+    int len = len1 > len2 ? len1 : len2;
+
+    if (is_subsequence(s1, len1, s2, len2)) {
+        memcpy(out, s2, len2);
+        *out_len = len2;
+        return 0;
+    }
+
+    for (i = 0; i < len; ++i) {
+        char a = i < len1 ? s1[i] : ' ';
+        char b = i < len2 ? s2[i] : ' ';
+        if (a != ' ' && a != b) {
+            dist++;
+        }
+        out[i] = b != ' ' ? b : a;
+    }
+    *out_len = len;
+    return dist;
+}
+
+static int emit_fragment(char *out, int skip, const char *text, int len) {
+    int n;
+    if (len == 0) {
+        return 0;
+    }
+    n = sprintf(out, "%d\t", skip);
+    memcpy(out + n, text, len);
+    out[n + len] = '\t';
+    return n + len + 1;
+}
+
+int string_delta(const char *text, int len, const char *last, int last_len, int minmatch, char *out) {
+    /*
+    The delta from last to text, see delta.StringDeltaCompressor. out
+    needs room for len + 12 * (len / (minmatch + 1) + 2) bytes.
+    Returns the length of the delta.
+    */
+    int n;
+    int in_match = 1;
+    int mismatch_begin = 0, match_begin = 0, offset = 0;
+    int out_len = 0;
+
+    for (n = 0; n < len; ++n) {
+        int same = n < last_len && text[n] == last[n];
+        if (in_match) {
+            if (!same) {
+                in_match = 0;
+                if (n - match_begin >= minmatch) {
+                    out_len += emit_fragment(out + out_len, mismatch_begin - offset,
+                                             text + mismatch_begin, match_begin - mismatch_begin);
+                    offset = match_begin;
+                    mismatch_begin = n;
+                }
+            }
+        } else if (same) {
+            in_match = 1;
+            match_begin = n;
+        }
+    }
+
+    if (!in_match) {
+        out_len += emit_fragment(out + out_len, mismatch_begin - offset,
+                                 text + mismatch_begin, len - mismatch_begin);
+    } else if (mismatch_begin < match_begin) {
+        out_len += emit_fragment(out + out_len, mismatch_begin - offset,
+                                 text + mismatch_begin, match_begin - mismatch_begin);
+    }
+
+    if (out_len) {
+        out_len--;  /* the trailing tab */
+    }
+    return out_len;
+}
+
+static int parse_delta(char *buf, int len, const char *delta, int delta_len) {
+    /*
+    Apply delta to the len bytes at buf, or just work out the length of
+    the result if buf is NULL. Returns -1 if the delta is malformed.
+    Fragments past the end are put at the end, like Python slicing.
+    */
+    int i = 0, pos = 0;
+    while (i < delta_len) {
+        int skip = 0, start, at;
+        if (delta[i] == '\t') {
+            return -1;
+        }
+        for (; i < delta_len && delta[i] != '\t'; ++i) {
+            if (delta[i] < '0' || delta[i] > '9') {
+                return -1;
+            }
+            if (skip < (1 << 24)) {  /* anything bigger is past the end anyway */
+                skip = skip * 10 + delta[i] - '0';
+            }
+        }
+        if (i == delta_len) {
+            return -1;
+        }
+        start = ++i;
+        while (i < delta_len && delta[i] != '\t') {
+            ++i;
+        }
+        pos += skip;
+        if (pos > (1 << 28)) {
+            pos = 1 << 28;
+        }
+        at = pos < len ? pos : len;
+        if (buf) {
+            memcpy(buf + at, delta + start, i - start);
+        }
+        if (at + i - start > len) {
+            len = at + i - start;
+        }
+        pos += i - start;
+        if (i < delta_len) {
+            ++i;  /* the tab before the next skip */
+        }
+    }
+    return len;
+}
+
+int apply_string_delta(char *buf, int len, int size, const char *delta, int delta_len) {
+    /*
+    Apply a delta.StringDeltaCompressor delta to the len bytes at buf, in
+    place. Returns the new length, or -1 if the delta is malformed or the
+    result won't fit in size bytes, leaving buf as it was.
+    */
+    int new_len = parse_delta(NULL, len, delta, delta_len);
+    if (new_len < 0 || new_len > size) {
+        return -1;
+    }
+    return parse_delta(buf, len, delta, delta_len);
+}
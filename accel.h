@@ -1,5 +1,9 @@
 void pack2bpp(uint8_t *in, uint8_t *out);
 
+void unpack2bpp(uint8_t *in, uint8_t *out, int count);
+
+int sample_changed(uint8_t *raw, int raw_stride, int width, int height, int step, uint8_t *last, int tolerance);
+
 struct sprite {
     uint32_t image[7];
     int id;
@@ -7,11 +11,31 @@ struct sprite {
     int width;
 };
 
+struct sprite_index {
+	struct sprite *sprites;
+	int n_sprites;
+	int n_widths;
+	int widths[8];  /* distinct sprite widths, widest first */
+	int mask;  /* table size - 1 */
+	int32_t *table;  /* sprite numbers, -1 for empty slots */
+	int width, height;  /* screen size; images are column-major */
+	int sprite_height;  /* rows in a sprite, at most 16 */
+	int n_colors;  /* colors in a sprite */
+	int row_step;  /* only look for sprites on rows that are multiples of this */
+	uint32_t first_columns[64];  /* bit filter of the sprites' first columns, see filter_sprites */
+	int32_t *near_table;  /* sprite numbers by parts of their columns, see build_near_index */
+	uint32_t near_columns[3][64];  /* bit filters of the sprites' columns 0, 1 and 2 */
+	int near_mask;
+	int max_dist;  /* pixels a sprite match can be off by, 0 for exact matches only */
+};
+
 struct sprite_match {
 	int x;
 	int y;
 	struct sprite *sp;
 	int space;
+	int distance;  /* pixels that differ from sp */
+	float confidence;  /* 1 for exact matches, less the more pixels differ */
 };
 
 struct sprite_matches {
@@ -21,6 +45,35 @@ struct sprite_matches {
 
 void translate_bytes(uint8_t *image, int len, uint8_t *table);
 
-int identify_sprites(uint8_t *image, struct sprite *sprites, int n_sprites, struct sprite_match *matched, int max_matches);
+void translate_screen(uint8_t *screen, int width, int height, uint8_t *table, uint8_t *image);
+
+void extract_screen(uint8_t *raw, int raw_stride, int scale, int width, int height,
+                    uint8_t *screen, uint8_t *table, uint8_t *image);
+
+int build_sprite_index(struct sprite *sprites, int n_sprites, struct sprite_index *index, int32_t *table, int table_size);
+
+void filter_sprites(struct sprite_index *index);
+
+int build_near_index(struct sprite_index *index, int32_t *table, int table_size, int max_dist);
+
+int identify_sprites(uint8_t *image, struct sprite_index *index, struct sprite_match *matched, int max_matches);
+
+int identify_sprites_threads(uint8_t *image, struct sprite_index *index, struct sprite_match *matched, int max_matches,
+                             int threads);
+
+int identify_sprites_dirty(uint8_t *image, uint8_t *prev_image, struct sprite_index *index, uint8_t *visited,
+                           struct sprite_match *prev, int prev_count, struct sprite_match *matched, int max_matches);
+
+int identify_sprites_dirty_threads(uint8_t *image, uint8_t *prev_image, struct sprite_index *index, uint8_t *visited,
+                                   struct sprite_match *prev, int prev_count, struct sprite_match *matched, int max_matches,
+                                   int threads);
 
 int merge_sprites(struct sprite_match *a, int a_count, struct sprite_match *b, int b_count, struct sprite_match *dest, int dest_count, int *overlap_out);
+
+int is_subsequence(const char *a, int a_len, const char *b, int b_len);
+
+int dist_merge(const char *s1, int len1, const char *s2, int len2, char *out, int *out_len);
+
+int string_delta(const char *text, int len, const char *last, int last_len, int minmatch, char *out);
+
+int apply_string_delta(char *buf, int len, int size, const char *delta, int delta_len);
@@ -0,0 +1,423 @@
+'''
+Compact screen archives, stored as 8x8 tile deltas.
+
+Consecutive frames are nearly identical at the tile level, so instead of a
+full 2bpp frame per record (like ScreenCompressor), each record holds only
+the tiles that changed. Records are grouped into blocks that start with a
+keyframe and are compressed on their own, and a sidecar index maps the
+first timestamp of each block to its byte offset, so any game time can be
+reached by decompressing a single block.
+
+File layout (little-endian):
+    header: 'PKTD' version:B width:H height:H
+    block:  length:L zlib(records)
+    record: 'K' timestamp_s:L frame_n:L tiles*16 bytes (keyframe)
+            'D' timestamp_s:L frame_n:L count:H count*(tile:H 16 bytes)
+Index (fname + '.idx'): timestamp_s:L frame_n:L offset:Q per block.
+
+ScreenArchiveReader reads the older full-frame format written by
+video.ScreenCompressor.
+'''
+
+import bisect
+import gzip
+import os
+import struct
+import time
+import zlib
+
+import numpy
+
+from video import C, ffi
+
+MAGIC = 'PKTD'
+VERSION = 1
+HEADER = struct.Struct('<4sBHH')
+BLOCK = struct.Struct('<L')
+RECORD = struct.Struct('<cLL')
+COUNT = struct.Struct('<H')
+INDEX = struct.Struct('<LLQ')
+TILE_BYTES = 16
+
+
+def pack_tiles(trunc):
+    '''
+    Pack a HxW screen of values in [0, 3] into (H/8 * W/8, 16) bytes:
+    8x8 tiles in row order, each 2bpp like pack2bpp.
+    '''
+    height, width = trunc.shape
+    tiles = trunc.reshape(height / 8, 8, width / 8, 8).swapaxes(1, 2)
+    px = tiles.reshape(-1, 8, 2, 4).astype(numpy.uint8)
+    packed = px[..., 0] | (px[..., 1] << 2) | (px[..., 2] << 4) | (px[..., 3] << 6)
+    return packed.reshape(-1, TILE_BYTES)
+
+
+def unpack_tiles(packed, width, height):
+    ''' inverse of pack_tiles '''
+    px = (packed.reshape(-1, 8, 2, 1) >> numpy.array([0, 2, 4, 6], numpy.uint8)) & 3
+    tiles = px.reshape(height / 8, width / 8, 8, 8)
+    return tiles.swapaxes(1, 2).reshape(height, width)
+
+
+class TileDeltaCompressor(object):
+    '''
+    Handler that archives data['screen'] (quantized to 2bpp) as tile deltas.
+
+    A new block (and keyframe) is started every `keyframe_interval`
+    seconds of game time or `max_block` records, or when most of the
+    screen changed at once.
+
+    An existing archive is appended to, as long as it holds screens of the
+    same size: a different size raises ValueError.
+    '''
+
+    def __init__(self, fname, keyframe_interval=60, max_block=600, level=6):
+        self.fname = fname = time.strftime(fname)
+        self.header = None
+        if os.path.exists(fname) and os.path.getsize(fname):
+            with open(fname, 'rb') as fd:
+                head = fd.read(HEADER.size)
+            if len(head) < HEADER.size or HEADER.unpack(head)[:2] != (MAGIC, VERSION):
+                raise ValueError('%s is not a tile delta archive' % fname)
+            self.header = HEADER.unpack(head)
+        self.fd = open(fname, 'ab')
+        self.index_fd = open(fname + '.idx', 'ab')
+        self.keyframe_interval = keyframe_interval
+        self.max_block = max_block
+        self.level = level
+        self.last = None
+        self.records = []  # the pieces of the block's records
+        self.count = 0
+        self.block_start = None
+
+    def handle(self, data):
+        tiles = pack_tiles(data['screen'] >> 6)
+        timestamp_s = data.get('timestamp_s', 0)
+        frame_n = data['frame_n']
+
+        height, width = data['screen'].shape
+        if self.header is None:
+            self.header = (MAGIC, VERSION, width, height)
+            self.fd.write(HEADER.pack(*self.header))
+        elif self.header[2:] != (width, height):
+            raise ValueError('%s holds %dx%d screens, not %dx%d' % (
+                self.fname, self.header[2], self.header[3], width, height))
+
+        if self.last is not None and self.last.shape == tiles.shape:
+            changed = numpy.flatnonzero((tiles != self.last).any(axis=1))
+            if len(changed) == 0:
+                return
+        else:
+            changed = None
+
+        if (changed is None or len(changed) > len(tiles) / 2 or
+                self.count >= self.max_block or
+                timestamp_s - self.block_start[0] >= self.keyframe_interval):
+            self.flush()
+            self.block_start = (timestamp_s, frame_n)
+            self.records.append(RECORD.pack('K', timestamp_s, frame_n))
+            self.records.append(tiles.tostring())
+        else:
+            self.records.append(RECORD.pack('D', timestamp_s, frame_n))
+            self.records.append(COUNT.pack(len(changed)))
+            entries = numpy.empty(len(changed), [('tile', '<u2'), ('data', 'u1', TILE_BYTES)])
+            entries['tile'] = changed
+            entries['data'] = tiles[changed]
+            self.records.append(entries.tostring())
+        self.count += 1
+        self.last = tiles
+
+    def flush(self):
+        ''' write out the current block, if any '''
+        if not self.records:
+            return
+        offset = self.fd.tell()
+        block = zlib.compress(''.join(self.records), self.level)
+        self.fd.write(BLOCK.pack(len(block)))
+        self.fd.write(block)
+        self.fd.flush()
+        self.index_fd.write(INDEX.pack(self.block_start[0], self.block_start[1], offset))
+        self.index_fd.flush()
+        self.records = []
+        self.count = 0
+        self.last = None  # the next block needs a keyframe
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+        self.index_fd.close()
+
+
+class TileDeltaReader(object):
+    '''
+    Read a TileDeltaCompressor archive, yielding
+    (timestamp_s, frame_n, screen) tuples, where screen is an HxW array of
+    values in [0, 3].
+    '''
+
+    def __init__(self, fname):
+        self.fd = open(fname, 'rb')
+        magic, version, self.width, self.height = HEADER.unpack(self.fd.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a tile delta archive' % fname)
+        self.n_tiles = (self.width / 8) * (self.height / 8)
+        self.index = None
+        if os.path.exists(fname + '.idx'):
+            with open(fname + '.idx', 'rb') as fd:
+                raw = fd.read()
+            self.index = [INDEX.unpack_from(raw, off)
+                          for off in xrange(0, len(raw) - INDEX.size + 1, INDEX.size)]
+        if not self.index:
+            self.index = self.build_index()
+        self.index_times = [entry[0] for entry in self.index]
+
+    def build_index(self):
+        ''' recreate the index by walking the block headers '''
+        index = []
+        offset = HEADER.size
+        while True:
+            self.fd.seek(offset)
+            head = self.fd.read(BLOCK.size)
+            if len(head) < BLOCK.size:
+                return index
+            length, = BLOCK.unpack(head)
+            raw = self.fd.read(length)
+            if len(raw) < length:
+                return index  # cut off mid-write
+            _, timestamp_s, frame_n = RECORD.unpack(
+                zlib.decompressobj().decompress(raw, RECORD.size))
+            index.append((timestamp_s, frame_n, offset))
+            offset += BLOCK.size + length
+
+    def read_block(self, offset):
+        self.fd.seek(offset)
+        length, = BLOCK.unpack(self.fd.read(BLOCK.size))
+        return zlib.decompress(self.fd.read(length))
+
+    def decode_block(self, block):
+        tiles = numpy.zeros((self.n_tiles, TILE_BYTES), numpy.uint8)
+        entry = numpy.dtype([('tile', '<u2'), ('data', 'u1', TILE_BYTES)])
+        pos = 0
+        while pos < len(block):
+            kind, timestamp_s, frame_n = RECORD.unpack_from(block, pos)
+            pos += RECORD.size
+            if kind == 'K':
+                size = self.n_tiles * TILE_BYTES
+                tiles[:] = numpy.frombuffer(block, numpy.uint8, size, pos).reshape(-1, TILE_BYTES)
+            else:
+                count, = COUNT.unpack_from(block, pos)
+                pos += COUNT.size
+                size = count * entry.itemsize
+                entries = numpy.frombuffer(block, entry, count, pos)
+                tiles[entries['tile']] = entries['data']
+            pos += size
+            yield timestamp_s, frame_n, unpack_tiles(tiles, self.width, self.height)
+
+    def frames(self, start_s=None, end_s=None):
+        '''
+        Iterate over the frames with start_s <= timestamp_s < end_s, only
+        decoding from the last keyframe before start_s.
+        '''
+        first = 0
+        if start_s is not None:
+            # blocks can start on the same second, so take the first of them
+            first = max(0, bisect.bisect_left(self.index_times, start_s) - 1)
+        for timestamp_s, frame_n, offset in self.index[first:]:
+            if end_s is not None and timestamp_s >= end_s:
+                return
+            for frame in self.decode_block(self.read_block(offset)):
+                if start_s is not None and frame[0] < start_s:
+                    continue
+                if end_s is not None and frame[0] >= end_s:
+                    return
+                yield frame
+
+    def __iter__(self):
+        return self.frames()
+
+    def at(self, timestamp_s):
+        ''' return the frame on screen at game time timestamp_s, or None '''
+        first = max(0, bisect.bisect_left(self.index_times, timestamp_s) - 1)
+        last = None
+        for start_s, frame_n, offset in self.index[first:]:
+            if start_s > timestamp_s:
+                break
+            for frame in self.decode_block(self.read_block(offset)):
+                if frame[0] > timestamp_s:
+                    return last
+                last = frame
+        return last
+
+
+class ScreenArchiveReader(object):
+    '''
+    Read a video.ScreenCompressor archive (frames.raw.gz, or the same thing
+    gunzipped), yielding (timestamp_s, frame_n, screen) tuples, where screen
+    is a 144x160 array of values in [0, 3].
+
+    Records are decoded `batch` at a time. Uncompressed archives are
+    memory-mapped, so reading a slice of them only touches the pages it
+    needs; gzipped ones have to be inflated up to the slice, but nothing
+    before it is decoded.
+
+    Only the low 8 bits of frame_n are stored, so frame_n counts up from
+    the first record read, assuming fewer than 256 frames between records.
+    The screen arrays are reused for the next batch, so copy them to keep
+    them.
+    '''
+
+    MAGIC = '+f\xc9q'
+    WIDTH = 160
+    HEIGHT = 144
+    RECORD = numpy.dtype([('magic', 'S4'), ('timestamp_s', '<u4'), ('frame_n', 'u1'),
+                          ('data', 'u1', WIDTH * HEIGHT / 4)])
+
+    def __init__(self, fname, batch=256):
+        self.fname = fname
+        self.batch = batch
+        self.records = None
+        if not fname.endswith('.gz'):
+            self.records = numpy.memmap(fname, self.RECORD, 'r')
+
+    def __len__(self):
+        if self.records is None:
+            raise TypeError('length of a gzipped archive is unknown')
+        return len(self.records)
+
+    def read_batches(self, start, stop):
+        ''' yield arrays of up to `batch` records in [start, stop) '''
+        if self.records is not None:
+            stop = len(self.records) if stop is None else min(stop, len(self.records))
+            for pos in xrange(start, stop, self.batch):
+                yield self.records[pos:min(pos + self.batch, stop)]
+            return
+
+        fd = gzip.GzipFile(self.fname, 'rb')
+        try:
+            fd.seek(start * self.RECORD.itemsize)  # inflates, but doesn't decode
+            pos = start
+            while stop is None or pos < stop:
+                count = self.batch if stop is None else min(self.batch, stop - pos)
+                raw = fd.read(count * self.RECORD.itemsize)
+                count = len(raw) / self.RECORD.itemsize
+                if not count:
+                    return
+                yield numpy.frombuffer(raw, self.RECORD, count)
+                pos += count
+        finally:
+            fd.close()
+
+    def frames(self, start=0, stop=None):
+        ''' iterate over records [start, stop) '''
+        out = numpy.empty((self.batch, self.HEIGHT, self.WIDTH), numpy.uint8)
+        frame_n = None
+        for records in self.read_batches(start, stop):
+            if (records['magic'] != self.MAGIC).any():
+                raise ValueError('%s: bad record magic' % self.fname)
+            count = len(records)
+            # memmapped records aren't contiguous per field, so copy them out
+            data = numpy.ascontiguousarray(records['data'])
+            C.unpack2bpp(ffi.cast('uint8_t *', data.ctypes.data),
+                         ffi.cast('uint8_t *', out.ctypes.data), count)
+
+            low = records['frame_n'].astype(numpy.int64)
+            steps = numpy.diff(low) % 256
+            steps[steps == 0] = 256
+            if frame_n is None:
+                frame_n = low[0]
+            else:
+                frame_n += (low[0] - frame_n) % 256 or 256
+            numbers = frame_n + numpy.concatenate(([0], numpy.cumsum(steps)))
+            frame_n = numbers[-1]
+
+            for n in xrange(count):
+                yield int(records['timestamp_s'][n]), int(numbers[n]), out[n]
+
+    def __iter__(self):
+        return self.frames()
+
+
+def test_tile_deltas():
+    ''' round trip screens through an archive split into blocks that start
+    on the same second, then append to it '''
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = tmp + '/test.pktd'
+        rnd = numpy.random.RandomState(1)
+        screens = [rnd.randint(0, 256, (144, 160)).astype(numpy.uint8)]
+        for _ in xrange(7):
+            screens.append(screens[-1].copy())
+            screens[-1][:16, :16] += 64  # a few tiles change
+        times = [5, 6, 6, 6, 6, 6, 7, 8]
+        archive = TileDeltaCompressor(fname, max_block=2)
+        for n, (timestamp_s, screen) in enumerate(zip(times, screens)):
+            archive.handle({'screen': screen, 'timestamp_s': timestamp_s, 'frame_n': n})
+        archive.close()
+
+        reader = TileDeltaReader(fname)
+        assert reader.index_times == [5, 6, 6, 7]
+        frames = list(reader.frames(6, 7))
+        assert [frame_n for _, frame_n, _ in frames] == [1, 2, 3, 4, 5]
+        for _, frame_n, screen in frames:
+            assert numpy.array_equal(screen, screens[frame_n] >> 6)
+        assert reader.at(6)[1] == 5 and reader.at(4) is None
+
+        archive = TileDeltaCompressor(fname)
+        try:
+            archive.handle({'screen': numpy.zeros((160, 240), numpy.uint8), 'frame_n': 8})
+        except ValueError:
+            pass
+        else:
+            assert False, 'appended a 240x160 screen to a 160x144 archive'
+        archive.handle({'screen': screens[0], 'timestamp_s': 9, 'frame_n': 8})
+        archive.close()
+        assert len(list(TileDeltaReader(fname))) == 9
+
+        # a block cut off mid-write, with no index (or an empty one) to
+        # say where the blocks are: the rest are still readable
+        with open(fname, 'r+b') as fd:
+            fd.truncate(os.path.getsize(fname) - 200)
+        for empty_index in (True, False):
+            os.remove(fname + '.idx')
+            if empty_index:
+                open(fname + '.idx', 'w').close()
+            reader = TileDeltaReader(fname)
+            assert reader.index_times == [5, 6, 6, 7]
+            assert [frame_n for _, frame_n, _ in reader] == range(8)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_screen_archive(batch=4):
+    ''' read back what video.ScreenCompressor wrote, gzipped and not, with
+    frame numbers past 256 and records split over several batches '''
+    import shutil
+    import tempfile
+    import video
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = tmp + '/frames.raw.gz'
+        rnd = numpy.random.RandomState(1)
+        screens = [rnd.randint(0, 256, (144, 160)).astype(numpy.uint8) for _ in xrange(10)]
+        numbers = [3, 100, 250, 260, 500, 505, 700, 701, 900, 1000]
+        compressor = video.ScreenCompressor(fname)
+        for n, (frame_n, screen) in enumerate(zip(numbers, screens)):
+            compressor.handle({'screen': screen, 'timestamp_s': 100 + n, 'frame_n': frame_n})
+        compressor.fd.close()
+        with gzip.open(fname) as src, open(tmp + '/frames.raw', 'wb') as dst:
+            dst.write(src.read())
+
+        for name in (fname, tmp + '/frames.raw'):
+            reader = ScreenArchiveReader(name, batch=batch)
+            frames = [(timestamp_s, frame_n, screen.copy())
+                      for timestamp_s, frame_n, screen in reader]
+            assert [frame[:2] for frame in frames] == zip(range(100, 110), numbers)
+            for (_, _, screen), expected in zip(frames, screens):
+                assert numpy.array_equal(screen, expected >> 6)
+            # frame_n counts up from the first record read
+            assert [frame_n for _, frame_n, _ in reader.frames(2, 5)] == [250, 260, 500]
+        assert len(ScreenArchiveReader(tmp + '/frames.raw')) == 10
+    finally:
+        shutil.rmtree(tmp)
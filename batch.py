@@ -0,0 +1,140 @@
+'''
+Process a recorded video on several cores by splitting it into segments.
+
+Each segment is OCRed in a worker process, starting `warmup` frames before
+its first frame, so that per-stream state (ScreenExtractor.last,
+OCREngine.last_matched, the last good timestamp) has a chance to catch up
+with what it would be reading the file straight through. That's only as
+good as the warmup: if the screen or the timestamp last changed before the
+warmup started, the segment's first frames can come out differently (see
+test_batch for a video where it works). Results come back as one ordered
+stream of changed frames, which then goes through the handlers (BoxReader,
+LogHandler, ...) in this process, so their state never sees a segment
+border at all.
+'''
+
+import multiprocessing
+
+import cv2
+
+import ocr
+import tilesets
+import timestamp
+import video
+
+# OpenCV 2 only has these under cv2.cv
+CAP_PROP_POS_FRAMES = getattr(cv2, 'CAP_PROP_POS_FRAMES', 1)
+CAP_PROP_FRAME_COUNT = getattr(cv2, 'CAP_PROP_FRAME_COUNT', 7)
+
+# keys of the frame data that make it back from the workers
+RESULT_KEYS = ('frame_n', 'timestamp', 'timestamp_s', 'text')
+
+identifier = None
+
+
+def init_worker(debug, tile_set, max_distance=0):
+    # building the sprite tables is slow, so do it once per worker process
+    global identifier
+    identifier = ocr.SpriteIdentifier(debug=debug, tile_set=tile_set,
+                                      max_distance=max_distance)
+
+
+def process_segment(segment):
+    '''
+    OCR frames [start, end) of a video, after warming up on the `warmup`
+    frames before it. Returns a list of dicts with RESULT_KEYS, one per
+    changed frame.
+    '''
+    video_loc, start, end, warmup = segment
+    first = max(0, start - warmup)
+    stream = cv2.VideoCapture(video_loc)
+    if first:
+        stream.set(CAP_PROP_POS_FRAMES, first)
+
+    identifier.ocr_engine.reset()
+    extractor = video.ScreenExtractor(geometry=identifier.tile_set.geometry)
+    extractor.n = first
+    proc = ocr.StreamProcessor(default_handlers=False, ratelimit=False)
+    proc.add_handler(extractor.handle)
+    proc.add_handler(identifier.handle)
+    proc.add_handler(timestamp.TimestampRecognizer().handle)
+
+    records = []
+    def record(data):
+        if data['frame_n'] > start:  # frame_n counts from 1
+            records.append({key: data[key] for key in RESULT_KEYS})
+    proc.add_handler(record)
+
+    for _ in xrange(first, end):
+        success, frame = stream.read()
+        if not success:
+            break
+        proc.process_frame({'frame': cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)})
+    return records
+
+
+class BatchProcessor(ocr.StreamProcessor):
+    '''
+    Process a video file with `jobs` worker processes, `segment_length`
+    frames at a time. Handlers receive the changed frames in order, with
+    'frame_n', 'timestamp', 'timestamp_s' and 'text' (but no images).
+    '''
+
+    def __init__(self, video_loc, jobs=None, segment_length=60*60*10,
+                 warmup=120, debug=False, tile_set=tilesets.DEFAULT, max_distance=0):
+        super(BatchProcessor, self).__init__(
+            default_handlers=False, video_loc=video_loc, ratelimit=False)
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.segment_length = segment_length
+        self.warmup = warmup
+        self.debug = debug
+        self.tile_set = tile_set
+        self.max_distance = max_distance
+
+    def segments(self):
+        stream = cv2.VideoCapture(self.video_loc)
+        frames = int(stream.get(CAP_PROP_FRAME_COUNT))
+        stream.release()
+        if frames <= 0:
+            # unknown length (some FLV recordings): do it in one piece
+            return [(self.video_loc, 0, 2**62, 0)]
+        return [(self.video_loc, start, min(frames, start + self.segment_length),
+                 self.warmup)
+                for start in xrange(0, frames, self.segment_length)]
+
+    def run(self):
+        pool = multiprocessing.Pool(self.jobs, init_worker,
+                                    (self.debug, self.tile_set, self.max_distance))
+        try:
+            for records in pool.imap(process_segment, self.segments()):
+                for data in records:
+                    self.process_frame(data)
+        finally:
+            pool.terminate()
+            self.close()
+
+
+def test_batch(segment_length=50, warmup=30):
+    ''' segments of a video with text typed out across their borders should
+    come back the same as reading it straight through '''
+    import shutil
+    import tempfile
+    import bench
+    frames = (bench.corpus_frames(6) + bench.typing_frames(150, bench.tile_cells())
+              + bench.corpus_frames(6))
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = tmp + '/fixture.avi'
+        bench.write_video(fname, frames)
+        outputs = []
+        for proc in (ocr.StreamProcessor(video_loc=fname, ratelimit=False),
+                     BatchProcessor(fname, jobs=2, segment_length=segment_length,
+                                    warmup=warmup)):
+            out = []
+            proc.add_handler(lambda data: out.append(
+                tuple(data[key] for key in RESULT_KEYS)))
+            proc.run()
+            outputs.append(out)
+    finally:
+        shutil.rmtree(tmp)
+    assert outputs[0] and outputs[0] == outputs[1], outputs
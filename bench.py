@@ -0,0 +1,508 @@
+'''
+Benchmarks for the OCR pipeline.
+
+Frames go through the same stages as a StreamProcessor with the default
+handlers and a BoxReader, with each stage timed on its own:
+
+    extract    ScreenExtractor (frames that didn't change stop here)
+    translate  OCREngine.translate
+    identify   OCREngine.rescan
+    merge      OCREngine.resolve
+    timestamp  TimestampRecognizer
+    dialog     BoxReader
+
+Workloads:
+
+    corpus  the screenshots in corpus/, one after the other
+    dense   a new screen full of text every frame, built from a tile sheet
+    typing  dialog text appearing a letter at a time, like the game does it
+
+The synthetic workloads use the tile set being benchmarked (--tile-set),
+drawn on that tile set's screen; the corpus only runs for GBA tile sets.
+
+Usage:
+
+    python bench.py [-w typing] [-n 2000] [--tile-set red] [--json out.json] [--baseline old.json]
+    python bench.py --dialog-log dialog_raw.txt
+
+With --dialog-log, dialog_raw.txt captures written by BoxReader are
+replayed through a BoxReader instead, once with the native dist_merge and
+once with the pure Python one, which also checks they find the same dialog.
+
+With --baseline, the results are compared against an earlier --json run,
+and the exit status is 1 if anything got slower by more than --threshold.
+'''
+
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import gc
+import json
+import os
+import random
+import sys
+import time
+
+import cv2
+import numpy
+
+import dialog
+import ocr
+import tilesets
+import timestamp
+import video
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STAGES = ('extract', 'translate', 'identify', 'merge', 'timestamp', 'dialog')
+WORKLOADS = ('corpus', 'dense', 'typing')
+
+# the corpus is screenshots of Emerald, so it's only any good for GBA tile sets
+CORPUS_GEOMETRY = tilesets.GBA
+
+# Where the synthetic workloads put text on each screen geometry: the left
+# edge and columns of dense_frames' rows, and the map and dialog box of
+# typing_frames. GB text has to be on the 8x8 tile grid; GBA text doesn't,
+# so dense_frames puts it off the grid.
+Layout = collections.namedtuple(
+    'Layout', 'dense_left dense_columns map_height box_y box_x line_length')
+LAYOUTS = {
+    tilesets.GBA: Layout(4, 28, 112, 121, 16, 26),
+    tilesets.GB: Layout(0, 20, 96, 112, 8, 18),
+}
+
+
+def screen_colors(tile_set):
+    ''' the grays a tile set's text has on the stream after extract_screen,
+    lightest first '''
+    tile_set = tilesets.get(tile_set)
+    if tile_set.palette:
+        grays = collections.OrderedDict()
+        for gray, color in tile_set.palette:
+            grays.setdefault(color, gray)
+        return tuple(grays.values())
+    band = 256 / tile_set.levels
+    return tuple(level * band + band / 2 for level in reversed(xrange(tile_set.levels)))
+
+
+def tile_cells(tile_set=tilesets.DEFAULT):
+    '''
+    Return every cell of a tile set's sheet that holds a sprite with the
+    right number of colors, recolored to look like it does on the stream.
+    '''
+    tile_set = tilesets.get(tile_set)
+    tiles = cv2.cvtColor(cv2.imread(video.DATA_DIR + '/' + tile_set.png), cv2.COLOR_BGR2GRAY)
+    colors = screen_colors(tile_set)
+    if tile_set.levels:
+        # quantized like SpriteIdentifier.make_tilemap, to the middle of each band
+        band = 256 / tile_set.levels
+        tiles = tiles / band * band + band / 2
+    height = tile_set.cell_height
+    cells = []
+    for y in xrange(len(tiles) / height):
+        for x in xrange(len(tiles[0]) / 8):
+            cell = tiles[y*height:y*height+height, x*8:x*8+8]
+            grays = numpy.unique(cell)
+            if len(grays) != tile_set.colors:
+                continue
+            lut = numpy.zeros(256, numpy.uint8)
+            if tile_set.palette:
+                lut[grays[::-1]] = colors[:len(grays)]
+            else:
+                lut[grays] = grays
+            cells.append(lut[cell])
+    return cells
+
+
+def screen_to_frame(screen, frame=None, geometry=tilesets.GBA):
+    ''' blow a screen up into a 1280x720 stream frame '''
+    if frame is None:
+        frame = numpy.zeros((720, 1280), numpy.uint8)
+    region = ocr.screen_region(frame, geometry)
+    region[:] = cv2.resize(screen, region.shape[::-1], interpolation=cv2.INTER_NEAREST)
+    return frame
+
+
+def corpus_frames(count, directory=video.DATA_DIR + '/corpus'):
+    images = [cv2.cvtColor(cv2.imread(directory + '/' + fn), cv2.COLOR_BGR2GRAY)
+              for fn in sorted(os.listdir(directory))]
+    return [images[n % len(images)] for n in xrange(count)]
+
+
+def dense_frames(count, cells, seed=1, tile_set=tilesets.DEFAULT):
+    tile_set = tilesets.get(tile_set)
+    geometry = tile_set.geometry
+    layout = LAYOUTS[geometry]
+    height = tile_set.cell_height
+    rnd = random.Random(seed)
+    frames = []
+    for _ in xrange(count):
+        screen = numpy.empty((geometry.height, geometry.width), numpy.uint8)
+        screen[:] = screen_colors(tile_set)[0]
+        for row in xrange(geometry.height / height):
+            for col in xrange(layout.dense_columns):
+                if rnd.random() < 0.15:
+                    continue  # spaces
+                x = layout.dense_left + col * 8
+                screen[row*height:row*height+height, x:x+8] = rnd.choice(cells)
+        frames.append(screen_to_frame(screen, geometry=geometry))
+    return frames
+
+
+def typing_frames(count, cells, seed=1, frames_per_letter=2, line_length=None,
+                  tile_set=tilesets.DEFAULT):
+    '''
+    A dialog box filling up a letter at a time, with the usual two lines
+    (at y=121 and y=137 on GBA screens). Full boxes are cleared for the
+    next page.
+    '''
+    tile_set = tilesets.get(tile_set)
+    geometry = tile_set.geometry
+    layout = LAYOUTS[geometry]
+    line_length = line_length or layout.line_length
+    height = tile_set.cell_height
+    rnd = random.Random(seed)
+    screen = numpy.empty((geometry.height, geometry.width), numpy.uint8)
+    frames = []
+    letter = 0
+    while len(frames) < count:
+        if letter == 0:
+            screen[:] = screen_colors(tile_set)[0]
+            screen[:layout.map_height] = 130  # the map, which the OCR should ignore
+        line, col = divmod(letter, line_length)
+        if rnd.random() >= 0.15:
+            y, x = layout.box_y + line * 16, layout.box_x + col * 8
+            screen[y:y+height, x:x+8] = rnd.choice(cells)
+        letter = (letter + 1) % (line_length * 2)
+        frame = screen_to_frame(screen, geometry=geometry)
+        frames.extend([frame] * frames_per_letter)
+    return frames[:count]
+
+
+def write_video(fname, frames, fps=60):
+    ''' write frames (gray or BGR) to an MJPG video, for tests that need
+    to decode one '''
+    height, width = frames[0].shape[:2]
+    writer = cv2.VideoWriter(fname, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    for frame in frames:
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        writer.write(frame)
+    writer.release()
+
+
+def make_frames(workload, count, tile_set=tilesets.DEFAULT):
+    tile_set = tilesets.get(tile_set)
+    if workload == 'corpus':
+        if tile_set.geometry != CORPUS_GEOMETRY:
+            raise ValueError('the corpus is GBA screenshots, not for %s' % tile_set.name)
+        return corpus_frames(count)
+    if workload == 'dense':
+        return dense_frames(count, tile_cells(tile_set), tile_set=tile_set)
+    if workload == 'typing':
+        return typing_frames(count, tile_cells(tile_set), tile_set=tile_set)
+    raise ValueError('unknown workload %r' % workload)
+
+
+class Pipeline(object):
+    ''' one stream's worth of handler state, run a stage at a time '''
+
+    def __init__(self, identifier):
+        self.engine = identifier.ocr_engine
+        self.engine.reset()
+        self.extractor = video.ScreenExtractor(geometry=identifier.tile_set.geometry)
+        self.recognizer = timestamp.TimestampRecognizer()
+        self.box_reader = dialog.BoxReader(raw_log=None)
+
+    def stages(self, frame):
+        '''
+        Yield the name of each stage as it's about to run; the stage runs
+        when the generator is resumed. Returns early for unchanged frames.
+        '''
+        data = {'frame': frame}
+        yield 'extract'
+        try:
+            self.extractor.handle(data)
+        except StopIteration:
+            return
+        yield 'translate'
+        image = self.engine.translate(data['screen'])
+        yield 'identify'
+        if numpy.array_equal(image, self.engine.last_image):
+            data['text'] = self.engine.last_out
+        else:
+            self.engine.last_image = image
+            scan = self.engine.rescan(image)
+            yield 'merge'
+            data['text'] = self.engine.resolve(*scan)
+        yield 'timestamp'
+        self.recognizer.handle(data)
+        yield 'dialog'
+        self.box_reader.handle(data)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def time_stages(identifier, frames):
+    '''
+    Run frames through a fresh Pipeline. mean_ms is the time a stage takes
+    averaged over every frame, including those where it didn't run, so the
+    means add up to the time per frame; p50_ms and p99_ms are per call.
+    '''
+    pipeline = Pipeline(identifier)
+    times = dict((stage, []) for stage in STAGES)
+    start = time.time()
+    for frame in frames:
+        stages = pipeline.stages(frame)
+        stage = next(stages)
+        while stage:
+            t = time.time()
+            following = next(stages, None)
+            times[stage].append(time.time() - t)
+            stage = following
+    elapsed = time.time() - start
+
+    result = {
+        'frames': len(frames),
+        'changed': len(times['translate']),
+        'fps': len(frames) / elapsed,
+        'stages': {},
+    }
+    for stage in STAGES:
+        values = times[stage]
+        result['stages'][stage] = {
+            'calls': len(values),
+            'mean_ms': 1000 * sum(values) / len(frames),
+            'p50_ms': 1000 * percentile(values, .5),
+            'p99_ms': 1000 * percentile(values, .99),
+        }
+    return result
+
+
+def malloc_counter():
+    '''
+    Return a function giving the bytes malloc has handed out, from glibc's
+    mallinfo, or None if there's no mallinfo. Unlike counting objects, this
+    sees numpy's and cffi's buffers, but not the small objects Python
+    keeps in its own arenas.
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    except OSError:
+        return None
+    # mallinfo's ints wrap past 2GB, so use mallinfo2 where there is one
+    for name, field in (('mallinfo2', ctypes.c_size_t), ('mallinfo', ctypes.c_int)):
+        mallinfo = getattr(libc, name, None)
+        if mallinfo is not None:
+            break
+    else:
+        return None
+
+    class MallInfo(ctypes.Structure):
+        _fields_ = [(f, field) for f in ('arena', 'ordblks', 'smblks', 'hblks', 'hblkhd',
+                                         'usmblks', 'fsmblks', 'uordblks', 'fordblks',
+                                         'keepcost')]
+    mallinfo.restype = MallInfo
+
+    def measure():
+        info = mallinfo()
+        return info.uordblks + info.hblkhd  # the heap, and mmapped blocks
+    return measure
+
+
+def count_allocations(identifier, frames):
+    '''
+    Net allocations per frame for each stage: bytes, from tracemalloc or
+    else malloc_counter (method says which, None if neither works here),
+    and gc-tracked objects created.
+    '''
+    pipeline = Pipeline(identifier)
+    counts = dict((stage, [0, 0]) for stage in STAGES)
+    method, measure_bytes = None, lambda: 0
+    if tracemalloc:
+        method = 'tracemalloc'
+        tracemalloc.start()
+        measure_bytes = lambda: tracemalloc.get_traced_memory()[0]
+    elif malloc_counter():
+        method, measure_bytes = 'malloc', malloc_counter()
+    gc.collect()
+    gc.disable()
+    try:
+        for frame in frames:
+            stages = pipeline.stages(frame)
+            stage = next(stages)
+            while stage:
+                before = measure_bytes(), gc.get_count()[0]
+                following = next(stages, None)
+                counts[stage][0] += measure_bytes() - before[0]
+                counts[stage][1] += gc.get_count()[0] - before[1]
+                stage = following
+    finally:
+        if tracemalloc:
+            tracemalloc.stop()
+        gc.enable()
+    return {
+        'method': method,
+        'bytes_per_frame': dict((stage, counts[stage][0] / float(len(frames)))
+                                for stage in STAGES),
+        'objects_per_frame': dict((stage, counts[stage][1] / float(len(frames)))
+                                  for stage in STAGES),
+    }
+
+
+def time_dialog_log(fname, repeat=5):
+    '''
+    Replay a dialog_raw.txt through a fresh BoxReader, with each dist_merge,
+    and return the best time per line of the log.
+    '''
+    frames = list(dialog.read_raw_log(fname))
+    result = {'frames': len(frames)}
+    outputs = {}
+    native = dialog.dist_merge
+    for name, merge in (('python', dialog.py_dist_merge), ('native', native)):
+        dialog.dist_merge = merge  # BoxReader looks it up on every call
+        try:
+            best = None
+            for _ in xrange(repeat):
+                box_reader = dialog.BoxReader(raw_log=None)
+                out = []
+                box_reader.add_dialog_handler(lambda text, data: out.append(text))
+                start = time.time()
+                for data in frames:
+                    box_reader.handle(data)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            dialog.dist_merge = native
+        outputs[name] = out
+        result[name + '_us'] = 1e6 * best / max(1, len(frames))
+    result['dialogs'] = len(outputs['native'])
+    result['same'] = outputs['python'] == outputs['native']
+    return result
+
+
+def run(workloads, count, tile_set=tilesets.DEFAULT, allocations=True,
+        dialog_logs=()):
+    tile_set = tilesets.get(tile_set)
+    results = {'python': sys.version.split()[0], 'tile_set': tile_set.name,
+               'workloads': {}, 'dialog_logs': {}}
+    for fname in dialog_logs:
+        results['dialog_logs'][fname] = time_dialog_log(fname)
+    if not workloads:
+        return results
+    identifier = ocr.SpriteIdentifier(tile_set=tile_set)
+    for workload in workloads:
+        frames = make_frames(workload, count, identifier.tile_set)
+        time_stages(identifier, frames[:min(50, count)])  # warm up
+        result = time_stages(identifier, frames)
+        if allocations:
+            result['allocations'] = count_allocations(identifier, frames)
+        results['workloads'][workload] = result
+    return results
+
+
+def report(results):
+    for fname, result in sorted(results.get('dialog_logs', {}).items()):
+        print '%s: %d lines, %d dialogs%s' % (
+            fname, result['frames'], result['dialogs'],
+            '' if result['same'] else ', DIFFERENT from the Python dist_merge')
+        print '  python %8.2fus/line  native %8.2fus/line' % (
+            result['python_us'], result['native_us'])
+    for workload, result in sorted(results['workloads'].items()):
+        allocs = result.get('allocations', {})
+        print '%s: %d frames (%d changed), %.0f fps%s' % (
+            workload, result['frames'], result['changed'], result['fps'],
+            ', bytes from %s' % allocs['method'] if allocs.get('method') else '')
+        for stage in STAGES:
+            stats = result['stages'][stage]
+            print '  %-10s %6d calls  mean %7.3fms  p50 %7.3fms  p99 %7.3fms%s' % (
+                stage, stats['calls'], stats['mean_ms'], stats['p50_ms'], stats['p99_ms'],
+                '  bytes %9.1f  objects %6.1f' % (
+                    allocs['bytes_per_frame'][stage], allocs['objects_per_frame'][stage])
+                if allocs else '')
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Print how results changed against a baseline, and return a list of
+    the (workload, metric) pairs that got worse by more than threshold.
+    '''
+    regressions = []
+    for fname, result in sorted(results.get('dialog_logs', {}).items()):
+        old = baseline.get('dialog_logs', {}).get(fname)
+        if old is None:
+            continue
+        ratio = result['native_us'] / old['native_us']
+        worse = ratio > 1 + threshold
+        print '%s:\n  %-16s %10.3f -> %10.3f  %+6.1f%%%s' % (
+            fname, 'native us/line', old['native_us'], result['native_us'],
+            (ratio - 1) * 100, '  REGRESSION' if worse else '')
+        if worse:
+            regressions.append((fname, 'native us/line'))
+    for workload, result in sorted(results['workloads'].items()):
+        old = baseline['workloads'].get(workload)
+        if old is None:
+            print '%s: not in baseline' % workload
+            continue
+        # fps is the only metric where bigger is better
+        metrics = [('fps', old['fps'], result['fps'], True)]
+        for stage in STAGES:
+            metrics.append(('%s mean' % stage, old['stages'][stage]['mean_ms'],
+                            result['stages'][stage]['mean_ms'], False))
+        print '%s:' % workload
+        for name, before, after, higher_better in metrics:
+            if not before:
+                continue
+            ratio = after / before
+            worse = ratio < 1 / (1 + threshold) if higher_better else ratio > 1 + threshold
+            print '  %-16s %10.3f -> %10.3f  %+6.1f%%%s' % (
+                name, before, after, (ratio - 1) * 100, '  REGRESSION' if worse else '')
+            if worse:
+                regressions.append((workload, name))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the OCR pipeline')
+    parser.add_argument('--workload', '-w', action='append', choices=WORKLOADS,
+                        help='Workload to run, may be repeated (default: all)')
+    parser.add_argument('--frames', '-n', type=int, default=2000,
+                        help='Frames per workload (default: 2000)')
+    parser.add_argument('--tile-set', default=tilesets.DEFAULT, choices=tilesets.TILE_SETS,
+                        help='Tile set to read, and draw the synthetic workloads with '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-allocations', action='store_true',
+                        help='Skip counting allocations')
+    parser.add_argument('--dialog-log', action='append', default=[],
+                        help='Replay a dialog_raw.txt capture through BoxReader, '
+                        'may be repeated')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Compare against results from --json')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown that counts as a regression (default: 0.1)')
+    options = parser.parse_args()
+
+    # just the dialog logs, if that's all that was asked for
+    workloads = options.workload or ([] if options.dialog_log else [
+        workload for workload in WORKLOADS if workload != 'corpus'
+        or tilesets.get(options.tile_set).geometry == CORPUS_GEOMETRY])
+    results = run(workloads, options.frames, options.tile_set,
+                  not options.no_allocations, options.dialog_log)
+    report(results)
+    if options.json:
+        with open(options.json, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as fd:
+            regressions = compare(results, json.load(fd), options.threshold)
+        if regressions:
+            sys.exit(1)
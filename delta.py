@@ -1,4 +1,111 @@
 import itertools
+import random
+
+import video
+
+
+def py_encode(text, last, minmatch=4):
+    ''' the delta from last to text, see StringDeltaCompressor '''
+    buf = ''
+    in_match = True
+    mismatch_begin = 0
+    mismatch_emitted = False
+    match_begin = 0
+    offset = 0
+
+    instructions = []
+
+    def emit(offset, pos, leng):
+        if leng == 0:
+            return ''
+        return '%d\t%s\t' % (pos - offset, text[pos:pos+leng])
+
+    # find mismatches
+    for n, (a, b) in enumerate(itertools.izip_longest(text, last, fillvalue=None)):
+        if in_match:
+            if a != b:
+                in_match = False
+                if n - match_begin >= minmatch:
+                    buf += emit(offset, mismatch_begin, match_begin - mismatch_begin)
+                    offset = match_begin
+                    mismatch_begin = n
+        else:
+            if a == b:
+                in_match = True
+                match_begin = n
+
+    # emit last match if not already emitted
+    if not in_match:
+        buf += emit(offset, mismatch_begin, n - mismatch_begin + 1)
+    elif mismatch_begin < match_begin:
+        buf += emit(offset, mismatch_begin, match_begin - mismatch_begin)
+
+    return buf[:-1]  # strip trailing tab
+
+
+def encode(text, last, minmatch=4):
+    ''' py_encode, in C '''
+    if isinstance(text, unicode) or isinstance(last, unicode):
+        return py_encode(text, last, minmatch)
+    out = video.ffi.new('char[]', len(text) + 12 * (len(text) / (minmatch + 1) + 2))
+    size = video.C.string_delta(text, len(text), last, len(last), minmatch, out)
+    return video.ffi.buffer(out, size)[:]
+
+
+def apply_delta(buf, delta):
+    ''' apply a delta to a bytearray, in place '''
+    if delta == '':
+        return
+    ins = delta.split('\t')
+    pos = 0
+    for n in xrange(0, len(ins), 2):
+        pos += int(ins[n])
+        fragment = ins[n + 1]
+        buf[pos:pos+len(fragment)] = fragment
+        pos += len(fragment)
+
+
+def is_keyframe(delta, length):
+    ''' whether a delta replaces the whole of a string of this length '''
+    return delta.startswith('0\t') and len(delta) - 2 >= length and delta.find('\t', 2) == -1
+
+
+def decode(prev, delta):
+    ''' the string delta was made from, given the one before it '''
+    if delta == '':
+        return prev
+    buf = bytearray(prev)
+    apply_delta(buf, delta)
+    return str(buf)
+
+
+def decode_many(prev, deltas):
+    '''
+    Apply a run of deltas in one pass, starting from the last keyframe in
+    it, and return the final string. prev can be '' if there's a keyframe.
+    '''
+    # keyframes are the longest deltas that are one fragment at 0; others
+    # like that are shorter, unless everything changed, which is as good
+    whole = [n for n, delta in enumerate(deltas) if is_keyframe(delta, 0)]
+    length = max([len(prev)] + [len(deltas[n]) - 2 for n in whole])
+    first = max([0] + [n for n in whole if len(deltas[n]) - 2 >= length])
+    size = max(length, len(prev))
+    buf = video.ffi.new('char[]', size + 1)
+    video.ffi.memmove(buf, prev, len(prev))
+    used = len(prev)
+    for n in xrange(first, len(deltas)):
+        delta = deltas[n]
+        new_used = -1
+        if not isinstance(delta, unicode):
+            new_used = video.C.apply_string_delta(buf, used, size, delta, len(delta))
+        if new_used < 0:
+            # the string grew, or something C can't take: finish in Python
+            rest = bytearray(video.ffi.buffer(buf, used))
+            for delta in itertools.islice(deltas, n, None):
+                apply_delta(rest, delta)
+            return str(rest)
+        used = new_used
+    return video.ffi.buffer(buf, used)[:]
 
 
 class StringDeltaCompressor(object):
@@ -9,13 +116,20 @@ class StringDeltaCompressor(object):
     Or, alternatively:
         {match_len}\t{mismatch_str}\t...
     Input cannot contain tabs.
+
+    Every `keyframe_interval` frames the whole string is sent instead
+    ('0\t' + text, which decodes from anything of the same length), so
+    consumers can join mid-stream; data[key + '_keyframe'] is set on
+    those. None turns keyframes off.
     '''
 
-    def __init__(self, key, minmatch=4, verify=False):
+    def __init__(self, key, minmatch=4, verify=False, keyframe_interval=600):
         self.key = key
         self.minmatch = minmatch
         self.last = ''
         self.verify = verify
+        self.keyframe_interval = keyframe_interval
+        self.since_keyframe = 0
 
     def handle(self, data):
         text = data[self.key]
@@ -23,48 +137,25 @@ class StringDeltaCompressor(object):
         assert '\t' not in text
         assert len(text) >= len(self.last)
 
+        self.since_keyframe += 1
+        keyframe = (self.keyframe_interval is not None and
+                    self.since_keyframe >= self.keyframe_interval)
+        data[self.key + '_keyframe'] = keyframe
+        if keyframe:
+            self.since_keyframe = 0
+            self.last = text
+            data[self.key + '_delta'] = '0\t' + text
+            return
+
         if text == self.last:
             data[self.key + '_delta'] = ''
             return
 
-        buf = ''
-        in_match = True
-        mismatch_begin = 0
-        mismatch_emitted = False
-        match_begin = 0
-        offset = 0
-
-        instructions = []
-
-        def emit(offset, pos, leng):
-            if leng == 0:
-                return ''
-            return '%d\t%s\t' % (pos - offset, text[pos:pos+leng])
-
-        # find mismatches
-        for n, (a, b) in enumerate(itertools.izip_longest(text, self.last, fillvalue=None)):
-            if in_match:
-                if a != b:
-                    in_match = False
-                    if n - match_begin >= self.minmatch:
-                        buf += emit(offset, mismatch_begin, match_begin - mismatch_begin)
-                        offset = match_begin
-                        mismatch_begin = n
-            else:
-                if a == b:
-                    in_match = True
-                    match_begin = n
-
-        # emit last match if not already emitted
-        if not in_match:
-            buf += emit(offset, mismatch_begin, n - mismatch_begin + 1)
-        elif mismatch_begin < match_begin:
-            buf += emit(offset, mismatch_begin, match_begin - mismatch_begin)
-
-        buf = buf[:-1]  # strip trailing tab
+        buf = encode(text, self.last, self.minmatch)
 
         if self.verify:
             #print buf.replace('\t', '`').replace('\n','\\')
+            assert buf == py_encode(text, self.last, self.minmatch)
             assert self.decode(self.last, buf) == text
             try:
                 assert len(buf) <= len(text) + 3
@@ -77,21 +168,31 @@ class StringDeltaCompressor(object):
         data[self.key + '_delta'] = buf
 
     def decode(self, prev, delta):
-        if delta == '':
-            return prev
-
-        ins = delta.split('\t')
-        data = prev
-        pos = 0
-        while ins:
-            pos += int(ins.pop(0))
-            fragment = ins.pop(0)
-            data = data[:pos] + fragment + data[pos+len(fragment):]
-            pos += len(fragment)
+        return decode(prev, delta)
+
+
+def test_string_delta():
+    rnd = random.Random(1)
+    comp = StringDeltaCompressor('d', verify=True, keyframe_interval=50)
+    text = ''.join(rnd.choice('ab\n ') for _ in xrange(300))
+    deltas = []
+    for _ in xrange(400):
+        text = list(text)
+        for _ in xrange(rnd.randrange(10)):
+            pos = rnd.randrange(len(text))
+            text[pos:pos+3] = rnd.choice('ab\n '), 'c', 'd'
+        text = ''.join(text[:300])
+        data = {'d': text}
+        comp.handle(data)
+        deltas.append(data['d_delta'])
+    assert decode_many('', deltas) == text
+    assert decode_many('ab', ['0\tabc', '1\tx\t1\tyz']) == 'axcyz'  # growing
+    assert decode_many('', deltas[-60:]) == text
+    assert reduce(decode, deltas, '') == text
 
-        return data
 
 if __name__ == '__main__':
+    test_string_delta()
     comp = StringDeltaCompressor('d', verify=True)
     for a in ('abcde', 'bbcde'):
         comp.handle({'d':a})
@@ -1,7 +1,13 @@
+import ast
 import itertools
+import random
 import re
 
-def is_subsequence(a, b):
+import timestamp
+import video
+
+
+def py_is_subsequence(a, b):
     b_pos = 0
     try:  # http://stackoverflow.com/a/3673735/3694
         for char in a:
@@ -12,20 +18,15 @@ def is_subsequence(a, b):
     except ValueError:
         return False
 
-def dist_merge(s1, s2):
+def py_dist_merge(s1, s2):
     '''
     Calculate edit distance between two strings and what their
     'merged' value should be. This reduces errors when
     noise makes a character unrecognizable.
     '''
-    if is_subsequence(s1, s2):
+    if py_is_subsequence(s1, s2):
         return 0, s2
 
-    #print 'dist_merge', repr(s1), `s2`
-    s2_pos = 0
-    for c in s1:
-        if c == ' ':
-            continue
     dist = 0
     out = ''
     for a, b in itertools.izip_longest(s1, s2, fillvalue=' '):
@@ -38,56 +39,125 @@ def dist_merge(s1, s2):
     return dist, out
 
 
+def is_subsequence(a, b):
+    ''' whether a, ignoring spaces, is a subsequence of b '''
+    if isinstance(a, unicode) or isinstance(b, unicode):
+        return py_is_subsequence(a, b)
+    return bool(video.C.is_subsequence(a, len(a), b, len(b)))
+
+def dist_merge(s1, s2):
+    ''' py_dist_merge, in C '''
+    if isinstance(s1, unicode) or isinstance(s2, unicode):
+        return py_dist_merge(s1, s2)
+    # the usual case, text appearing a letter at a time, needs no buffers
+    if video.C.is_subsequence(s1, len(s1), s2, len(s2)):
+        return 0, s2
+    out = video.ffi.new('char[]', max(len(s1), len(s2), 1))
+    out_len = video.ffi.new('int *')
+    dist = video.C.dist_merge(s1, len(s1), s2, len(s2), out, out_len)
+    return dist, video.ffi.buffer(out, out_len[0])[:]
+
+
+# one [y, xbegin, xend, 'text'] in a str(lines)
+RAW_LINE_RE = re.compile(r'''\[(\d+), (\d+), (\d+), ('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")\](?:, |\]$)''')
+
+
+def parse_lines(text):
+    ''' inverse of str(lines), faster than ast.literal_eval '''
+    lines = []
+    pos = 1
+    for match in RAW_LINE_RE.finditer(text, 1):
+        if match.start() != pos:
+            break
+        y, xbegin, xend, string = match.groups()
+        lines.append([int(y), int(xbegin), int(xend), string[1:-1].decode('string_escape')])
+        pos = match.end()
+    if pos == len(text) or text == '[]':
+        return lines
+    return ast.literal_eval(text)  # something the regex doesn't know
+
+
+def read_raw_log(fname):
+    '''
+    Parse a dialog_raw.txt written by BoxReader, yielding the frame data
+    for each line, with 'timestamp', 'timestamp_s' and 'text'.
+    '''
+    with open(fname) as fd:
+        for line in fd:
+            stamp, _, lines = line.rstrip('\n').partition(' ')
+            try:
+                timestamp_s = timestamp.parse_timestamp(stamp)
+            except ValueError:
+                timestamp_s = 0
+            yield {'timestamp': stamp, 'timestamp_s': timestamp_s,
+                   'text': parse_lines(lines)}
+
+
 class BoxReader(object):
     '''Find each dialog box in the text version of the screen'''
 
-    def __init__(self, max_dist=3):
+    def __init__(self, max_dist=3, raw_log='dialog_raw.txt', box_rows=(120, 121),
+                 box_left=39):
         self.last = ''
         self.lastline = ''
         self.group = []
+        self.merged = ['']  # the group's lines, merged
         self.lastgroup = []
         self.dialog_handlers = []
         self.max_dist = max_dist
+        # where the first line of a dialog box is: its y, and x less than this
+        self.box_rows = box_rows
+        self.box_left = box_left
         self.continued = 0
         self.last_lines = None
-        self.out = open('dialog_raw.txt', 'a')
+        # every change to the text on screen: a file name (or file) to write
+        # them to as text, a textlog.TextLog, or None for nothing
+        if isinstance(raw_log, basestring):
+            raw_log = open(raw_log, 'a')
+        self.out = raw_log
 
     def add_dialog_handler(self, handler):
         self.dialog_handlers.append(handler)
 
+    def add_to_group(self, text):
+        ''' add a box's text to the group, merging its lines as it goes '''
+        self.group.append(text)
+        for line in text.splitlines():
+            if not line:
+                continue
+            if 'FIGHT BAG' in line:
+                continue
+            if 'POKEMON RUN' in line:
+                continue
+            dist, merged = dist_merge(self.merged[-1], line)
+            if dist < self.max_dist:
+                self.merged[-1] = merged
+            else:
+                self.merged.append(line)
+
+    def reset_group(self):
+        self.group = []
+        self.merged = ['']
+
     def handle_dialog(self, data, text):
         #print 'handle_dialog', repr(text), self.continued
 
         if text == '':  # dialog disappeared
             if self.last:
-                self.group.append(self.last)
+                self.add_to_group(self.last)
             if self.group and self.lastgroup and self.group[0] == self.lastgroup[-1]:
                 # some screen effects make us lose the dialog temporarily
                 # prevent duplicate lines this way
-                self.group = []
+                self.reset_group()
             if self.group:
-                out = ['']
-                for el in self.group:
-                    for line in el.splitlines():
-                        if not line:
-                            continue
-                        if 'FIGHT BAG' in line:
-                            continue
-                        if 'POKEMON RUN' in line:
-                            continue
-                        dist, merged = dist_merge(out[-1], line)
-                        if dist < self.max_dist:
-                            out[-1] = merged
-                        else:
-                            out.append(line)
-                out = ' '.join(out).strip()
+                out = ' '.join(self.merged).strip()
                 out = re.sub(r'\s+', ' ', out)
                 out = re.sub(r'- ', '', out)
                 if out.strip():
                     for handler in self.dialog_handlers:
                         handler(out, data)
                 self.lastgroup = self.group
-                self.group = []
+                self.reset_group()
             self.last = text
             return
         if text.strip() in ('', self.last.strip()):
@@ -98,7 +168,7 @@ class BoxReader(object):
         else:
             #print self.last.replace('\n', '`'), '--', text.replace('\n', '`')
             if self.last != self.lastline:
-                self.group.append(self.last)
+                self.add_to_group(self.last)
                 self.last = text
 
     def handle(self, data):
@@ -112,14 +182,26 @@ class BoxReader(object):
         lines = data['text']
 
         if lines != self.last_lines:
-            if lines:
+            # empty screens are logged too, they close dialog boxes
+            if hasattr(self.out, 'append'):
+                self.out.append(data.get('timestamp_s', 0), data.get('frame_n', 0), lines)
+            elif self.out:
                 self.out.write(data['timestamp'] + ' ' + str(lines) + '\n')
             self.last_lines = lines
 
         texts = []
         lines = [ x for x in lines if len(x[3]) > 1 ]
 
-        if len(lines) >= 1 and lines[0][0] in (120, 121) and lines[0][1] < 39:
+        if len(lines) >= 1 and lines[0][0] in self.box_rows and lines[0][1] < self.box_left:
             texts = [ x[3] for x in lines ]
 
         self.handle_dialog(data, '\n'.join(texts) if len(texts) >= 1 else '')
+
+
+def test_dist_merge():
+    rnd = random.Random(1)
+    for _ in xrange(20000):
+        s1 = ''.join(rnd.choice('ab c') for _ in xrange(rnd.randrange(12)))
+        s2 = ''.join(rnd.choice('ab c') for _ in xrange(rnd.randrange(12)))
+        assert dist_merge(s1, s2) == py_dist_merge(s1, s2), (s1, s2)
+        assert is_subsequence(s1, s2) == py_is_subsequence(s1, s2), (s1, s2)
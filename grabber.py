@@ -7,17 +7,21 @@ import json
 import time
 
 import pokr
-import redis
+from pokr import sinks
 
-
-r = redis.Redis()
+if '--local' in sys.argv:
+    # no redis around: keep what would have been published in memory
+    r = sinks.LocalPublisher(verbose=True)
+else:
+    import redis
+    r = redis.Redis()
 
 class FilteredPrinter(object):
     def printer(self, data):
         if data['dithered_delta'] == '':
             return
-        data.pop('frame')
-        data.pop('screen')
+        data.pop('frame', None)  # AsyncHandler already leaves the images out
+        data.pop('screen', None)
         r.publish('pokemon.streams.frames', json.dumps(data))
         print data['timestamp'], '%5d'%len(data['dithered_delta'])
 
@@ -42,14 +46,19 @@ class TSD(object):
             print ts
 
 
+proc = pokr.StreamProcessor()
+
+# publishing happens on background threads, so a slow redis can't stall
+# the OCR. Dialog is rare and mustn't get lost, so a full dialog queue
+# waits for redis instead of dropping any; frames are neither.
 box_reader = pokr.BoxReader()
-box_reader.add_dialog_handler(DialogPusher().handle)
+box_reader.add_dialog_handler(proc.add_sink(
+    sinks.AsyncHandler(DialogPusher().handle, maxsize=10000, overflow='block')))
 
-proc = pokr.StreamProcessor()
 proc.add_handler(TSD().timestamp_printer)
 #proc.add_handler(pokr.ScreenCompressor(fname='frames/frames.%y%m%d-%H%M.raw.gz').handle)
 #proc.add_handler(pokr.StringDeltaCompressor('dithered').handle)
 proc.add_handler(box_reader.handle)
-#proc.add_handler(FilteredPrinter().printer)
+#proc.add_async_handler(FilteredPrinter().printer, maxsize=60)
 #proc.add_handler(pokr.LogHandler('text', 'frames.log').handle)
 proc.run()
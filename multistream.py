@@ -0,0 +1,282 @@
+'''
+Read several streams in one process.
+
+Every stream keeps its own grabbing thread, frame queue, scheduler and
+handlers (ScreenExtractor, the OCR engine's last frame, BoxReader groups,
+...), but the sprite tables are loaded once and shared, and frames from
+all the streams are processed by one pool of worker threads. The heavy
+parts of each frame (extract_screen, identify_sprites, cv2) run in C with
+the GIL released, so the threads do run in parallel.
+
+Each stream is processed by at most one worker at a time, in frame order,
+so handlers never see two frames of the same stream at once. A stream
+that drops reconnects without holding up the others.
+
+    python multistream.py twitch.tv/twitchplayspokemon twitch.tv/othertpp
+    python multistream.py --workers 4 a.mp4 b.mp4 c.mp4
+'''
+
+import argparse
+import multiprocessing
+import threading
+import time
+import traceback
+import Queue
+
+import dialog
+import ocr
+import tilesets
+import timestamp
+import video
+
+
+class NotifyingQueue(Queue.Queue):
+    ''' a frame queue that tells the runner when something was put on it '''
+
+    def __init__(self, maxsize, notify):
+        Queue.Queue.__init__(self, maxsize)
+        self.notify = notify
+
+    def put(self, item, block=True, timeout=None):
+        Queue.Queue.put(self, item, block, timeout)
+        self.notify()
+
+
+class Stream(ocr.StreamProcessor):
+    '''
+    One of the streams of a MultiStreamProcessor. Add handlers to it like
+    to a StreamProcessor; data['stream'] is its name.
+    '''
+
+    def __init__(self, runner, name, bufsize=30, retry_delay=30, **kwargs):
+        super(Stream, self).__init__(default_handlers=False, bufsize=bufsize, **kwargs)
+        self.runner = runner
+        self.name = name
+        self.retry_delay = retry_delay
+        self.frame_queue = NotifyingQueue(bufsize, lambda: runner.notify(self))
+        self.scheduled = False
+        self.finished = False
+
+    def grab_frames(self):
+        # grab_frames reconnects when reading fails, but errors from
+        # resolving the stream would end this stream's thread for good
+        while True:
+            try:
+                return super(Stream, self).grab_frames()
+            except Exception:
+                traceback.print_exc()
+                print '%s: grabbing failed, retrying in %ds' % (self.name, self.retry_delay)
+                time.sleep(self.retry_delay)
+
+    def frame_done(self, cost, backlog):
+        # no pacing: sleeping here would hold up a worker the other
+        # streams need
+        self.stats.record_queue(backlog)
+        self.scheduler.processed(cost, backlog)
+
+
+class MultiStreamProcessor(object):
+    '''
+    Process frames from many streams with `workers` threads (default: one
+    per core). Add streams with add_stream before calling run().
+
+    Streams reading the same tile set share one copy of its sprite tables;
+    each gets a fork of the SpriteIdentifier with state of its own. When
+    the workers can't keep up, each stream's scheduler skips frames as if
+    it had its share of the workers to itself.
+    '''
+
+    def __init__(self, workers=None, debug=False, burst=4, max_distance=0):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.debug = debug
+        self.max_distance = max_distance
+        self.burst = burst  # frames of a stream to do before moving on
+        self.streams = []
+        self.identifiers = {}
+        self.ready = Queue.Queue()
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def identifier(self, tile_set):
+        ''' a SpriteIdentifier for one more stream, sharing the tables '''
+        name = tilesets.get(tile_set).name
+        if name not in self.identifiers:
+            self.identifiers[name] = ocr.SpriteIdentifier(
+                debug=self.debug, tile_set=name, max_distance=self.max_distance)
+        return self.identifiers[name].fork()
+
+    def add_stream(self, name, video_loc=None, stream_url=None,
+                   tile_set=tilesets.DEFAULT, default_handlers=True, **kwargs):
+        '''
+        Add a stream, reading video_loc (a file or URL ffmpeg or cv2 can open), or
+        stream_url resolved with livestreamer. Returns its Stream, for
+        adding handlers. Extra arguments go to ocr.StreamProcessor.
+        '''
+        if stream_url is not None:
+            kwargs['stream_url'] = stream_url
+        kwargs.setdefault('ratelimit', video_loc is None)
+        stream = Stream(self, name, video_loc=video_loc, debug=self.debug,
+                        tile_set=tile_set, **kwargs)
+        if default_handlers:
+            if tile_set == 'auto':
+                stream.detector = ocr.TileSetDetector(
+                    stream.use_identifier, debug=self.debug,
+                    identifiers=[self.identifier(t) for t in tilesets.TILE_SETS])
+                stream.handlers.append(stream.detector.handle)
+            else:
+                identifier = self.identifier(tile_set)
+                stream.handlers.append(video.ScreenExtractor(
+                    geometry=identifier.tile_set.geometry).handle)
+                stream.handlers.append(identifier.handle)
+            stream.handlers.append(timestamp.TimestampRecognizer().handle)
+        self.streams.append(stream)
+        return stream
+
+    def notify(self, stream):
+        ''' called after a frame is queued: make sure a worker will see it '''
+        with self.lock:
+            if not stream.scheduled:
+                stream.scheduled = True
+                self.ready.put(stream)
+
+    def finish(self, stream):
+        with self.lock:
+            stream.finished = True
+            self.active -= 1
+            if self.active == 0:
+                for _ in xrange(self.workers):
+                    self.ready.put(None)
+
+    def work(self):
+        while True:
+            stream = self.ready.get(True, 60*60*24)
+            if stream is None:
+                return
+            for _ in xrange(self.burst):
+                try:
+                    frame = stream.frame_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if frame is None:
+                    self.finish(stream)
+                    break
+                start = time.time()
+                data = stream.frame_data(frame)
+                data['stream'] = stream.name
+                stream.process_frame(data)
+                # a stream only gets its share of the workers
+                share = max(1.0, float(self.active) / self.workers)
+                stream.frame_done((time.time() - start) * share,
+                                  stream.frame_queue.qsize())
+                stream.release_frame(frame)
+            with self.lock:
+                # the queue is checked under the lock, and notify takes it
+                # after putting, so no frame is left without a worker
+                if stream.finished or stream.frame_queue.empty():
+                    stream.scheduled = False
+                else:
+                    self.ready.put(stream)
+
+    def report(self):
+        return '\n'.join('%s: %s' % (stream.name, stream.scheduler.report())
+                         for stream in self.streams)
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+
+    def run(self):
+        ''' process every stream until they have all ended '''
+        self.active = len(self.streams)
+        threads = [threading.Thread(target=self.work, name='worker %d' % n)
+                   for n in xrange(self.workers)]
+        for worker in threads:
+            worker.daemon = True
+            worker.start()
+        for stream in self.streams:
+            grabber = threading.Thread(target=stream.grab_frames,
+                                       name='grab ' + stream.name)
+            grabber.daemon = True
+            grabber.start()
+        try:
+            for worker in threads:
+                while worker.is_alive():
+                    # join without a timeout can't be interrupted
+                    worker.join(60*60*24)
+        finally:
+            self.close()
+
+
+class StreamDialogPusher(object):
+    def __init__(self, name):
+        self.name = name
+
+    def handle(self, text, data):
+        print self.name, data['timestamp'], text
+
+
+
+def test_multistream(streams=2, workers=2):
+    ''' streams of the same video, read at once, should each give what a
+    StreamProcessor reading it alone does: no state leaks between them '''
+    import shutil
+    import tempfile
+    import bench
+    frames = (bench.corpus_frames(6) + bench.typing_frames(150, bench.tile_cells())
+              + bench.corpus_frames(6))
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = tmp + '/fixture.avi'
+        bench.write_video(fname, frames)
+
+        def record(proc):
+            out = []
+            proc.add_handler(lambda data: out.append((data['frame_n'], data['text'])))
+            box_reader = dialog.BoxReader(raw_log=None)
+            box_reader.add_dialog_handler(lambda text, data: out.append(text))
+            proc.add_handler(box_reader.handle)
+            return out
+
+        proc = ocr.StreamProcessor(video_loc=fname, ratelimit=False)
+        expected = record(proc)
+        proc.run()
+        runner = MultiStreamProcessor(workers=workers)
+        outputs = [record(runner.add_stream(str(n), video_loc=fname))
+                   for n in xrange(streams)]
+        runner.run()
+    finally:
+        shutil.rmtree(tmp)
+    assert expected
+    for out in outputs:
+        assert out == expected, (out, expected)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read dialog from several streams at once')
+    parser.add_argument('streams', nargs='+',
+                        help='Video files, or URLs for livestreamer')
+    parser.add_argument('--workers', '-w', type=int, default=0,
+                        help='Number of worker threads (default: one per core)')
+    parser.add_argument('--tiles', '-t', default=tilesets.DEFAULT,
+                        choices=list(tilesets.TILE_SETS) + ['auto'],
+                        help='Game to read text from, or auto to detect it '
+                        'per stream (default: %(default)s)')
+    parser.add_argument('--max-distance', type=int, default=0, choices=(0, 1, 2),
+                        help='Pixels of a letter that can be wrong (noisy streams) '
+                        '(default: %(default)s)')
+    parser.add_argument('--debug', '-d', action='store_true',
+                        help='Show debug output')
+    options = parser.parse_args()
+
+    runner = MultiStreamProcessor(workers=options.workers, debug=options.debug,
+                                  max_distance=options.max_distance)
+    for loc in options.streams:
+        if '://' in loc or loc.startswith('twitch.tv/'):
+            stream = runner.add_stream(loc, stream_url=loc, tile_set=options.tiles)
+        else:
+            stream = runner.add_stream(loc, video_loc=loc, tile_set=options.tiles)
+        box_reader = dialog.BoxReader(raw_log=None)
+        box_reader.add_dialog_handler(StreamDialogPusher(loc).handle)
+        stream.add_handler(box_reader.handle)
+
+    runner.run()
+    print runner.report()
@@ -2,6 +2,8 @@
 
 import argparse
 import collections
+import copy
+import hashlib
 import os
 import re
 import time
@@ -11,34 +13,101 @@ import Queue
 
 import livestreamer
 import cv2
+import numpy
 
 import delta
 import dialog
+import scheduler
+import sinks
+import sources
+import stats
+import textlog
+import tilesets
 import timestamp
 import video
 
 
-def extract_screen(raw):
-    #screen_x, screen_y = 8, 41
-    #screen = raw[screen_y:screen_y+432, screen_x:screen_x+480]
-    #screen = cv2.resize(screen, (160, 144), interpolation=cv2.INTER_AREA)
-    screen_x, screen_y = 8, 8
-    screen = raw[screen_y:screen_y+640, screen_x:screen_x+960]
-    screen = cv2.resize(screen, (240, 160), interpolation=cv2.INTER_AREA)
+def screen_region(raw, geometry=tilesets.GBA):
+    x, y, scale = geometry.x, geometry.y, geometry.scale
+    return raw[y:y+geometry.height*scale, x:x+geometry.width*scale]
+
+
+def extract_screen(raw, geometry=tilesets.GBA, out=None):
+    ''' the game screen, shrunk to its own resolution (into out, if given) '''
+    screen = cv2.resize(screen_region(raw, geometry), (geometry.width, geometry.height),
+                        out, interpolation=cv2.INTER_AREA)
     return screen
 
 
 class SpriteIdentifier(object):
-    '''Convert image sprites into a text format'''
-    def __init__(self, debug=False):
+    '''
+    Convert image sprites into a text format.
+
+    tile_set is the name of one of tilesets.TILE_SETS (or a TileSet).
+    Building the sprite tables from the tile sheet takes a while, so they're
+    cached in cache_dir, keyed by a hash of the files they're built from
+    and the C code that builds the index.
+    With threads > 1, screens are scanned in bands on that many threads.
+    With max_distance > 0, sprites also match with up to that many pixels
+    wrong, see video.OCREngine.set_max_distance.
+    '''
+
+    # bump when the way sprites are built changes
+    cache_version = 2
+
+    # video may still be importing, so this can't use video.DATA_DIR
+    def __init__(self, debug=False,
+                 cache_dir=os.path.abspath(os.path.dirname(__file__)) + '/cache',
+                 tile_set=tilesets.DEFAULT, threads=1, max_distance=0):
         self.debug = debug
+        self.tile_set = tile_set = tilesets.get(tile_set)
         if self.debug:
             cv2.namedWindow("Stream", cv2.WINDOW_AUTOSIZE)
-        self.tile_map = self.make_tilemap('firered_tiles.png')
-        self.tile_text = self.make_tile_text('firered_tiles.txt')
-        self.ocr_engine = video.OCREngine(self.tile_map, self.tile_text)
-
-    def make_tile_text(self, fname):
+        self.ocr_engine = None
+        cache = cache_dir and self.cache_path(cache_dir, tile_set.png, tile_set.txt)
+        if cache:
+            try:
+                self.ocr_engine = video.OCREngine.load(cache, tile_set)
+            except (EnvironmentError, ValueError):
+                pass
+        if self.ocr_engine is None:
+            self.tile_map = self.make_tilemap(tile_set.png)
+            self.tile_text = self.make_tile_text(tile_set.txt)
+            self.ocr_engine = video.OCREngine(self.tile_map, self.tile_text, tile_set)
+            if cache:
+                try:
+                    if not os.path.isdir(cache_dir):
+                        os.makedirs(cache_dir)
+                    self.ocr_engine.save(cache)
+                except EnvironmentError:
+                    pass  # read-only install, build it every time
+        self.ocr_engine.threads = threads
+        if max_distance:
+            self.ocr_engine.set_max_distance(max_distance)
+
+    def fork(self):
+        ''' a SpriteIdentifier for another stream, sharing the sprite tables '''
+        identifier = copy.copy(self)
+        identifier.ocr_engine = self.ocr_engine.fork()
+        return identifier
+
+    def cache_path(self, cache_dir, *names):
+        # accel.h has the struct layouts, accel.c how sprites are hashed
+        # into the index
+        key = hashlib.sha1(str(self.cache_version) + repr(self.tile_set))
+        for name in names + ('accel.h', 'accel.c'):
+            with open(video.DATA_DIR + '/' + name, 'rb') as fd:
+                key.update(fd.read())
+        return '%s/%s-%s.sprites' % (cache_dir, os.path.splitext(names[0])[0], key.hexdigest()[:16])
+
+    def make_tile_text(self, fname, columns=16):
+        '''
+        Read the text of each tile. Lines look like "10:ABCDEFG", giving
+        the text of consecutive tiles from a hex offset, with flags after
+        the number: w for two character tiles, l for one tile standing for
+        the whole line. Files without any of those are a plain grid, one
+        character per tile and one line per row of `columns` tiles.
+        '''
         def make_wide(x):
             if not wide or len(x.strip()) < 2:
                 return x[0]
@@ -48,7 +117,14 @@ class SpriteIdentifier(object):
                 return x[0] + x
 
         out = {}
-        for line in open(fname):
+        lines = open(video.DATA_DIR + '/' + fname).read().splitlines()
+        if not any(re.match('([0-9A-F]+)([a-z]*):', line) for line in lines):
+            for row, letters in enumerate(lines):
+                for column, letter in enumerate(letters[:columns]):
+                    if letter != ' ':
+                        out[row * columns + column] = letter
+            return out
+        for line in lines:
             m = re.match('([0-9A-F]+)([a-z]*):(.*)', line)
             if m:
                 offset = int(m.group(1), 16)
@@ -71,36 +147,49 @@ class SpriteIdentifier(object):
     def make_tilemap(self, name):
         path = os.path.abspath(os.path.dirname(__file__)) + '/' + name
         tiles = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+        if self.tile_set.levels:
+            # GB sheets have a little noise in their colors
+            tiles /= 256 / self.tile_set.levels
 
         sprites = []
+        rows = self.tile_set.sprite_height
 
         n = -1
-        for y in xrange(len(tiles) / 16):
+        for y in xrange(len(tiles) / self.tile_set.cell_height):
             for x in xrange(len(tiles[0]) / 8):
                 n += 1
                 sprite = self.sprite_to_quant(tiles, x, y)
                 if not sprite:
                     continue
                 if self.debug:
-                    print('({}, {}) rows: {}'.format(y, x, len(sprite)/14))
-                    for i in xrange(0, len(sprite), 14):
-                        print(''.join([ str(x) for x in sprite[i:i+14] ]))
+                    print('({}, {}) rows: {}'.format(y, x, len(sprite)/rows))
+                    for i in xrange(0, len(sprite), rows):
+                        print(''.join([ str(x) for x in sprite[i:i+rows] ]))
                 sprites.append((n, sprite))
 
         #print "sprites:", sprites
         return sprites
 
     def sprite_to_quant(self, image, left, top):
-        bits = (image[top*16:top*16+14, left*8:left*8+8]).flatten(order='F')
-        palette = collections.OrderedDict.fromkeys(bits)
-        if len(palette) == 1:
+        top *= self.tile_set.cell_height
+        rows = self.tile_set.sprite_height
+        cell = image[top:top+rows, left*8:left*8+8]
+        background = collections.Counter(cell.flat).most_common(1)[0][0]
+        columns = [x for x in xrange(8) if (cell[:, x] != background).any()]
+        if not columns or columns[-1] - columns[0] >= 7:
             return []
+        # palette colors are numbered in order of appearance, like the OCR
+        # engine does on the screen, so trim the background columns first.
+        # Sprites are at least 3 columns wide.
+        left = min(columns[0], 5)
+        right = max(columns[-1] + 1, left + 3)
+        bits = cell[:, left:right].flatten(order='F')
+        palette = collections.OrderedDict.fromkeys(bits)
+        if len(palette) != self.tile_set.colors:
+            return []  # not text (GB sheets have other graphics too)
         palette_map = {color: n for n, color in enumerate(palette)}
         buf = [palette_map[color] for color in bits]
-        while set(buf[-14:]) == {0}: buf = buf[:-14]
-        while set(buf[:14]) == {0}: buf = buf[14:]
         #print left, top, buf
-        assert(len(set(buf)) == 3)
         return buf
 
     def screen_to_tiles(self, screen):
@@ -122,8 +211,9 @@ class SpriteIdentifier(object):
         return self.ocr_engine.identify(screen)
 
     def stream_to_text(self, frame):
-        screen = extract_screen(frame)
-        return screen, self.screen_to_text(screen)
+        geometry = self.tile_set.geometry
+        screen = numpy.empty((geometry.height, geometry.width), numpy.uint8)
+        return screen, self.ocr_engine.identify_frame(frame, screen)
 
     def handle(self, data):
         if self.debug:
@@ -149,87 +239,297 @@ class SpriteIdentifier(object):
                 print "%.1f"%((time.time()-start)*1000), text
         print 'TOTAL:', time.time() - sstart
 
+class TileSetDetector(object):
+    '''
+    Work out which game is on the stream.
+
+    Each frame is read with every tile set, scoring each one by the letters
+    it finds in words of two or more (single letters are mostly noise, like
+    the dots and slashes the GB fonts find all over GBA screens). Frames are
+    dropped (StopIteration) until after `min_frames` one of them has
+    `min_score` and at least `margin` times the runner-up's. Then on_detect
+    is called with a SpriteIdentifier for it. Handlers after this one, like
+    TimestampRecognizer, don't see the frames dropped before that.
+
+    After that, frames go through, and every `recheck`th one is scored
+    again. If after min_frames of those another tile set wins by the same
+    rules, on_detect is called with it, so a stream that changes games is
+    followed. Tile sets with the same screen geometry share one
+    extract_screen. Pass `identifiers` to use those instead of loading
+    every tile set.
+    '''
+
+    def __init__(self, on_detect, tile_sets=None, min_frames=10, min_score=40,
+                 margin=2.0, recheck=60, debug=False, identifiers=None):
+        self.on_detect = on_detect
+        self.identifiers = identifiers or [
+            SpriteIdentifier(debug=debug, tile_set=name)
+            for name in tile_sets or tilesets.TILE_SETS]
+        self.min_frames = min_frames
+        self.min_score = min_score
+        self.margin = margin
+        self.recheck = recheck
+        self.frames = 0
+        self.detected = None
+        self.clear()
+
+    def clear(self):
+        self.scores = [0] * len(self.identifiers)
+        self.samples = 0
+
+    def score(self, engine, screen):
+        ''' letters found on screen in words of at least two '''
+        results, matched = engine.scan(engine.translate(screen))
+        score = 0
+        word = 0
+        last_y = None
+        for n in xrange(matched):
+            match = results[n]
+            if match.y != last_y or match.space:
+                if word >= 2:
+                    score += word
+                word = 0
+                last_y = match.y
+            word += sum(1 for c in video.ffi.string(match.sp.text) if c.isalnum())
+        if word >= 2:
+            score += word
+        return score
+
+    def winner(self):
+        ''' the identifier the scores so far pick, or None '''
+        if self.samples < self.min_frames:
+            return None
+        ranked = sorted(xrange(len(self.scores)), key=self.scores.__getitem__, reverse=True)
+        best = self.scores[ranked[0]]
+        runner_up = self.scores[ranked[1]] if len(ranked) > 1 else 0
+        if best < self.min_score or best < self.margin * runner_up:
+            return None
+        return self.identifiers[ranked[0]]
+
+    def handle(self, data):
+        self.frames += 1
+        if self.detected is not None and self.frames % self.recheck:
+            return
+        screens = {}
+        for n, identifier in enumerate(self.identifiers):
+            geometry = identifier.tile_set.geometry
+            if geometry not in screens:
+                screens[geometry] = extract_screen(data['frame'], geometry)
+            self.scores[n] += self.score(identifier.ocr_engine, screens[geometry])
+        self.samples += 1
+
+        if self.detected is None:
+            winner = self.winner()
+            if winner is None:
+                raise StopIteration
+            print 'detected tile set', winner.tile_set.name
+        elif self.samples >= self.min_frames:
+            winner = self.winner()
+            self.clear()
+            if winner is None or winner is self.detected:
+                return
+            print 'switched to tile set', winner.tile_set.name
+        else:
+            return
+        self.detected = winner
+        self.clear()
+        self.on_detect(winner)
+        raise StopIteration  # the new identifier starts with the next frame
+
+
 class StreamProcessor(object):
-    '''Grab frames from input and process with handlers'''
+    '''
+    Grab frames from input and process with handlers.
+
+    tile_set picks the game to read, see tilesets.TILE_SETS, or with 'auto',
+    it's detected from the first frames with text on them. scan_threads
+    is how many threads each screen is scanned for sprites on, and
+    max_distance how many pixels of a letter can be wrong (see
+    SpriteIdentifier).
+
+    Frames are read with a frame source (see sources.open_source; 'auto'
+    uses ffmpeg if it's installed), and only the top-left frame_size of
+    them is decoded, by default as much as the game screen and timestamp
+    need. data['frame'] is reused once the handlers return, so copy it if
+    you need to keep it. With reuse_data, so is the data dict itself: it's
+    cleared for every frame, leaving nothing to allocate per frame once
+    the buffers have warmed up.
+    '''
     def __init__(self, bufsize=120, ratelimit=True, frame_skip=0,
-                 default_handlers=True, debug=False, video_loc=None):
+                 default_handlers=True, debug=False, video_loc=None,
+                 max_latency=1.0, tile_set=tilesets.DEFAULT,
+                 stream_url='twitch.tv/twitchplayspokemon', scan_threads=1,
+                 max_distance=0, source='auto', frame_size=None, reuse_data=False):
         self.frame_queue = Queue.Queue(bufsize)
+        self.free_frames = collections.deque()
+        self.reuse_data = reuse_data
+        self.data = {}
         if ratelimit is None:
             # Automatically disable ratelimit if not using the default stream
             # from Twitch. Users may want to set it to True/False directly.
             ratelimit = video_loc is None
         self.ratelimit = ratelimit
-        self.frame_skip = frame_skip
+        # frame_skip is the minimum; the scheduler skips more on its own
+        # when processing can't keep up with the stream.
+        self.scheduler = scheduler.FrameScheduler(
+            min_skip=frame_skip, max_latency=max_latency, realtime=ratelimit)
+        self.stats = stats.StreamStats(self.scheduler)
         self.handlers = []
+        self.identifier_handlers = []  # the ones the tile set detector added
+        self.sinks = []
         self.video_loc = video_loc
+        self.stream_url = stream_url
+        self.scan_threads = scan_threads
+        self.max_distance = max_distance
+        self.source = source
+        if frame_size is None:
+            if tile_set == 'auto':
+                geometries = [t.geometry for t in tilesets.TILE_SETS.values()]
+            else:
+                geometries = [tilesets.get(tile_set).geometry]
+            frame_size = sources.frame_size(*geometries)
+        self.frame_size = frame_size
         if default_handlers:
-            self.handlers.append(video.ScreenExtractor().handle)
-            self.handlers.append(SpriteIdentifier(debug=debug).handle)
+            if tile_set == 'auto':
+                self.detector = TileSetDetector(self.use_identifier, debug=debug)
+                self.handlers.append(self.detector.handle)
+            else:
+                identifier = SpriteIdentifier(debug=debug, tile_set=tile_set,
+                                              threads=scan_threads,
+                                              max_distance=max_distance)
+                self.handlers.append(video.ScreenExtractor(
+                    geometry=identifier.tile_set.geometry).handle)
+                self.handlers.append(identifier.handle)
             self.handlers.append(timestamp.TimestampRecognizer().handle)
 
     def add_handler(self, handler):
         self.handlers.append(handler)
 
+    def add_sink(self, sink):
+        ''' track an AsyncHandler, so it shows up in the stats and gets
+        flushed when the stream ends '''
+        self.sinks.append(sink)
+        self.stats.sinks.append(sink)
+        return sink
+
+    def add_async_handler(self, handler, **kwargs):
+        ''' add a handler that runs on its own thread, see sinks.AsyncHandler '''
+        sink = self.add_sink(sinks.AsyncHandler(handler, **kwargs))
+        self.add_handler(sink)
+        return sink
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def use_identifier(self, identifier):
+        ''' put the identifier the tile set detector picked after it, in
+        place of any it picked before '''
+        identifier.ocr_engine.threads = self.scan_threads
+        if self.max_distance:
+            identifier.ocr_engine.set_max_distance(self.max_distance)
+        identifier.ocr_engine.reset()
+        pos = self.handlers.index(self.detector.handle) + 1
+        handlers = [video.ScreenExtractor(geometry=identifier.tile_set.geometry).handle,
+                    identifier.handle]
+        self.handlers[pos:pos + len(self.identifier_handlers)] = handlers
+        self.identifier_handlers = handlers
+
+    def open_stream(self):
+        stream = sources.open_source(self.get_stream_location(), self.source, self.frame_size)
+        self.scheduler.set_source_fps(stream.fps)
+        return stream
+
+    def frame_buffer(self, stream):
+        ''' a buffer to grab a frame into, reusing ones done with '''
+        while self.free_frames:
+            try:
+                frame = self.free_frames.pop()
+            except IndexError:
+                break
+            if frame.shape == stream.shape:
+                return frame
+        return stream.alloc()
+
+    def frame_data(self, frame):
+        ''' the data dict to process a frame with '''
+        if not self.reuse_data:
+            return {'frame': frame}
+        data = self.data
+        data.clear()
+        data['frame'] = frame
+        return data
+
+    def release_frame(self, frame):
+        ''' hand a frame back once every handler has seen it '''
+        self.free_frames.append(frame)
+
     def grab_frames(self):
         while True:
-            stream = cv2.VideoCapture(self.get_stream_location())
-            #stream.set(cv2.cv.CV_CAP_PROP_POS_MSEC, (3*60+10)*1000)
+            stream = self.open_stream()
+            buf = None
             while True:
-                stream.grab()
-                for _ in range(self.frame_skip):
-                    stream.grab()
-                success, frame = stream.retrieve()
+                if buf is None:
+                    buf = self.frame_buffer(stream)
+                success = stream.grab(buf)
+                if success and not self.scheduler.admit(self.frame_queue.qsize()):
+                    continue
+                if success:
+                    frame = stream.retrieve(buf)
+                    success = frame is not None
                 if success:
                     try:
-                        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                        self.frame_queue.put(frame, block=False, timeout=1.)
+                        # when reading a file as fast as possible, wait for
+                        # room instead of losing frames
+                        self.frame_queue.put(frame, block=not self.ratelimit)
+                        if frame is buf:
+                            buf = None
                     except Queue.Full:
-                        continue
+                        self.scheduler.lost()
                 else:
+                    stream.close()
                     if self.video_loc:
                         print 'stream ended'
+                        print self.scheduler.report()
                         self.frame_queue.put(None)
                         return
                     print 'failed grabbing frame, reconnecting'
                     break
 
     def process_frames(self):
-        cur = time.time()
         while True:
-            prev = cur
-            cur = time.time()
             # give a timeout to avoid python Issue #1360:
             # Ctrl-C doesn't kill threads waiting on queues
             frame = self.frame_queue.get(True, 60*60*24)
             if frame is None:
                 return
-            data = {'frame': frame}
-            times = []
-            tot_elapsed = 0
-            for handler in self.handlers:
-                try:
-                    start = time.time()
-                    handler(data)
-                except StopIteration:
-                    break
-                except Exception:
-                    traceback.print_exc()
-                finally:
-                    elapsed = time.time() - start
-                    tot_elapsed += elapsed
-                    times.append((handler, elapsed))
-            if tot_elapsed > 1/60.0:
-                pass
-                #print 'warning, slow frame', sorted(times, key=lambda x: x[1], reverse=True)
-                #cv2.imwrite('slow_%s_%f.png' % (data['timestamp'], tot_elapsed), data['frame'])
-
-
-
-            qsize = self.frame_queue.qsize()
-            if self.ratelimit and qsize < 60:
-                # TODO: proper framerate control
-                # This hackily slows down processing as we run out of frames
-                time.sleep(max(0, 1/60. - (cur - prev) + 1/600.*(60-qsize)))
+            start = time.time()
+            self.process_frame(self.frame_data(frame))
+            self.frame_done(time.time() - start, self.frame_queue.qsize())
+            self.release_frame(frame)
+
+    def process_frame(self, data):
+        times = []
+        tot_elapsed = 0
+        for handler in self.handlers:
+            try:
+                start = time.time()
+                handler(data)
+            except StopIteration:
+                break
+            except Exception:
+                traceback.print_exc()
+            finally:
+                elapsed = time.time() - start
+                tot_elapsed += elapsed
+                times.append((handler, elapsed))
+        self.stats.record_frame(data, times, tot_elapsed)
+
+    def frame_done(self, cost, backlog):
+        self.stats.record_queue(backlog)
+        self.scheduler.processed(cost, backlog)
+        if self.ratelimit:
+            self.scheduler.pace(backlog)
 
     def get_stream_location(self):
         if self.video_loc:
@@ -237,7 +537,7 @@ class StreamProcessor(object):
         while True:
             try:
                 streamer = livestreamer.Livestreamer()
-                plugin = streamer.resolve_url('twitch.tv/twitchplayspokemon')
+                plugin = streamer.resolve_url(self.stream_url)
                 streams = plugin.get_streams()
                 return streams['source'].url
             except KeyError:
@@ -246,7 +546,10 @@ class StreamProcessor(object):
 
     def run(self):
         thread.start_new_thread(self.grab_frames, ())
-        self.process_frames()
+        try:
+            self.process_frames()
+        finally:
+            self.close()
 
 
 class LogHandler(object):
@@ -273,12 +576,28 @@ def test_corpus():
     SpriteIdentifier().test_corpus()
 
 
+def test_detect_tile_set():
+    ''' the corpus is Emerald; a stream that goes on with FireRed text
+    should be followed '''
+    import bench
+    proc = StreamProcessor(tile_set='auto')
+    picked = []
+    use_identifier = proc.use_identifier
+    proc.detector.on_detect = lambda identifier: (
+        picked.append(identifier.tile_set.name), use_identifier(identifier))
+    frames = bench.corpus_frames(12) + bench.dense_frames(700, bench.tile_cells())
+    for frame in frames:
+        proc.process_frame({'frame': frame})
+    assert picked == ['emerald', 'firered'], picked
+
+
 if __name__ == '__main__':
     def handler_stdout(data):
         print '\x1B[H' + data['timestamp'] + ' '*10
         print data['dithered']
 
-    box_reader = dialog.BoxReader()
+    # the text log has everything dialog_raw.txt would
+    box_reader = dialog.BoxReader(raw_log=None)
     box_reader.add_dialog_handler(DialogPusher().handle)
 
     parser = argparse.ArgumentParser()
@@ -286,9 +605,67 @@ if __name__ == '__main__':
                         help='Show debug output')
     parser.add_argument('video', nargs='?',
                         help='File to read from (default: live stream)')
+    parser.add_argument('--workers', '-w', type=int, default=0,
+                        help='Number of worker processes for OCR (default: none)')
+    parser.add_argument('--jobs', '-j', type=int, default=0,
+                        help='Process a video file in segments with this many '
+                        'processes (default: off)')
+    parser.add_argument('--tiles', '-t', default=tilesets.DEFAULT,
+                        choices=list(tilesets.TILE_SETS) + ['auto'],
+                        help='Game to read text from, or auto to detect it '
+                        '(default: %(default)s)')
+    parser.add_argument('--scan-threads', type=int, default=1,
+                        help='Threads to scan each screen for text on '
+                        '(default: %(default)s)')
+    parser.add_argument('--max-distance', type=int, default=0, choices=(0, 1, 2),
+                        help='Pixels of a letter that can be wrong (noisy streams) '
+                        '(default: %(default)s)')
+    parser.add_argument('--source', default='auto', choices=sources.SOURCES,
+                        help='Decode video with ffmpeg or cv2; auto uses ffmpeg '
+                        'if it is installed (default: %(default)s)')
+    parser.add_argument('--text-log', default='frames.pktl',
+                        help='Log every change of the text on screen here, '
+                        'read it with textlog.py (default: %(default)s)')
+    parser.add_argument('--stats-file',
+                        help='Write handler timings and queue stats here '
+                        'every 10 seconds')
+    parser.add_argument('--stats-port', type=int,
+                        help='Serve handler timings and queue stats over '
+                        'HTTP on this port')
+    parser.add_argument('--slow-dir',
+                        help='Save frames that took over 16ms here, '
+                        'at most one a minute')
     options = parser.parse_args()
-
-    proc = StreamProcessor(debug=options.debug, video_loc=options.video)
-    proc.add_handler(LogHandler('text', 'frames.log').handle)
+    if options.tiles == 'auto' and (options.workers or options.jobs):
+        parser.error('--tiles auto only works without --workers or --jobs')
+    if options.scan_threads > 1 and (options.workers or options.jobs):
+        parser.error('--scan-threads only works without --workers or --jobs')
+    if options.source == 'ffmpeg' and options.jobs:
+        # segments are found by seeking to a frame number, which takes cv2
+        parser.error('--source ffmpeg only works without --jobs')
+
+    if options.jobs and options.video:
+        import batch
+        proc = batch.BatchProcessor(options.video, jobs=options.jobs,
+                                    debug=options.debug, tile_set=options.tiles,
+                                    max_distance=options.max_distance)
+    elif options.workers:
+        import pipeline
+        proc = pipeline.ParallelStreamProcessor(
+            workers=options.workers, debug=options.debug,
+            video_loc=options.video, tile_set=options.tiles,
+            max_distance=options.max_distance, source=options.source)
+    else:
+        proc = StreamProcessor(debug=options.debug, video_loc=options.video,
+                               tile_set=options.tiles, scan_threads=options.scan_threads,
+                               max_distance=options.max_distance, source=options.source)
+    proc.stats.slow_dir = options.slow_dir
+    if options.stats_file:
+        proc.stats.write_to(options.stats_file)
+    if options.stats_port:
+        proc.stats.serve(options.stats_port)
+    text_log = textlog.TextLog(options.text_log)
+    proc.add_handler(text_log.handle)
     proc.add_handler(box_reader.handle)
+    proc.sinks.append(text_log)  # so it's flushed at the end
     proc.run()
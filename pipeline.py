@@ -0,0 +1,279 @@
+'''
+Run the expensive per-frame stages (screen extraction, sprite matching and
+timestamp recognition) in worker processes, so they aren't all fighting over
+one core under the GIL.
+
+Frames never get pickled: the grabbing thread decodes straight into a slot of
+a FrameRing, which lives in shared memory, and only slot numbers go through
+the task queue. Workers send back small result arrays, which are put back in
+frame order before the stateful handlers (BoxReader, LogHandler, ...) see them.
+'''
+
+import ctypes
+import multiprocessing
+import thread
+import time
+import traceback
+import Queue
+
+import numpy
+
+import ocr
+import tilesets
+import timestamp
+import video
+
+
+class FrameRing(object):
+    '''
+    A fixed set of frame slots in shared memory.
+
+    Slots are handed out by the grabbing thread and given back once the
+    frame has been through every handler. Workers only see slot numbers.
+    '''
+
+    def __init__(self, slots, frame_shape=(720, 1280), screen_shape=(160, 240)):
+        self.slots = slots
+        self.frames = self.alloc((slots,) + frame_shape)
+        self.screens = self.alloc((slots,) + screen_shape)
+        self.free = Queue.Queue()
+        for slot in xrange(slots):
+            self.free.put(slot)
+
+    @staticmethod
+    def alloc(shape):
+        # RawArray memory is inherited by forked workers, no locking needed:
+        # a slot has exactly one writer at any time.
+        buf = multiprocessing.RawArray(ctypes.c_uint8, int(numpy.prod(shape)))
+        return numpy.ctypeslib.as_array(buf).reshape(shape)
+
+    def acquire(self, block=False):
+        ''' return a free slot number, or None if they're all in use '''
+        try:
+            return self.free.get(block=block)
+        except Queue.Empty:
+            return None
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def in_use(self):
+        return self.slots - self.free.qsize()
+
+
+class WorkerError(Exception):
+    ''' a stage worker failed; the message has its traceback '''
+
+
+def stage_worker(ring, identifier, recognizer, tasks, results):
+    '''
+    Worker process loop: read (seq, slot) tasks and reply with
+    (seq, slot, matches, timestamp, elapsed) for each one. If a frame
+    raises, the worker replies with a WorkerError in place of the matches
+    and stops.
+    '''
+    engine = identifier.ocr_engine
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        start = time.time()
+        seq, slot = task
+        try:
+            frame = ring.frames[slot]
+            screen = ring.screens[slot]
+            image = engine.translate_frame(frame, screen)
+            matches = engine.pack_matches(*engine.scan(image))
+            timestamp_result = recognizer.recognize(frame)
+        except Exception:
+            results.put((seq, slot, WorkerError(traceback.format_exc()), None, 0))
+            return
+        results.put((seq, slot, matches, timestamp_result, time.time() - start))
+
+
+class StageResults(object):
+    '''Fold the results computed by stage workers back into the frame data.'''
+
+    def __init__(self, identifier, recognizer):
+        self.engine = identifier.ocr_engine
+        self.recognizer = recognizer
+
+    def handle(self, data):
+        matches = data.pop('matches')
+        data['text'] = self.engine.resolve(*self.engine.unpack_matches(matches))
+        self.recognizer.update(data, data.pop('timestamp_result'))
+
+
+class ParallelStreamProcessor(ocr.StreamProcessor):
+    '''
+    StreamProcessor that runs screen extraction, sprite matching and
+    timestamp recognition in `workers` processes. Handlers added with
+    add_handler still run in this process, in frame order.
+
+    data['frame'] and data['screen'] point into the shared ring and are
+    reused once the handlers return, so copy them if you need to keep them.
+    '''
+
+    def __init__(self, workers=2, slots=32, default_handlers=True,
+                 debug=False, tile_set=tilesets.DEFAULT, max_distance=0, **kwargs):
+        super(ParallelStreamProcessor, self).__init__(
+            default_handlers=False, debug=debug, tile_set=tile_set, **kwargs)
+        self.identifier = ocr.SpriteIdentifier(debug=debug, tile_set=tile_set,
+                                               max_distance=max_distance)
+        self.geometry = geometry = self.identifier.tile_set.geometry
+        width, height = self.frame_size
+        self.ring = FrameRing(slots, frame_shape=(height, width),
+                              screen_shape=(geometry.height, geometry.width))
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.recognizer = timestamp.TimestampRecognizer()
+        self.workers = [
+            multiprocessing.Process(target=stage_worker, args=(
+                self.ring, self.identifier, self.recognizer,
+                self.tasks, self.results))
+            for _ in xrange(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+        if default_handlers:
+            self.handlers.append(video.ScreenExtractor(geometry=geometry).handle)
+            self.handlers.append(StageResults(self.identifier, self.recognizer).handle)
+
+    def grab_frames(self):
+        seq = 0
+        while True:
+            stream = self.open_stream()
+            scratch = None
+            while True:
+                # when reading a file as fast as possible, wait for a slot
+                # instead of losing frames
+                slot = self.ring.acquire(block=not self.ratelimit)
+                if slot is None:
+                    # every slot is busy: read the frame past anyway
+                    if scratch is None:
+                        scratch = stream.alloc()
+                    success = stream.grab(scratch)
+                    if success and self.scheduler.admit(self.ring.in_use()):
+                        self.scheduler.lost()
+                    if success:
+                        continue
+                else:
+                    buf = self.ring.frames[slot]
+                    success = stream.grab(buf)
+                    frame = None
+                    # the slot held for grabbing isn't backlog
+                    if success and self.scheduler.admit(self.ring.in_use() - 1):
+                        frame = stream.retrieve(buf)
+                        success = frame is not None
+                    if frame is None:
+                        self.ring.release(slot)
+                    else:
+                        if frame is not buf:
+                            buf[:] = frame
+                        self.tasks.put((seq, slot))
+                        seq += 1
+                if not success:
+                    stream.close()
+                    if self.video_loc:
+                        print 'stream ended'
+                        print self.scheduler.report()
+                        # a slot of None marks the end, after every
+                        # frame before it has been handled
+                        self.results.put((seq, None, None, None, 0))
+                        for _ in self.workers:
+                            self.tasks.put(None)
+                        return
+                    print 'failed grabbing frame, reconnecting'
+                    break
+
+    def next_result(self):
+        '''
+        Wait for a worker's result, raising WorkerError if a worker failed
+        or died without saying why (say, crashing in C).
+        '''
+        while True:
+            try:
+                result = self.results.get(True, 1)
+            except Queue.Empty:
+                for worker in self.workers:
+                    if worker.exitcode not in (None, 0):
+                        raise WorkerError('stage worker %d exited with code %d' % (
+                            worker.pid, worker.exitcode))
+                continue
+            if isinstance(result[2], WorkerError):
+                raise result[2]
+            return result
+
+    def process_frames(self):
+        pending = {}
+        next_seq = 0
+        while True:
+            while next_seq not in pending:
+                result = self.next_result()
+                pending[result[0]] = result
+            _, slot, matches, timestamp_result, worker_cost = pending.pop(next_seq)
+            next_seq += 1
+            if slot is None:
+                return
+            start = time.time()
+            self.process_frame({
+                'frame': self.ring.frames[slot],
+                'screen': self.ring.screens[slot],
+                'matches': matches,
+                'timestamp_result': timestamp_result,
+            })
+            self.ring.release(slot)
+            # workers share the load, so whichever side is slower sets
+            # the pace
+            cost = max(time.time() - start, worker_cost / len(self.workers))
+            self.frame_done(cost, self.ring.in_use())
+
+    def run(self):
+        # fork the workers before any threads exist
+        for worker in self.workers:
+            worker.start()
+        thread.start_new_thread(self.grab_frames, ())
+        try:
+            self.process_frames()
+        finally:
+            self.close()
+
+
+def test_parallel(workers=2):
+    ''' the same video through a StreamProcessor and a
+    ParallelStreamProcessor should give the same text and timestamps '''
+    import shutil
+    import tempfile
+    import bench
+    frames = bench.typing_frames(120, bench.tile_cells()) + bench.corpus_frames(12)
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = tmp + '/fixture.avi'
+        bench.write_video(fname, frames)
+        outputs = []
+        for proc in (ocr.StreamProcessor(video_loc=fname, ratelimit=False),
+                     ParallelStreamProcessor(workers=workers, video_loc=fname,
+                                             ratelimit=False)):
+            out = []
+            proc.add_handler(lambda data: out.append(
+                (data['frame_n'], data['timestamp'], repr(data['text']))))
+            proc.run()
+            outputs.append(out)
+    finally:
+        shutil.rmtree(tmp)
+    assert outputs[0] and outputs[0] == outputs[1], outputs
+
+
+def test_worker_error():
+    ''' a worker that raises stops process_frames, instead of leaving it
+    waiting for a result that never comes '''
+    proc = ParallelStreamProcessor(workers=1, video_loc='/nonexistent')
+    proc.identifier.ocr_engine.translate_frame = None  # not callable
+    proc.workers[0].start()
+    slot = proc.ring.acquire()
+    proc.tasks.put((0, slot))
+    try:
+        proc.process_frames()
+    except WorkerError as e:
+        assert 'TypeError' in str(e), e
+    else:
+        assert False, 'no WorkerError'
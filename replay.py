@@ -0,0 +1,100 @@
+'''
+Re-run the text-level handlers (BoxReader and friends) over logged OCR
+output, without touching the video.
+
+Reads either a text log written by textlog.TextLog (frames.pktl) or a
+dialog_raw.txt from BoxReader, and prints the dialog it finds:
+
+    python replay.py frames.pktl --max-dist 4
+    python replay.py dialog_raw.txt --start 3d4h0m0s --end 3d5h0m0s
+
+dialog_raw.txt files written before empty screens were logged don't say
+when the text disappeared, so dialog boxes separated only by a blank
+screen run together in them.
+'''
+
+import argparse
+import sys
+import time
+
+import dialog
+import ocr
+import textlog
+import timestamp
+
+
+def read_log(fname, start=None, end=None):
+    '''
+    Yield frame data ('timestamp', 'timestamp_s' and 'text', and 'frame_n'
+    for text logs) for the records in a log with start <= timestamp_s < end.
+    '''
+    start, end = textlog.to_seconds(start), textlog.to_seconds(end)
+    with open(fname, 'rb') as fd:
+        magic = fd.read(len(textlog.MAGIC))
+    if magic == textlog.MAGIC:
+        for timestamp_s, frame_n, lines in textlog.TextLogReader(fname).records(start, end):
+            yield {'frame_n': frame_n, 'timestamp_s': timestamp_s,
+                   'timestamp': timestamp.format_timestamp(timestamp_s),
+                   'text': lines}
+        return
+    for data in dialog.read_raw_log(fname):
+        if start is not None and data['timestamp_s'] < start:
+            continue
+        if end is not None and data['timestamp_s'] >= end:
+            continue
+        yield data
+
+
+class ReplayProcessor(ocr.StreamProcessor):
+    '''
+    Feed the records of a log through the handlers as fast as they go.
+    Handlers see the text, but no images; anything that needs 'frame' or
+    'screen' won't work.
+    '''
+
+    def __init__(self, fname, start=None, end=None):
+        super(ReplayProcessor, self).__init__(
+            default_handlers=False, video_loc=fname, ratelimit=False)
+        self.start = start
+        self.end = end
+        self.count = 0
+
+    def run(self):
+        try:
+            for data in read_log(self.video_loc, self.start, self.end):
+                self.process_frame(data)
+                self.count += 1
+        finally:
+            self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find dialog in logged OCR output')
+    parser.add_argument('log', help='frames.pktl or dialog_raw.txt')
+    parser.add_argument('--start', help='Skip records before this time (3d4h12m0s, or seconds)')
+    parser.add_argument('--end', help='Stop at this time')
+    parser.add_argument('--max-dist', type=int, default=3,
+                        help='BoxReader max_dist (default: %(default)s)')
+    parser.add_argument('--box-rows', default='120,121',
+                        help='y of the first line of a dialog box (default: %(default)s)')
+    parser.add_argument('--box-left', type=int, default=39,
+                        help='Dialog boxes start left of this x (default: %(default)s)')
+    parser.add_argument('--text-log',
+                        help='Also write the records to this text log, '
+                        'to convert a dialog_raw.txt')
+    options = parser.parse_args()
+
+    proc = ReplayProcessor(options.log, options.start, options.end)
+    box_reader = dialog.BoxReader(
+        max_dist=options.max_dist, raw_log=None, box_left=options.box_left,
+        box_rows=tuple(int(y) for y in options.box_rows.split(',')))
+    box_reader.add_dialog_handler(ocr.DialogPusher().handle)
+    if options.text_log:
+        text_log = textlog.TextLog(options.text_log)
+        proc.add_handler(text_log.handle)
+        proc.sinks.append(text_log)
+    proc.add_handler(box_reader.handle)
+
+    start = time.time()
+    proc.run()
+    sys.stderr.write('%d records in %.2fs\n' % (proc.count, time.time() - start))
@@ -0,0 +1,167 @@
+import time
+
+
+class FrameScheduler(object):
+    '''
+    Decide which source frames get processed, and when.
+
+    Tracks the source frame rate (as reported by the container, or measured
+    from frame arrivals if it doesn't say) and the cost of processing a
+    frame, and raises frame skipping until processing keeps up, so the
+    backlog never holds more than max_latency seconds of frames. When realtime is False
+    (reading a file as fast as possible) nothing is skipped beyond min_skip;
+    the grabber blocks instead.
+
+    `dropped` counts frames skipped on purpose, `overflow` counts frames
+    lost because the frame queue was full anyway.
+    '''
+
+    max_backoff = 3
+
+    def __init__(self, min_skip=0, max_latency=1.0, realtime=True, fps=60.0):
+        self.min_skip = min_skip
+        self.max_latency = max_latency
+        self.realtime = realtime
+        self.fps = fps
+        self.cost = 0.0  # seconds to process one frame, moving average
+        self.skip = min_skip
+        self.backoff = 0
+        self.dropped = 0
+        self.overflow = 0
+        self.processed_count = 0
+        self.countdown = 0
+        self.last_arrival = None
+        self.next_due = None
+        self.fps_reported = False
+
+    def set_source_fps(self, fps):
+        ''' use the frame rate the container reports, if it's sane '''
+        self.fps_reported = 1 <= fps <= 240
+        if self.fps_reported:
+            self.fps = float(fps)
+
+    def max_backlog(self):
+        return max(1, int(self.fps * self.max_latency))
+
+    def arrived(self, now=None):
+        ''' note that the source produced a frame '''
+        if now is None:
+            now = time.time()
+        if self.last_arrival is not None and not self.fps_reported:
+            gap = now - self.last_arrival
+            # decoders deliver frames in bursts, so only trust gaps that
+            # look like a steady frame rate
+            if 1/240. < gap < 1:
+                self.fps += 0.01 * (1 / gap - self.fps)
+        self.last_arrival = now
+
+    def admit(self, backlog, now=None):
+        ''' should the frame that just arrived (at `now`) be processed? '''
+        self.arrived(now)
+        if self.realtime and backlog >= self.max_backlog():
+            self.dropped += 1
+            return False
+        if self.countdown > 0:
+            self.countdown -= 1
+            self.dropped += 1
+            return False
+        self.countdown = self.skip
+        return True
+
+    def lost(self):
+        ''' a frame was admitted, but there was nowhere to put it '''
+        self.overflow += 1
+
+    def processed(self, cost, backlog):
+        ''' record how long a frame took, and adjust skipping to match '''
+        self.processed_count += 1
+        self.cost += 0.05 * (cost - self.cost)
+        if not self.realtime:
+            return
+        # keep 10% headroom: frames arrive every 1/fps seconds, and each
+        # one we keep costs `cost`. On top of that, back off further while
+        # a backlog is building, and recover once it's drained.
+        if backlog > self.max_backlog() / 2:
+            self.backoff = min(self.backoff + 1, self.max_backoff)
+        elif backlog == 0 and self.backoff > 0:
+            self.backoff -= 1
+        needed = int(self.cost * self.fps * 1.1) + self.backoff
+        self.skip = max(self.min_skip, needed)
+
+    def pace(self, backlog):
+        '''
+        Sleep so frames come out at the rate they were captured, instead of
+        in the bursts the stream delivers them in. Never sleeps while the
+        backlog is building up.
+        '''
+        now = time.time()
+        if self.next_due is None or backlog > self.max_backlog() / 2:
+            self.next_due = now
+        delay = self.next_due - now
+        if delay > 0:
+            time.sleep(delay)
+        self.next_due = max(self.next_due, now) + (self.skip + 1) / self.fps
+
+    def stats(self):
+        return {
+            'fps': self.fps,
+            'cost': self.cost,
+            'skip': self.skip,
+            'processed': self.processed_count,
+            'dropped': self.dropped,
+            'overflow': self.overflow,
+        }
+
+    def report(self):
+        return ('fps %(fps).1f cost %(cost).4fs skip %(skip)d processed '
+                '%(processed)d dropped %(dropped)d overflow %(overflow)d'
+                % self.stats())
+
+
+def simulate(scheduler, costs, fps=60.0, bufsize=None):
+    '''
+    Feed a scheduler frames arriving at fps on a fake clock, handled one
+    at a time from a queue of `bufsize`, the nth taking costs[n] seconds.
+    Returns the largest backlog a frame was admitted against.
+    '''
+    queue = []  # arrival times of the frames waiting to be handled
+    busy_until = 0.0
+    worst = 0
+    for n, cost in enumerate(costs):
+        now = n / fps
+        # the handler works through the queue up to now
+        while queue and max(busy_until, queue[0]) + cost <= now:
+            busy_until = max(busy_until, queue.pop(0)) + cost
+            scheduler.processed(cost, len(queue))
+        if scheduler.admit(len(queue), now):
+            worst = max(worst, len(queue))
+            if bufsize is not None and len(queue) >= bufsize:
+                scheduler.lost()
+            else:
+                queue.append(now)
+    return worst
+
+
+def test_scheduler():
+    # cheap frames: nothing skipped, and the frame rate is measured
+    scheduler = FrameScheduler(fps=30.0)
+    simulate(scheduler, [0.005] * 600)
+    assert scheduler.skip == 0 and scheduler.dropped == 0
+    assert abs(scheduler.fps - 60) < 1, scheduler.fps
+
+    # frames costing 3 frame times: skipping rises, then recovers
+    scheduler = FrameScheduler()
+    worst = simulate(scheduler, [0.05] * 600)
+    assert worst < scheduler.max_backlog(), worst
+    assert scheduler.skip >= 2, scheduler.stats()
+    assert scheduler.dropped > 300 and scheduler.overflow == 0
+    simulate(scheduler, [0.005] * 600)
+    assert scheduler.skip == 0, scheduler.stats()
+
+    # a file read with min_skip: every other frame is dropped on purpose,
+    # and the ones that don't fit in the queue overflow
+    scheduler = FrameScheduler(min_skip=1, realtime=False)
+    simulate(scheduler, [0.05] * 600, bufsize=2)
+    assert scheduler.dropped == 300, scheduler.stats()
+    assert scheduler.overflow > 0
+    assert scheduler.processed_count + scheduler.overflow <= 300
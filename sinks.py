@@ -0,0 +1,217 @@
+'''
+Handlers that run off the frame loop.
+
+Anything that talks to the network or a slow disk (publishing to redis,
+posting to a web service) can stall for seconds, and inline handlers stall
+the whole stream with it. AsyncHandler puts calls on a bounded queue and
+makes them from a thread of its own, so the frame loop only pays for the
+enqueue:
+
+    proc.add_async_handler(FilteredPrinter().printer)
+    box_reader.add_dialog_handler(proc.add_sink(
+        sinks.AsyncHandler(DialogPusher().handle, overflow='block')))
+
+LocalPublisher stands in for a redis connection in tests and when running
+without one.
+'''
+
+import collections
+import threading
+import time
+import traceback
+import Queue
+
+import stats
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+# frame data keys that point into reused buffers (see
+# pipeline.ParallelStreamProcessor), and are too big to queue anyway
+BULKY_KEYS = ('frame', 'screen')
+
+
+def snapshot(*args):
+    '''
+    The default AsyncHandler prepare: shallow copies of dict arguments
+    without their images, since the frame loop keeps changing them after
+    the handler returns.
+    '''
+    return tuple(dict((k, v) for k, v in arg.iteritems() if k not in BULKY_KEYS)
+                 if isinstance(arg, dict) else arg
+                 for arg in args)
+
+
+class AsyncHandler(object):
+    '''
+    Wrap a handler (for frames or dialog, any arguments work) to run on a
+    background thread.
+
+    Calls are queued, up to `maxsize`. When the queue is full, `overflow`
+    decides what happens: 'drop_oldest' throws away the oldest queued call,
+    'drop_newest' the new one, and 'block' waits for room, which holds up
+    the frame loop like an inline handler would.
+
+    With `batch` set, the handler is called with a list of up to `batch`
+    argument tuples at a time instead, waiting up to `linger` seconds for a
+    batch to fill up. That's where pipelined writes go.
+
+    `prepare` runs in the calling thread and turns the arguments into what
+    gets queued; by default dicts are copied without their images.
+    Exceptions from the handler are printed and counted, like they are
+    for inline handlers.
+    '''
+
+    def __init__(self, handler, maxsize=1000, overflow='drop_oldest',
+                 batch=None, linger=0.05, prepare=snapshot, window=600):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s' % ', '.join(OVERFLOW_POLICIES))
+        self.handler = handler
+        self.__name__ = 'async ' + stats.handler_name(handler)
+        self.queue = Queue.Queue(maxsize)
+        self.overflow = overflow
+        self.batch = batch
+        self.linger = linger
+        self.prepare = prepare
+        self.queued = 0
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = stats.Rolling(window)  # seconds from call to handled
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # started lazily, so processes can fork before any threads exist
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.__name__)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def __call__(self, *args):
+        if self.thread is None:
+            self.start()
+        if self.prepare:
+            args = self.prepare(*args)
+        item = (time.time(), args)
+        self.queued += 1
+        if self.overflow == 'block':
+            self.queue.put(item)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Queue.Full:
+                self.dropped += 1
+                if self.overflow == 'drop_newest':
+                    return
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+
+    handle = __call__
+
+    def take(self):
+        ''' wait for the next items to handle; None at the end '''
+        item = self.queue.get()
+        if item is None:
+            return None
+        items = [item]
+        if self.batch:
+            deadline = time.time() + self.linger
+            while len(items) < self.batch:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)  # finish this batch first
+                    break
+                items.append(item)
+        return items
+
+    def run(self):
+        while True:
+            items = self.take()
+            if items is None:
+                return
+            try:
+                if self.batch:
+                    self.handler([args for _, args in items])
+                else:
+                    self.handler(*items[0][1])
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+            now = time.time()
+            for queued_at, _ in items:
+                self.latency.add(now - queued_at)
+            self.handled += len(items)
+
+    def close(self, timeout=None):
+        ''' handle everything still queued, then stop the thread '''
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def report(self):
+        return '%-40s %6d queued %8d done %6d dropped %4d errors  p99 %.1fms' % (
+            self.__name__, self.queue.qsize(), self.handled, self.dropped,
+            self.errors, self.latency.percentile(.99) * 1000)
+
+
+class LocalPublisher(object):
+    '''
+    Stands in for redis.Redis in tests: publish() keeps messages in
+    `published` instead of sending them, after sleeping for `delay`
+    seconds to act like a slow network.
+    '''
+
+    def __init__(self, delay=0, verbose=False):
+        self.delay = delay
+        self.verbose = verbose
+        self.published = collections.defaultdict(list)
+
+    def publish(self, channel, message):
+        if self.delay:
+            time.sleep(self.delay)
+        self.published[channel].append(message)
+        if self.verbose:
+            print channel, message
+        return 0
+
+
+def test_async_handler():
+    publisher = LocalPublisher(delay=0.01)
+    sink = AsyncHandler(lambda data: publisher.publish('frames', data['text']),
+                        overflow='block')
+    start = time.time()
+    for n in xrange(50):
+        sink({'text': str(n), 'frame': None})
+    assert time.time() - start < 0.25, 'slow sink held up the caller'
+    sink.close()
+    assert publisher.published['frames'] == [str(n) for n in xrange(50)]
+
+    batches = []
+    sink = AsyncHandler(batches.append, batch=10, linger=1)
+    for n in xrange(25):
+        sink(n)
+    sink.close()
+    assert [len(b) for b in batches] == [10, 10, 5], batches
+
+    release = threading.Event()
+    sink = AsyncHandler(lambda n: release.wait(), maxsize=5)
+    for n in xrange(20):
+        sink(n)
+    release.set()
+    sink.close()
+    assert sink.dropped >= 14 and sink.handled + sink.dropped == 20
+
+
+if __name__ == '__main__':
+    test_async_handler()
+    print 'ok'
@@ -0,0 +1,229 @@
+'''
+Where frames come from.
+
+A frame source opens a video file or stream URL and hands out grayscale
+frames, in the layout of a 1280x720 stream frame (the game screen and the
+timestamp are found at the same place whichever source read them):
+
+    source = open_source(loc, 'ffmpeg', size=frame_size(geometry))
+    buf = source.alloc()
+    while source.grab(buf):
+        frame = source.retrieve(buf)
+        ...
+
+grab() waits for the next frame, and retrieve() decodes it, into `buf` if
+it can, so frames that are skipped after grabbing cost as little as
+possible and kept ones don't allocate.
+
+CV2Source decodes with cv2.VideoCapture and converts each BGR frame to
+gray. FFmpegSource runs an ffmpeg process that scales, crops and converts
+to gray inside the decoder, and reads the raw gray bytes straight into
+the buffers. It only decodes the top-left `size` of the frame, which is
+all the handlers look at, and pipes a quarter of the bytes of BGR even
+before cropping.
+'''
+
+import distutils.spawn
+import re
+import subprocess
+import threading
+
+import cv2
+import numpy
+
+import tilesets
+
+CAP_PROP_FPS = getattr(cv2, 'CAP_PROP_FPS', 5)
+
+FRAME_WIDTH, FRAME_HEIGHT = 1280, 720
+
+# the right and bottom edges of the timestamp, see timestamp.TimestampRecognizer
+TIMESTAMP_RIGHT, TIMESTAMP_BOTTOM = 970 + 147, 48 + 32
+
+SOURCES = ('auto', 'cv2', 'ffmpeg')
+
+
+def frame_size(*geometries):
+    '''
+    (width, height) of the top-left part of a frame that holds the game
+    screen (for each of geometries) and the timestamp.
+    '''
+    geometries = geometries or (tilesets.GBA,)
+    width = max([TIMESTAMP_RIGHT] + [g.x + g.width * g.scale for g in geometries])
+    height = max([TIMESTAMP_BOTTOM] + [g.y + g.height * g.scale for g in geometries])
+    return min(width, FRAME_WIDTH), min(height, FRAME_HEIGHT)
+
+
+def find_ffmpeg():
+    return distutils.spawn.find_executable('ffmpeg')
+
+
+def open_source(loc, kind='auto', size=None):
+    '''
+    Open loc with a frame source: 'ffmpeg', 'cv2', or 'auto' for ffmpeg
+    if it's installed and cv2 if not. Frames are cropped to size (width,
+    height), see frame_size.
+    '''
+    if kind not in SOURCES:
+        raise ValueError('source must be one of %s' % ', '.join(SOURCES))
+    if kind == 'ffmpeg' or (kind == 'auto' and find_ffmpeg()):
+        return FFmpegSource(loc, size=size)
+    return CV2Source(loc, size=size)
+
+
+class CV2Source(object):
+    '''
+    Frames from cv2.VideoCapture, scaled to 1280x720 if they aren't,
+    cropped to the top-left `size` (width, height) and converted to gray.
+    '''
+
+    def __init__(self, loc, size=None):
+        self.capture = cv2.VideoCapture(loc)
+        self.fps = self.capture.get(CAP_PROP_FPS)
+        width, height = size or (FRAME_WIDTH, FRAME_HEIGHT)
+        self.shape = (height, width)
+
+    def alloc(self):
+        return numpy.empty(self.shape, numpy.uint8)
+
+    def grab(self, buf=None):
+        return self.capture.grab()
+
+    def retrieve(self, buf=None):
+        ''' the grabbed frame, in buf if it's given, or None '''
+        success, frame = self.capture.retrieve()
+        if not success:
+            return None
+        if frame.shape[:2] != (FRAME_HEIGHT, FRAME_WIDTH):
+            frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
+        height, width = self.shape
+        if buf is None or buf.shape != self.shape:
+            buf = self.alloc()
+        return cv2.cvtColor(frame[:height, :width], cv2.COLOR_BGR2GRAY, buf)
+
+    def close(self):
+        self.capture.release()
+
+
+class FFmpegSource(object):
+    '''
+    Frames decoded by an ffmpeg subprocess, scaled to 1280x720, cropped to
+    the top-left `size` (width, height) and converted to gray before
+    they're piped over. Frames are `size` rather than 1280x720, but
+    anything inside them is where it would be in a full frame.
+    '''
+
+    def __init__(self, loc, size=None, ffmpeg=None):
+        self.width, self.height = size or (FRAME_WIDTH, FRAME_HEIGHT)
+        self.shape = (self.height, self.width)
+        self.frame_bytes = self.width * self.height
+        self.ffmpeg = ffmpeg or find_ffmpeg() or 'ffmpeg'
+        self.proc = subprocess.Popen(
+            [self.ffmpeg, '-nostdin', '-hide_banner', '-nostats', '-i', loc,
+             '-an', '-sn', '-vf', 'scale=%d:%d,crop=%d:%d:0:0' % (
+                 FRAME_WIDTH, FRAME_HEIGHT, self.width, self.height),
+             '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=-1)
+        self.log = []
+        self.fps = self.read_header()
+        # keep reading ffmpeg's output, so it never blocks on a full pipe
+        drain = threading.Thread(target=self.read_log, name='ffmpeg log')
+        drain.daemon = True
+        drain.start()
+
+    def read_header(self):
+        ''' read ffmpeg's description of its input, returning the fps '''
+        fps = 0
+        for line in iter(self.proc.stderr.readline, ''):
+            self.log.append(line.rstrip())
+            if 'Video:' in line and not fps:
+                match = (re.search(r' ([\d.]+) fps', line) or
+                         re.search(r' ([\d.]+) tbr', line))
+                fps = float(match.group(1)) if match else 0
+            if line.startswith('Output #') or line.startswith('Stream mapping'):
+                break
+        return fps
+
+    def read_log(self):
+        for line in iter(self.proc.stderr.readline, ''):
+            self.log.append(line.rstrip())
+            del self.log[:-20]
+
+    def alloc(self):
+        return numpy.empty(self.shape, numpy.uint8)
+
+    def grab(self, buf=None):
+        ''' read the next frame into buf; False at the end '''
+        if buf is None or buf.shape != self.shape or not buf.flags.c_contiguous:
+            buf = self.alloc()
+        self.grabbed = buf
+        view = memoryview(buf.reshape(-1))
+        got = 0
+        while got < self.frame_bytes:
+            n = self.proc.stdout.readinto(view[got:])
+            if not n:
+                return False
+            got += n
+        return True
+
+    def retrieve(self, buf=None):
+        ''' the grabbed frame, already in buf if grab was given it '''
+        return self.grabbed
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+def test_sources(ffmpeg=None):
+    ''' decode a short video with both sources, checking they crop to the
+    same place and give the same screens and text '''
+    import shutil
+    import tempfile
+    import bench
+    import ocr
+    ffmpeg = ffmpeg or find_ffmpeg()
+    if not ffmpeg:
+        print 'ffmpeg not found, skipping test_sources'
+        return
+    frames = bench.typing_frames(40, bench.tile_cells()) + bench.corpus_frames(6)
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = tmp + '/fixture.avi'
+        bench.write_video(fname, frames)
+        size = frame_size(tilesets.GBA)
+        full = CV2Source(fname)
+        readers = [CV2Source(fname, size), FFmpegSource(fname, size, ffmpeg)]
+        assert [reader.fps for reader in readers] == [60, 60]
+        engine = ocr.SpriteIdentifier().ocr_engine
+        engines = [engine.fork() for _ in readers]
+        decoded = 0
+        while full.grab():
+            whole = full.retrieve()
+            screens = []
+            for reader in readers:
+                buf = reader.alloc()
+                assert reader.grab(buf)
+                frame = reader.retrieve(buf)
+                assert frame.shape == (size[1], size[0])
+                screens.append(ocr.extract_screen(frame))
+            cropped = whole[:size[1], :size[0]]
+            assert numpy.array_equal(readers[0].retrieve(), cropped)
+            # ffmpeg takes luma as is, cv2 goes through BGR first
+            diff = numpy.abs(screens[0].astype(int) - screens[1]).max()
+            assert diff <= 2, diff
+            texts = [e.identify(screen) for e, screen in zip(engines, screens)]
+            assert texts[0] == texts[1], texts
+            decoded += 1
+        assert decoded == len(frames)
+        assert not readers[1].grab(readers[1].alloc())
+        for reader in readers + [full]:
+            reader.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test_sources()
@@ -0,0 +1,193 @@
+'''
+Where the time goes: per-handler latency, queue depth and dropped frames
+for a StreamProcessor, readable as plain text from a file or over HTTP.
+'''
+
+import BaseHTTPServer
+import collections
+import os
+import thread
+import time
+
+import cv2
+
+
+def handler_name(handler):
+    ''' "ScreenExtractor.handle" for bound methods, the name otherwise '''
+    owner = getattr(handler, '__self__', None)
+    name = getattr(handler, '__name__', repr(handler))
+    if owner is not None:
+        return '%s.%s' % (type(owner).__name__, name)
+    return name
+
+
+class Rolling(object):
+    '''The last `window` values of something, with percentiles.'''
+
+    def __init__(self, window=600):
+        self.values = collections.deque(maxlen=window)
+        self.total = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.total += 1
+
+    def percentile(self, p):
+        values = sorted(self.values)
+        if not values:
+            return 0
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def max(self):
+        return max(self.values) if self.values else 0
+
+
+class StreamStats(object):
+    '''
+    Collects timings from StreamProcessor.process_frame and frame_done.
+
+    Frames over `slow_threshold` seconds are counted, and if slow_dir is
+    set, written there as PNGs, at most one every `slow_interval` seconds.
+    Call write_to() or serve() to make the report visible.
+    '''
+
+    def __init__(self, scheduler=None, window=600, slow_threshold=1/60.0,
+                 slow_dir=None, slow_interval=60):
+        self.scheduler = scheduler
+        self.window = window
+        self.slow_threshold = slow_threshold
+        self.slow_dir = slow_dir
+        self.slow_interval = slow_interval
+        self.handlers = collections.OrderedDict()
+        self.sinks = []  # sinks.AsyncHandlers
+        self.names = {}
+        self.frame_times = Rolling(window)
+        self.queue_depth = Rolling(window)
+        self.slow_frames = 0
+        self.last_capture = 0
+        self.started = time.time()
+        self.stats_file = None
+        self.write_interval = None
+        self.next_write = None
+
+    def record_frame(self, data, times, elapsed):
+        ''' times is a list of (handler, seconds) '''
+        for handler, handler_elapsed in times:
+            name = self.names.get(handler)
+            if name is None:
+                name = self.names[handler] = handler_name(handler)
+                self.handlers.setdefault(name, Rolling(self.window))
+            self.handlers[name].add(handler_elapsed)
+        self.frame_times.add(elapsed)
+
+        now = time.time()
+        if elapsed > self.slow_threshold:
+            self.slow_frames += 1
+            if (self.slow_dir and 'frame' in data and
+                    now - self.last_capture >= self.slow_interval):
+                self.last_capture = now
+                self.capture(data, times, elapsed)
+        if self.next_write is not None and now >= self.next_write:
+            self.next_write = now + self.write_interval
+            self.write()
+
+    def record_queue(self, depth):
+        self.queue_depth.add(depth)
+
+    def capture(self, data, times, elapsed):
+        ''' save a slow frame, with a note of which handlers were slow '''
+        name = '%s/slow_%s_%d_%.4f' % (self.slow_dir, data.get('timestamp', int(time.time())),
+                                       self.frame_times.total, elapsed)
+        cv2.imwrite(name + '.png', data['frame'])
+        with open(name + '.txt', 'w') as fd:
+            for handler, handler_elapsed in sorted(times, key=lambda x: x[1], reverse=True):
+                fd.write('%8.3fms %s\n' % (handler_elapsed * 1000, self.names.get(handler, handler)))
+
+    def report(self):
+        lines = ['uptime %ds, %d frames, %d slow (over %.1fms)' % (
+            time.time() - self.started, self.frame_times.total,
+            self.slow_frames, self.slow_threshold * 1000)]
+        if self.scheduler is not None:
+            lines.append(self.scheduler.report())
+        lines.append('queue depth p50 %d p99 %d max %d (last %d frames)' % (
+            self.queue_depth.percentile(.5), self.queue_depth.percentile(.99),
+            self.queue_depth.max(), len(self.queue_depth.values)))
+        lines.append('%-40s %9s %9s %9s' % ('handler', 'p50 ms', 'p99 ms', 'max ms'))
+        for name, rolling in self.handlers.items() + [('(frame)', self.frame_times)]:
+            lines.append('%-40s %9.3f %9.3f %9.3f' % (
+                name, rolling.percentile(.5) * 1000,
+                rolling.percentile(.99) * 1000, rolling.max() * 1000))
+        for sink in self.sinks:
+            lines.append(sink.report())
+        return '\n'.join(lines) + '\n'
+
+    def write_to(self, fname, interval=10):
+        ''' rewrite the report to fname every `interval` seconds '''
+        self.stats_file = fname
+        self.write_interval = interval
+        self.next_write = time.time()
+
+    def write(self):
+        # write and rename, so readers never see half a report
+        with open(self.stats_file + '.tmp', 'w') as fd:
+            fd.write(self.report())
+        os.rename(self.stats_file + '.tmp', self.stats_file)
+
+    def serve(self, port, host='127.0.0.1'):
+        ''' serve the report as text/plain from a background thread '''
+        stats = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = stats.report()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread.start_new_thread(server.serve_forever, ())
+        return server
+
+
+def test_stream_stats():
+    ''' percentiles per handler, rate limited slow frame captures, and the
+    report written to a file '''
+    import shutil
+    import tempfile
+    import numpy
+
+    def extract():
+        pass
+
+    def identify():
+        pass
+
+    tmp = tempfile.mkdtemp()
+    try:
+        stats = StreamStats(slow_dir=tmp, slow_interval=60)
+        frame = numpy.zeros((16, 16), numpy.uint8)
+        for n in xrange(100):
+            # every 10th frame is slow, on identify's account
+            times = [(extract, n % 10 / 1000.0), (identify, 0.05 if n % 10 == 0 else 0.002)]
+            stats.record_frame({'frame': frame, 'timestamp': '0d0h0m%ds' % n},
+                               times, sum(t for _, t in times))
+        report = stats.report()
+        assert '100 frames, 10 slow' in report, report
+        assert '%-40s %9.3f %9.3f %9.3f' % ('extract', 5, 9, 9) in report, report
+        assert '%-40s %9.3f %9.3f %9.3f' % ('identify', 2, 50, 50) in report, report
+        # ten slow frames, but only the first within slow_interval is kept
+        assert sorted(os.listdir(tmp)) == ['slow_0d0h0m0s_1_0.0500.png',
+                                           'slow_0d0h0m0s_1_0.0500.txt'], os.listdir(tmp)
+
+        stats.write_to(tmp + '/stats.txt')
+        stats.record_frame({}, [(extract, 0.001)], 0.001)
+        assert not os.path.exists(tmp + '/stats.txt.tmp')
+        with open(tmp + '/stats.txt') as fd:
+            assert fd.read().startswith('uptime'), 'no report written'
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,258 @@
+'''
+A compact, append-only log of OCR results, indexed by game time.
+
+Every time data['text'] changes, TextLog records the timestamp and the
+[y, xbegin, xend, text] lines. Records are buffered and written a block
+at a time, each block compressed on its own, and a sidecar index maps
+the first timestamp of each block to its offset, so finding what was on
+screen at some time only decompresses one or two blocks.
+
+File layout (little-endian):
+    header: 'PKTL' version:B
+    block:  length:L zlib(records)
+    record: timestamp_s:L frame_n:L count:H count*(line)
+    line:   y:H xbegin:H xend:H length:H text
+Index (fname + '.idx'): first timestamp_s:L frame_n:L offset:Q per block.
+
+Usage:
+
+    python textlog.py frames.pktl [START [END]]
+
+prints the records between START and END (like 3d4h12m0s, or seconds).
+'''
+
+import bisect
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import timestamp
+
+MAGIC = 'PKTL'
+VERSION = 1
+HEADER = struct.Struct('<4sB')
+BLOCK = struct.Struct('<L')
+RECORD = struct.Struct('<LLH')
+LINE = struct.Struct('<HHHH')
+INDEX = struct.Struct('<LLQ')
+
+
+def encode_record(timestamp_s, frame_n, lines):
+    parts = [RECORD.pack(timestamp_s, frame_n, len(lines))]
+    for y, xbegin, xend, text in lines:
+        parts.append(LINE.pack(y, xbegin, xend, len(text)))
+        parts.append(text)
+    return ''.join(parts)
+
+
+def decode_records(block):
+    ''' yield (timestamp_s, frame_n, lines) for each record in a block '''
+    pos = 0
+    while pos < len(block):
+        timestamp_s, frame_n, count = RECORD.unpack_from(block, pos)
+        pos += RECORD.size
+        lines = []
+        for _ in xrange(count):
+            y, xbegin, xend, length = LINE.unpack_from(block, pos)
+            pos += LINE.size
+            lines.append([y, xbegin, xend, block[pos:pos + length]])
+            pos += length
+        yield timestamp_s, frame_n, lines
+
+
+def to_seconds(t):
+    ''' accept timestamps as seconds or strings like 3d4h12m5s '''
+    if t is None or isinstance(t, (int, long)):
+        return t
+    if t.isdigit():
+        return int(t)
+    return timestamp.parse_timestamp(t)
+
+
+class TextLog(object):
+    '''
+    Handler that appends data['text'] to a binary log when it changes.
+
+    Records are buffered until `block_records` of them are waiting, or
+    for `flush_interval` seconds at most: a timer writes them out even if
+    nothing else gets appended, so a crash loses at most that much. Call
+    close() (or flush()) to write the rest.
+    '''
+
+    def __init__(self, fname, block_records=512, flush_interval=10, level=6):
+        fname = time.strftime(fname)
+        self.fd = open(fname, 'ab')
+        self.index_fd = open(fname + '.idx', 'ab')
+        if self.fd.tell() == 0:
+            self.fd.write(HEADER.pack(MAGIC, VERSION))
+        self.block_records = block_records
+        self.flush_interval = flush_interval
+        self.level = level
+        self.records = []
+        self.block_start = None
+        self.last = None
+        # the timer flushes from its own thread
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def handle(self, data):
+        lines = data['text']
+        if lines == self.last:
+            return
+        self.last = lines
+        self.append(data.get('timestamp_s', 0), data.get('frame_n', 0), lines)
+
+    def append(self, timestamp_s, frame_n, lines):
+        with self.lock:
+            if not self.records:
+                self.block_start = (timestamp_s, frame_n)
+                if self.flush_interval:
+                    self.timer = threading.Timer(self.flush_interval, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+            self.records.append(encode_record(timestamp_s, frame_n, lines))
+            if len(self.records) >= self.block_records:
+                self.flush()
+
+    def flush(self):
+        ''' write out the buffered records as a block '''
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if self.records:
+                self.write_block()
+
+    def write_block(self):
+        offset = self.fd.tell()
+        block = zlib.compress(''.join(self.records), self.level)
+        self.fd.write(BLOCK.pack(len(block)))
+        self.fd.write(block)
+        self.fd.flush()
+        # the index goes after the block, so it never points past the end
+        self.index_fd.write(INDEX.pack(self.block_start[0], self.block_start[1], offset))
+        self.index_fd.flush()
+        self.records = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.fd.close()
+            self.index_fd.close()
+
+
+class TextLogReader(object):
+    '''
+    Read a TextLog, yielding (timestamp_s, frame_n, lines) tuples, where
+    lines is a list of [y, xbegin, xend, text], like data['text'].
+
+    Timestamps can be given as seconds or as strings like 3d4h12m5s.
+    '''
+
+    def __init__(self, fname):
+        self.fd = open(fname, 'rb')
+        magic, version = HEADER.unpack(self.fd.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a text log' % fname)
+        self.index = None
+        if os.path.exists(fname + '.idx'):
+            with open(fname + '.idx', 'rb') as fd:
+                raw = fd.read()
+            self.index = [INDEX.unpack_from(raw, off)
+                          for off in xrange(0, len(raw) - INDEX.size + 1, INDEX.size)]
+        if not self.index:
+            self.index = self.build_index()
+        self.index_times = [entry[0] for entry in self.index]
+
+    def build_index(self):
+        ''' recreate the index by walking the block headers '''
+        index = []
+        offset = HEADER.size
+        while True:
+            self.fd.seek(offset)
+            head = self.fd.read(BLOCK.size)
+            if len(head) < BLOCK.size:
+                return index
+            length, = BLOCK.unpack(head)
+            raw = self.fd.read(length)
+            if len(raw) < length:
+                return index  # cut off mid-write
+            timestamp_s, frame_n, _ = RECORD.unpack(
+                zlib.decompressobj().decompress(raw, RECORD.size))
+            index.append((timestamp_s, frame_n, offset))
+            offset += BLOCK.size + length
+
+    def read_block(self, offset):
+        self.fd.seek(offset)
+        length, = BLOCK.unpack(self.fd.read(BLOCK.size))
+        return zlib.decompress(self.fd.read(length))
+
+    def records(self, start=None, end=None):
+        '''
+        Iterate over the records with start <= timestamp_s < end, only
+        decompressing the blocks that can hold them.
+        '''
+        start, end = to_seconds(start), to_seconds(end)
+        first = 0
+        if start is not None:
+            # blocks can start on the same second, so take the first of them
+            first = max(0, bisect.bisect_left(self.index_times, start) - 1)
+        for timestamp_s, frame_n, offset in self.index[first:]:
+            if end is not None and timestamp_s >= end:
+                return
+            for record in decode_records(self.read_block(offset)):
+                if start is not None and record[0] < start:
+                    continue
+                if end is not None and record[0] >= end:
+                    return
+                yield record
+
+    def __iter__(self):
+        return self.records()
+
+    def at(self, t):
+        ''' the record that was on screen at time t, or None '''
+        t = to_seconds(t)
+        block = bisect.bisect_right(self.index_times, t) - 1
+        if block < 0:
+            return None
+        last = None
+        for record in decode_records(self.read_block(self.index[block][2])):
+            if record[0] > t:
+                break
+            last = record
+        return last
+
+
+def format_lines(lines):
+    return '`'.join(text for _, _, _, text in lines)
+
+
+
+def test_flush_interval():
+    ''' buffered records get written by the timer, without another append '''
+    import shutil
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    try:
+        log = TextLog(tmp + '/test.pktl', flush_interval=0.1)
+        log.append(10, 1, [[121, 16, 72, 'HELLO']])
+        assert os.path.getsize(tmp + '/test.pktl.idx') == 0
+        time.sleep(0.5)
+        assert list(TextLogReader(tmp + '/test.pktl')) == [(10, 1, [[121, 16, 72, 'HELLO']])]
+        log.append(20, 2, [])
+        log.close()
+        assert len(list(TextLogReader(tmp + '/test.pktl'))) == 2
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    reader = TextLogReader(sys.argv[1])
+    for timestamp_s, frame_n, lines in reader.records(*sys.argv[2:4]):
+        print timestamp.format_timestamp(timestamp_s), frame_n, format_lines(lines)
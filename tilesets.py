@@ -0,0 +1,61 @@
+'''
+The games we know how to read: where their tile sheets are, and the shape
+of their screens and fonts.
+'''
+
+import collections
+
+# Where the game screen is in a stream frame (x, y), its size in game pixels,
+# and how much it's scaled up on the stream.
+Geometry = collections.namedtuple('Geometry', 'x y width height scale')
+
+# GBA games fill the left of a 1280x720 stream at 4x. GB games were shown
+# at 3x, below a title bar. GB text is always on the 8x8 tile grid, which
+# rules out lots of false matches of its small 2 color sprites.
+GBA = Geometry(8, 8, 240, 160, 4)
+GB = Geometry(8, 41, 160, 144, 3)
+
+TileSet = collections.namedtuple('TileSet', [
+    'name',
+    'png',            # the tile sheet
+    'txt',            # the text of each tile, see SpriteIdentifier.make_tile_text
+    'geometry',
+    'cell_height',    # the sheet is a grid of 8 x cell_height cells
+    'sprite_height',  # rows of each cell that are part of the sprite
+    'colors',         # colors in a sprite
+    'palette',        # (gray, color) of each stream color, or None to
+                      # split the grays into `levels` even bands
+    'levels',         # bands to quantize the sheet into first, or None
+    'row_step',       # text only starts on rows that are multiples of this
+])
+
+# the stream colors of GBA text.  61 is the dark red of the down arrow on text
+# boxes; it's mapped to the same color as the text so the 3 color heuristic
+# isn't confused.
+GBA_PALETTE = ((246, 1), (206, 2), (97, 3), (61, 3))
+
+TILE_SETS = collections.OrderedDict((tile_set.name, tile_set) for tile_set in [
+    TileSet('firered', 'firered_tiles.png', 'firered_tiles.txt', GBA,
+            16, 14, 3, GBA_PALETTE, None, 1),
+    TileSet('emerald', 'emerald_tiles.png', 'emerald_tiles.txt', GBA,
+            16, 14, 3, GBA_PALETTE, None, 1),
+    TileSet('crystal', 'crystal_tiles.png', 'crystal_tiles.txt', GB,
+            8, 8, 2, None, 4, 8),
+    TileSet('red', 'red_tiles.png', 'red_tiles.txt', GB,
+            8, 8, 2, None, 4, 8),
+    TileSet('red_outside', 'red_tiles_outside.png', 'red_tiles_outside.txt', GB,
+            8, 8, 2, None, 4, 8),
+])
+
+DEFAULT = 'firered'
+
+
+def get(tile_set):
+    ''' look up a tile set by name; TileSets are passed through '''
+    if isinstance(tile_set, TileSet):
+        return tile_set
+    try:
+        return TILE_SETS[tile_set]
+    except KeyError:
+        raise ValueError('unknown tile set %r, expected one of %s' % (
+            tile_set, ', '.join(TILE_SETS)))
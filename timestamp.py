@@ -25,17 +25,47 @@ class TimestampRecognizer(object):
     'DDEDDDEDD':     's'
     }
 
+    # nearest-neighbour matches remembered for unknown glyphs
+    max_cached = 4096
+
     def __init__(self, debug=False):
         self.debug = debug
         self.timestamp = '0d0h0m0s'
         self.timestamp_s = 0
+        self.glyphs = dict(self.col_to_char)
+        self.last_region = None
+        self.last_col_sum = None
+        self.last_result = None
 
     def handle(self, data):
+        self.update(data, self.recognize(data['frame']))
+
+    def recognize(self, frame):
+        '''
+        Read the play time from a frame, returning (timestamp, timestamp_s),
+        or None if the OCR failed.
+        '''
         x1, x2, y1, y2 = 970, 970+147, 48, 48 + 32
-        timestamp = data['frame'][y1:y2, x1:x2]
+        timestamp = frame[y1:y2, x1:x2]
+        # the clock only ticks once a second, skip the work if nothing moved
+        if self.last_region is None:
+            self.last_region = timestamp.copy()
+            self.same = numpy.empty(timestamp.shape, bool)
+        elif bool(numpy.equal(timestamp, self.last_region, self.same).all()):
+            return self.last_result
+        else:
+            self.last_region[:] = timestamp
+
         col_sum = (timestamp > 150).sum(axis=0)  # Sum bright pixels in each column
+        if numpy.array_equal(col_sum, self.last_col_sum):
+            return self.last_result
+        self.last_col_sum = col_sum
+
         col_str = (col_sum *.5 + ord('A')).astype(numpy.int8).tostring()  #
-        strings = re.split(r'A*', col_str)  # Segment by black columns
+        # Segment by black columns (those that map to 'A')
+        bounds = numpy.flatnonzero(numpy.diff(numpy.concatenate(
+            ([False], col_sum >= 2, [False]))))
+        strings = [col_str[begin:end] for begin, end in zip(bounds[::2], bounds[1::2])]
         if self.debug:
             print(strings)
             import cv2
@@ -43,22 +73,50 @@ class TimestampRecognizer(object):
             cv2.waitKey(0)
         try:
             result = self.convert(strings)
-            days, hours, minutes, seconds = map(int, re.split('[dhms]', result)[:-1])
-            self.timestamp = result
-            self.timestamp_s = ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+            self.last_result = result, parse_timestamp(result)
         except (ValueError, IndexError):
-            pass    # invalid timestamp (ocr failed)
-        finally:
-            data['timestamp'] = self.timestamp
-            data['timestamp_s'] = self.timestamp_s
+            self.last_result = None  # invalid timestamp (ocr failed)
+        return self.last_result
+
+    def update(self, data, result):
+        '''Store a recognize() result in data, keeping the last good one.'''
+        if result is not None:
+            self.timestamp, self.timestamp_s = result
+        data['timestamp'] = self.timestamp
+        data['timestamp_s'] = self.timestamp_s
 
     def convert(self, strings):
-        col_to_char = self.col_to_char
+        glyphs = self.glyphs
 
         def match(x):
-            if x in col_to_char:
-                return col_to_char[x]
-            close = difflib.get_close_matches(x, col_to_char, cutoff=.6)
-            return col_to_char[close[0]]
+            if x not in glyphs:
+                if len(glyphs) > self.max_cached:
+                    glyphs.clear()
+                    glyphs.update(self.col_to_char)
+                close = difflib.get_close_matches(x, self.col_to_char, cutoff=.6)
+                glyphs[x] = self.col_to_char[close[0]] if close else None
+            if glyphs[x] is None:
+                raise ValueError('unknown glyph %r' % x)
+            return glyphs[x]
+
+        return ''.join(match(x) for x in strings)
+
+
+TIMESTAMP_RE = re.compile(r'(\d+)d(\d+)h(\d+)m(\d+)s$')
+
+
+def parse_timestamp(text):
+    '''Convert a timestamp like '3d4h12m5s' to seconds.'''
+    m = TIMESTAMP_RE.match(text)
+    if not m:
+        raise ValueError('invalid timestamp %r' % text)
+    days, hours, minutes, seconds = map(int, m.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
 
-        return ''.join(match(x) for x in strings if x)
+def format_timestamp(seconds):
+    '''Inverse of parse_timestamp.'''
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return '%dd%dh%dm%ds' % (days, hours, minutes, seconds)
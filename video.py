@@ -1,4 +1,6 @@
+import copy
 import gzip
+import mmap
 import os
 import struct
 import time
@@ -8,6 +10,7 @@ import numpy
 
 import ocr
 import struct
+import tilesets
 
 from cffi import FFI
 
@@ -17,83 +20,354 @@ ffi = FFI()
 ffi.cdef(open(DATA_DIR + '/accel.h').read())
 C = ffi.dlopen(os.path.abspath(os.path.dirname(__file__)) + '/accel.so')
 
+# OCREngine.save/load: magic, sizeof(struct sprite), sprite count, hash table
+# size, number of widths and the widths, then the sprites and the table
+SPRITE_CACHE = struct.Struct('<4sLLLL8l')
+SPRITE_CACHE_MAGIC = 'PKSC'
+SPRITE_CACHE_ALIGN = 64
+
+
+def same_array(a, b, scratch):
+    ''' numpy.array_equal, comparing into scratch instead of a new array '''
+    if b is None or a.shape != b.shape:
+        return False
+    return bool(numpy.equal(a, b, scratch).all())
+
 
 class ScreenExtractor(object):
-    def __init__(self, fname=None, debug=False):
+    '''
+    Crop the game screen out of each frame, and stop the handler chain for
+    frames where it didn't change.
+
+    Before paying for the resize, every `stride`-th pixel of the raw crop is
+    compared against the last changed frame, and the frame is rejected if
+    none of them moved by more than `tolerance` (encoder noise). By default
+    the stride is the scale of the screen on the stream, so every game pixel
+    is looked at once. stride=0 turns this off.
+
+    The screen, and everything else per frame, goes into buffers that are
+    reused, so data['screen'] is only good until the handlers return.
+    '''
+    def __init__(self, fname=None, debug=False, stride=None, tolerance=24,
+                 geometry=tilesets.GBA):
         self.last = None
         self.n = 0
+        self.geometry = geometry
+        self.stride = geometry.scale if stride is None else stride
+        self.tolerance = tolerance
+        self.last_sample = None
+        shape = (geometry.height, geometry.width)
+        self.screen = numpy.empty(shape, numpy.uint8)
+        # the quantized screen, alternating so the last one is kept
+        self.truncs = [numpy.empty(shape, numpy.uint8) for _ in range(2)]
+        self.same = numpy.empty(shape, bool)
 
     def handle(self, data):
         self.n += 1
-        data['screen'] = ocr.extract_screen(data['frame'])
-        trunc = data['screen'] >> 6  # / 64 -> values in [0, 3]
-        data['changed'] = not numpy.array_equal(trunc, self.last)
+        if 'screen' not in data:
+            # the screen may already have been extracted by a worker process
+            if self.stride and not self.raw_changed(data['frame']):
+                data['changed'] = False
+                data['frame_n'] = self.n
+                raise StopIteration
+            data['screen'] = ocr.extract_screen(data['frame'], self.geometry, self.screen)
+        trunc = self.truncs[self.truncs[0] is self.last]
+        numpy.right_shift(data['screen'], 6, trunc)  # / 64 -> values in [0, 3]
+        data['changed'] = not same_array(trunc, self.last, self.same)
         data['frame_n'] = self.n
         if not data['changed']:
             raise StopIteration
 
         self.last = trunc
 
+    def raw_changed(self, frame):
+        region = ocr.screen_region(frame, self.geometry)
+        if region.strides[1] != 1:
+            return True
+        height, width = region.shape
+        step = self.stride
+        tolerance = self.tolerance
+        if self.last_sample is None:
+            self.last_sample = numpy.zeros((height / step) * (width / step), numpy.uint8)
+            tolerance = -1  # take the first frame's samples
+        # sample from the middle of each step x step block
+        start = region[step / 2:, step / 2:]
+        return bool(C.sample_changed(
+            ffi.cast('uint8_t *', start.ctypes.data), region.strides[0],
+            width, height, step,
+            ffi.cast('uint8_t *', self.last_sample.ctypes.data), tolerance))
+
 
 class OCREngine(object):
-    def __init__(self, sprites, sprite_text):
+    max_matches = 128
+    threads = 1  # scan bands of the screen on this many native threads
+
+    def __init__(self, sprites, sprite_text, tile_set=tilesets.DEFAULT):
+        self.tile_set = tile_set = tilesets.get(tile_set)
+        rows = tile_set.sprite_height
+
         def pack_image(buf):
             out = []
-            for n in range(0, len(buf) / 14):
+            for n in range(0, len(buf) / rows):
                 column = 0
-                for color in buf[n*14:n*14+14]:
+                for color in buf[n*rows:n*rows+rows]:
                     column = (column << 2) | color
                 out.append(column)
             return out
 
-        def pack_to_struct(buf):
-            # for binary search to work properly, we need to have
-            # sprites arranged lexicographically by image bytes.
-            # this lets us sort them properly
-            buf = pack_image(buf)
-            return struct.pack('%dI' % len(buf), *buf)
-
         self.sprite_text = ''
         self.sprites = ffi.new('struct sprite[]', len(sprites) + 1)
         self.n_sprites = len(sprites)
-        sprites.sort(key=lambda (id, buf): pack_to_struct(buf))
         for sprite_n, (sprite_id, sprite_buf) in enumerate(sprites):
             sprite = self.sprites[sprite_n]
             sprite.id = sprite_id
             text = sprite_text.get(sprite_id, '#')
             sprite.text = text
             sprite.image = pack_image(sprite_buf)
-            sprite.width = max(3, len(sprite_buf) / 14)
+            sprite.width = max(3, len(sprite_buf) / rows)
         self.sprites[len(sprites)].id = -1
         #print repr(list(self.sprites[0].image[0:128]))
 
+        # hash table for finding sprites by their packed columns
+        table_size = 64
+        while table_size < len(sprites) * 4:
+            table_size *= 2
+        self.index_table = ffi.new('int32_t[]', table_size)
+        self.index = ffi.new('struct sprite_index *')
+        if C.build_sprite_index(self.sprites, self.n_sprites, self.index,
+                                self.index_table, table_size):
+            raise ValueError('unable to index sprites')
+
+        self.setup()
+
+    def setup(self):
+        ''' set up everything but the sprite tables '''
+        tile_set = self.tile_set
+        self.geometry = geometry = tile_set.geometry
+        self.index.width = geometry.width
+        self.index.height = geometry.height
+        self.index.sprite_height = tile_set.sprite_height
+        self.index.n_colors = tile_set.colors
+        self.index.row_step = tile_set.row_step
+
+        # stream grays to sprite colors
         self.map = ffi.new('uint8_t[]', 256)
-        #  61 is the dark red of the down arrow on text boxes
-        #  Map it to 2 so the OCR engine's 3 color heuristic isn't confused.
-        for color, n in ((246, 1), (206, 2), (97, 3), (61, 3)):
-            for off in range(-9, 9):
-                self.map[color + off] = n
+        if tile_set.palette:
+            for color, n in tile_set.palette:
+                for off in range(-9, 9):
+                    self.map[color + off] = n
+        else:
+            for gray in range(256):
+                self.map[gray] = gray * tile_set.levels / 256
+
+        # translated images; identify keeps the last one to compare against
+        self.images = [numpy.zeros(geometry.width * geometry.height, numpy.uint8)
+                       for _ in range(2)]
+
+        self.reset()
+
+    def save(self, fname):
+        ''' write the sprite tables to a file that load can map back in '''
+        sprite_size = ffi.sizeof('struct sprite')
+        index = self.index
+        header = SPRITE_CACHE.pack(
+            SPRITE_CACHE_MAGIC, sprite_size, self.n_sprites, index.mask + 1,
+            index.n_widths, *index.widths)
+        # write and rename, so a reader never maps half a file
+        with open(fname + '.tmp', 'wb') as fd:
+            fd.write(header.ljust(SPRITE_CACHE_ALIGN, '\0'))
+            fd.write(ffi.buffer(self.sprites, sprite_size * (self.n_sprites + 1)))
+            fd.write(ffi.buffer(self.index_table))
+        os.rename(fname + '.tmp', fname)
+
+    @classmethod
+    def load(cls, fname, tile_set=tilesets.DEFAULT):
+        '''
+        Make an OCREngine for tile_set from a file written by save, using
+        the sprite tables straight from a private mapping of it. Raises
+        ValueError if the file doesn't match this build.
+        '''
+        with open(fname, 'rb') as fd:
+            cache = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(cache) < SPRITE_CACHE_ALIGN:
+            raise ValueError('%s: truncated sprite cache' % fname)
+        fields = SPRITE_CACHE.unpack_from(cache)
+        magic, sprite_size, n_sprites, table_size, n_widths = fields[:5]
+        sprites_size = sprite_size * (n_sprites + 1)
+        if (magic != SPRITE_CACHE_MAGIC or sprite_size != ffi.sizeof('struct sprite') or
+                len(cache) != SPRITE_CACHE_ALIGN + sprites_size + 4 * table_size):
+            raise ValueError('%s: not a sprite cache for this build' % fname)
 
+        self = cls.__new__(cls)
+        self.tile_set = tilesets.get(tile_set)
+        self.cache = ffi.from_buffer(cache)  # keeps the mapping alive
+        self.sprite_text = ''
+        self.n_sprites = n_sprites
+        self.sprites = ffi.cast('struct sprite *', self.cache + SPRITE_CACHE_ALIGN)
+        self.index_table = ffi.cast('int32_t *', self.cache + SPRITE_CACHE_ALIGN + sprites_size)
+        self.index = ffi.new('struct sprite_index *')
+        self.index.sprites = self.sprites
+        self.index.n_sprites = n_sprites
+        self.index.n_widths = n_widths
+        self.index.widths = fields[5:]
+        self.index.mask = table_size - 1
+        self.index.table = self.index_table
+        C.filter_sprites(self.index)
+        self.setup()
+        return self
+
+    def set_max_distance(self, max_distance):
+        ''' let sprites match with up to max_distance (at most 2) pixels
+        wrong, for noisy streams; each match's distance and confidence say
+        how many were. 0 is exact matches only. '''
+        table_size = 64
+        while table_size < self.n_sprites * (max_distance + 1) * 4:
+            table_size *= 2
+        near_table = ffi.new('int32_t[]', table_size)
+        if C.build_near_index(self.index, near_table, table_size, max_distance):
+            raise ValueError('max_distance must be between 0 and 2')
+        self.near_table = near_table
+
+    def fork(self):
+        ''' a new engine for another stream: the sprite tables (which are
+        only read) are shared, the per-stream state isn't '''
+        engine = copy.copy(self)
+        engine.images = [numpy.zeros_like(image) for image in self.images]
+        engine.reset()
+        return engine
+
+    def reset(self):
+        ''' forget everything about previous frames '''
         self.last_image = None
         self.last_matched = None
+        self.last_count = 0
+        self.last_out = []
+        self.last_scan = None
+        self.visited = ffi.new('uint8_t[]', self.geometry.height)
+        # per-stream buffers, so frames don't allocate once warmed up
+        self.match_pool = []
+        self.overlap = ffi.new('int *')
+        self.same = numpy.empty(self.geometry.width * self.geometry.height, bool)
+
+    def match_buffer(self, *busy):
+        ''' a sprite_match[max_matches] from the pool that isn't one of
+        busy (the results still needed) '''
+        for results in self.match_pool:
+            if len(results) >= self.max_matches and all(results is not b for b in busy):
+                return results
+        results = ffi.new('struct sprite_match[]', self.max_matches)
+        self.match_pool.append(results)
+        return results
+
+    def next_image(self):
+        ''' return a buffer for a translated image, making sure it isn't
+        the one kept as last_image '''
+        image = self.images[0]
+        if image is self.last_image:
+            image = self.images[1]
+        return image
+
+    def translate(self, screen):
+        ''' convert a screen into the column-major palette indices that
+        identify_sprites works on '''
+        screen = numpy.ascontiguousarray(screen)
+        image = self.next_image()
+        C.translate_screen(ffi.cast('uint8_t *', screen.ctypes.data),
+                           self.geometry.width, self.geometry.height, self.map,
+                           ffi.cast('uint8_t *', image.ctypes.data))
+        return image
+
+    def translate_frame(self, raw, screen=None):
+        ''' like translate(ocr.extract_screen(raw)), but cropping, shrinking,
+        translating and transposing in a single pass. If given, screen is
+        filled in with what extract_screen would have returned. '''
+        geometry = self.geometry
+        region = ocr.screen_region(raw, geometry)
+        image = self.next_image()
+        C.extract_screen(ffi.cast('uint8_t *', region.ctypes.data),
+                         region.strides[0], geometry.scale,
+                         geometry.width, geometry.height,
+                         ffi.NULL if screen is None else ffi.cast('uint8_t *', screen.ctypes.data),
+                         self.map, ffi.cast('uint8_t *', image.ctypes.data))
+        return image
+
+    def scan(self, image):
+        ''' find sprites in a translated image, return (results, count).
+        This doesn't touch any per-stream state, so it's safe to call from
+        worker processes '''
+        pimage = ffi.cast('uint8_t *', image.ctypes.data)
+        results = ffi.new('struct sprite_match[]', self.max_matches)
+        matched = C.identify_sprites_threads(pimage, self.index, results, self.max_matches,
+                                             self.threads)
+        return results, matched
+
+    def rescan(self, image):
+        ''' like scan, but only rescans the rows that changed since the
+        last call, reusing its results for the rest '''
+        pimage = ffi.cast('uint8_t *', image.ctypes.data)
+        if self.last_scan is None:
+            prev_pimage, prev_results, prev_matched = ffi.NULL, ffi.NULL, 0
+        else:
+            prev_image, prev_results, prev_matched = self.last_scan
+            prev_pimage = ffi.cast('uint8_t *', prev_image.ctypes.data)
+        results = self.match_buffer(prev_results, self.last_matched)
+        matched = C.identify_sprites_dirty_threads(
+            pimage, prev_pimage, self.index, self.visited,
+            prev_results, prev_matched, results, self.max_matches, self.threads)
+        self.last_scan = (image, results, matched)
+        return results, matched
+
+    def pack_matches(self, results, matched):
+        ''' flatten scan results into an array of [x, y, sprite_n, space,
+        distance] rows that can be sent to another process '''
+        out = numpy.empty((matched, 5), numpy.int32)
+        base = int(ffi.cast('intptr_t', self.sprites))
+        size = ffi.sizeof('struct sprite')
+        for n in xrange(matched):
+            match = results[n]
+            sprite_n = (int(ffi.cast('intptr_t', match.sp)) - base) / size
+            out[n] = (match.x, match.y, sprite_n, match.space, match.distance)
+        return out
+
+    def unpack_matches(self, packed):
+        ''' inverse of pack_matches, return (results, count) '''
+        results = self.match_buffer(self.last_matched)
+        sprite_height = self.tile_set.sprite_height
+        for n, (x, y, sprite_n, space, distance) in enumerate(packed):
+            match = results[n]
+            match.x = x
+            match.y = y
+            match.sp = self.sprites + sprite_n
+            match.space = space
+            match.distance = distance
+            match.confidence = 1 - float(distance) / (match.sp.width * sprite_height)
+        return results, len(packed)
 
     def identify(self, screen):
         ''' recognize text on screen, return list of lists of
         [ypos, xbegin, xend, text]
         '''
-        max_matches = 128
-        image = screen.flatten(order='F')
-        pimage = ffi.cast('uint8_t *', image.ctypes.data)
-        C.translate_bytes(pimage, 240*160, self.map)
-        if numpy.array_equal(image, self.last_image):
+        return self.identify_image(self.translate(screen))
+
+    def identify_frame(self, raw, screen=None):
+        ''' identify, straight from a stream frame, see translate_frame '''
+        return self.identify_image(self.translate_frame(raw, screen))
+
+    def identify_image(self, image):
+        if same_array(image, self.last_image, self.same):
             return self.last_out
         self.last_image = image
-        results = ffi.new('struct sprite_match[]', max_matches)
-        matched = C.identify_sprites(pimage, self.sprites, self.n_sprites, results, max_matches)
+        return self.resolve(*self.rescan(image))
+
+    def resolve(self, results, matched):
+        ''' merge scan results with the previous frame's and convert them
+        to text, see identify '''
+        max_matches = self.max_matches
         if self.last_matched is not None:
-            overlap = ffi.new('int *')
-            merged = ffi.new('struct sprite_match[]', max_matches)
-            merge_match = C.merge_sprites(self.last_matched, max_matches, results, max_matches, merged, max_matches, overlap)
+            overlap = self.overlap
+            merged = self.match_buffer(results, self.last_matched)
+            # pooled buffers aren't zeroed past the matches, so pass counts
+            merge_match = C.merge_sprites(self.last_matched, self.last_count, results, matched, merged, max_matches, overlap)
             #for n in xrange(overlap):
             #s    print (merged[n].text and ffi.string(merged[n].text)),
             #print 'matched', overlap
@@ -101,6 +375,7 @@ class OCREngine(object):
                 results = merged
                 matched = merge_match
         self.last_matched = results
+        self.last_count = matched
         out = []
         lastY = None
         for n in xrange(matched):
@@ -132,12 +407,17 @@ class ScreenCompressor(object):
             self.fd = gzip.GzipFile(time.strftime(fname), "w")
         self.debug = debug
         self.start = time.time()
+        self.truncs = None
+        self.pout = ffi.new('uint8_t[]', self.FRAME_BYTES)
 
     def handle(self, data):
-        trunc = data['screen'] >> 6  # / 64
-        trunc_flat = trunc.flatten()
-        ptrunc = ffi.cast("uint8_t *", trunc_flat.ctypes.data)
-        pout = ffi.new('uint8_t[]', self.FRAME_BYTES)
+        screen = data['screen']
+        if self.last is None or self.last.shape != screen.shape:
+            self.truncs = [numpy.empty(screen.shape, numpy.uint8) for _ in range(2)]
+        trunc = self.truncs[self.truncs[0] is self.last]
+        numpy.right_shift(screen, 6, trunc)  # / 64
+        ptrunc = ffi.cast("uint8_t *", trunc.ctypes.data)
+        pout = self.pout
         C.pack2bpp(ptrunc, pout)
 
         if self.fd:
@@ -155,15 +435,95 @@ class ScreenCompressor(object):
             cv2.waitKey(1)
 
     def unpack(self, pout, frame):
-        off = 0
-        for py in range(18):
-            for px in range(20):
-                for n in range(8):
-                    a = pout[off] | (pout[off + 1] << 8)
-                    off += 2
-                    for nx in range(8):
-                        frame[py*8+n][px*8+nx] = a & 3
-                        a >>= 2
+        out = numpy.empty((144, 160), numpy.uint8)
+        C.unpack2bpp(pout, ffi.cast('uint8_t *', out.ctypes.data), 1)
+        frame[:144, :160] = out
+
+def test_extract(directory='corpus', repeat=200):
+    ''' check the fused extract_screen kernel against the cv2 path, and
+    compare their speed '''
+    engine = ocr.SpriteIdentifier().ocr_engine
+    frames = [cv2.cvtColor(cv2.imread(directory + '/' + fn), cv2.COLOR_BGR2GRAY)
+              for fn in os.listdir(directory)]
+
+    def separate(frame):
+        image = ocr.extract_screen(frame).flatten(order='F')
+        C.translate_bytes(ffi.cast('uint8_t *', image.ctypes.data), 240*160, engine.map)
+        return image
+
+    screen = numpy.empty((160, 240), numpy.uint8)
+    for frame in frames:
+        fused = engine.translate_frame(frame, screen)
+        assert numpy.array_equal(fused, separate(frame))
+        assert numpy.array_equal(screen, ocr.extract_screen(frame))
+
+    for name, func in (('separate', separate),
+                       ('fused', engine.translate_frame)):
+        start = time.time()
+        for _ in xrange(repeat):
+            for frame in frames:
+                func(frame)
+        print '%-8s %.3fms' % (name, (time.time() - start) * 1000 / repeat / len(frames))
+
+
+def test_steady_state(rounds=4):
+    ''' check that once warmed up, processing frames doesn't allocate:
+    the buffers handlers see come from fixed pools, and memory doesn't
+    grow (net bytes with tracemalloc, gc-tracked objects without it) '''
+    import gc
+    import bench
+    import stats
+    frames = bench.typing_frames(120, bench.tile_cells())
+    proc = ocr.StreamProcessor(reuse_data=True)
+    # timings are kept for a window of frames, which would look like growth
+    proc.stats = stats.StreamStats(proc.scheduler, window=1)
+    proc.add_handler(ScreenCompressor().handle)
+    engine = proc.handlers[1].__self__.ocr_engine
+    # every buffer seen, kept alive so a new one can't reuse an old id
+    seen = dict((name, {}) for name in ('data', 'screen', 'image', 'matches'))
+
+    def track(data):
+        for name, buf in (('data', data), ('screen', data['screen']),
+                          ('image', engine.last_image), ('matches', engine.last_matched)):
+            seen[name][id(buf)] = buf
+    proc.add_handler(track)
+
+    def run(rounds):
+        # whole rounds, so the text on screen ends up like it started
+        for _ in xrange(rounds):
+            for frame in frames:
+                proc.process_frame(proc.frame_data(frame))
+
+    run(1)
+    for ids in seen.values():
+        ids.clear()
+    # allowed growth per frame: a few lines of text's worth, well short
+    # of keeping a screen or any other buffer
+    if bench.tracemalloc:
+        bench.tracemalloc.start()
+        measure = lambda: bench.tracemalloc.get_traced_memory()[0]
+        limit = 1024
+    else:
+        gc.collect()
+        gc.disable()
+        measure = lambda: gc.get_count()[0]
+        limit = 0.1
+    try:
+        before = measure()
+        run(rounds)
+        growth = measure() - before
+    finally:
+        if bench.tracemalloc:
+            bench.tracemalloc.stop()
+        else:
+            gc.enable()
+    print 'grew by %d over %d frames, buffers used: %s' % (
+        growth, rounds * len(frames),
+        ', '.join('%s %d' % (k, len(v)) for k, v in sorted(seen.items())))
+    assert growth < limit * rounds * len(frames)
+    assert len(seen['data']) == len(seen['screen']) == 1
+    assert len(seen['image']) <= 2 and len(seen['matches']) <= 3
+
 
 if __name__ == '__main__':
     import timestamp